@@ -6,6 +6,8 @@ let currentUser = null;
 
 // Кэш данных (загружаются из API)
 let orders = [];
+// Курсор изменений заказов: после первой загрузки догружаются только изменения
+let ordersCursor = null;
 let driverApplications = [];
 let drivers = [];
 let notifications = [];
@@ -31,12 +33,17 @@ async function loadCurrentUser() {
 // Функция для загрузки заказов
 async function loadOrders() {
     try {
-        const response = await fetch(`${API_BASE_URL}/orders`, {
+        if (ordersCursor !== null && await loadOrderChanges()) {
+            return orders;
+        }
+        // Списки выводят только краткие поля заказа
+        const response = await fetch(`${API_BASE_URL}/orders?view=summary`, {
             credentials: 'include'
         });
         const data = await response.json();
         if (data.success) {
             orders = (data.orders || []).map(normalizeOrder);
+            ordersCursor = data.cursor ?? null;
             return orders;
         }
         return [];
@@ -46,6 +53,34 @@ async function loadOrders() {
     }
 }
 
+// Слияние изменений заказов после курсора в локальный кэш.
+// false - курсор не подошел, нужна полная загрузка списка
+async function loadOrderChanges() {
+    const byId = new Map(orders.map(order => [order.id, order]));
+    let hasMore = true;
+    while (hasMore) {
+        const response = await fetch(`${API_BASE_URL}/orders/changes?view=summary&since=${encodeURIComponent(ordersCursor)}`, {
+            credentials: 'include'
+        });
+        const data = await response.json();
+        if (!data.success || data.reset) {
+            ordersCursor = null;
+            return false;
+        }
+        // Заказы в архиве или у другого водителя больше не видны
+        (data.removed || []).forEach(id => byId.delete(id));
+        (data.orders || []).forEach(o => {
+            const order = normalizeOrder(o);
+            byId.set(order.id, order);
+        });
+        ordersCursor = data.cursor;
+        hasMore = data.hasMore;
+    }
+    // Порядок как в полном списке: новые заказы сверху
+    orders = [...byId.values()].sort((a, b) => String(b.createdAt || '').localeCompare(String(a.createdAt || '')));
+    return true;
+}
+
 // Константы статусов заказов
 const ORDER_STATUSES = {
 // Статусы для клиента
@@ -638,6 +673,7 @@ try {
 
 currentUser = null;
 orders = [];
+ordersCursor = null;
 driverApplications = [];
 drivers = [];
 notifications = [];
@@ -714,6 +750,57 @@ if (event.inputType === 'deleteContentBackward' && currentIndex > 1 && value.len
 }
 }
 
+// Запрос кода подтверждения у сервера (purpose: 'register' | 'reset_password')
+async function requestVerificationCode(contact, purpose) {
+try {
+    const response = await fetch(`${API_BASE_URL}/verification/issue`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        body: JSON.stringify({ contact, purpose })
+    });
+    const data = await response.json();
+    if (!data.success) {
+        showNotification(data.message || 'Не удалось отправить код', 'error');
+        return false;
+    }
+    // Без SMS-шлюза сервер в демо-режиме возвращает код регистрации в ответе;
+    // код восстановления пароля приходит только на контакт
+    if (purpose === 'register' && data.code) {
+        showNotification(`Код подтверждения: ${data.code}`, 'info');
+    } else {
+        showNotification(`Код отправлен на ${contact}`, 'info');
+    }
+    return true;
+} catch (error) {
+    console.error('Ошибка отправки кода:', error);
+    showNotification('Ошибка соединения с сервером', 'error');
+    return false;
+}
+}
+
+// Проверка кода на сервере; при успехе контакт подтвержден в текущей сессии
+async function confirmVerificationCode(contact, purpose, code) {
+try {
+    const response = await fetch(`${API_BASE_URL}/verification/verify`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        body: JSON.stringify({ contact, purpose, code })
+    });
+    const data = await response.json();
+    if (!data.success) {
+        showNotification(data.message || 'Неверный код подтверждения. Попробуйте еще раз.', 'error');
+        return false;
+    }
+    return true;
+} catch (error) {
+    console.error('Ошибка проверки кода:', error);
+    showNotification('Ошибка соединения с сервером', 'error');
+    return false;
+}
+}
+
 // Таймер для повторной отправки кода при регистрации
 let registerTimerInterval;
 let registerTimerSeconds = 59;
@@ -747,19 +834,20 @@ document.getElementById('reg-resend-code').classList.add('disabled');
 }
 
 // Функция для повторной отправки кода при регистрации
-function resendRegisterCode() {
+async function resendRegisterCode() {
 const resendCodeElement = document.getElementById('reg-resend-code');
 
-if (resendCodeElement.classList.contains('disabled')) {
+if (resendCodeElement.classList.contains('disabled') || !tempRegistrationData) {
     return;
 }
 
-showNotification('Код отправлен повторно!', 'success');
-startRegisterTimer();
+if (await requestVerificationCode(tempRegistrationData.phone, 'register')) {
+    startRegisterTimer();
+}
 }
 
 // Функция для проверки введенного кода при регистрации
-function verifyRegisterCode() {
+async function verifyRegisterCode() {
 const code1 = document.getElementById('reg-sms-code-1').value;
 const code2 = document.getElementById('reg-sms-code-2').value;
 const code3 = document.getElementById('reg-sms-code-3').value;
@@ -772,8 +860,13 @@ if (fullCode.length !== 4) {
     return;
 }
 
-// Проверяем код (для демо используем "1234")
-if (fullCode === "1234") {
+if (!tempRegistrationData) {
+    showNotification('Ошибка регистрации: данные не найдены', 'error');
+    return;
+}
+
+// Проверяем код на сервере
+if (await confirmVerificationCode(tempRegistrationData.phone, 'register', fullCode)) {
     // Регистрируем пользователя через API после проверки кода
     if (tempRegistrationData) {
         fetch(`${API_BASE_URL}/register`, {
@@ -807,11 +900,7 @@ if (fullCode === "1234") {
         .finally(() => {
             tempRegistrationData = null;
         });
-    } else {
-        showNotification('Ошибка регистрации: данные не найдены', 'error');
     }
-} else {
-    showNotification('Неверный код подтверждения. Попробуйте еще раз.', 'error');
 }
 }
 
@@ -891,16 +980,17 @@ openForgotPasswordModal();
 }
 
 // Функция для отправки кода для сброса пароля
-function sendRecoveryCode() {
-const contact = document.getElementById('recovery-contact').value;
+async function sendRecoveryCode() {
+const contact = document.getElementById('recovery-contact').value.trim();
 
 if (!contact) {
     showNotification('Заполните поле с телефоном или email', 'warning');
     return;
 }
 
-// В демо всегда отправляем код 1234 и показываем уведомление
-showNotification('Код восстановления: 1234', 'info');
+if (!await requestVerificationCode(contact, 'reset_password')) {
+    return;
+}
 closeForgotPasswordModal();
 openConfirmCodeModal();
 }
@@ -952,19 +1042,21 @@ document.getElementById('resend-code').classList.add('disabled');
 }
 
 // Функция для повторной отправки кода
-function resendCode() {
+async function resendCode() {
 const resendCodeElement = document.getElementById('resend-code');
 
 if (resendCodeElement.classList.contains('disabled')) {
     return;
 }
 
-showNotification('Код для сброса пароля: 1234', 'info');
-startTimer();
+const contact = document.getElementById('recovery-contact').value.trim();
+if (await requestVerificationCode(contact, 'reset_password')) {
+    startTimer();
+}
 }
 
 // Функция для проверки введенного кода
-function verifyCode() {
+async function verifyCode() {
 const code1 = document.getElementById('sms-code-1').value;
 const code2 = document.getElementById('sms-code-2').value;
 const code3 = document.getElementById('sms-code-3').value;
@@ -977,8 +1069,8 @@ if (fullCode.length !== 4) {
     return;
 }
 
-// Для демо используем "1234" как правильный код
-if (fullCode === "1234") {
+const contact = document.getElementById('recovery-contact').value.trim();
+if (await confirmVerificationCode(contact, 'reset_password', fullCode)) {
     // Показываем модалку ввода нового пароля (без prompt)
     const existing = document.getElementById('resetPasswordModal');
     if (existing) existing.remove();
@@ -1009,8 +1101,6 @@ if (fullCode === "1234") {
     `;
     document.body.insertAdjacentHTML('beforeend', modalHTML);
     showNotification('Код подтвержден, задайте новый пароль', 'success');
-} else {
-    showNotification('Неверный код подтверждения', 'error');
 }
 }
 
@@ -1190,10 +1280,11 @@ if (hasError) {
     return;
 }
 
-// Запрос кода (демо 1234)
-tempRegistrationData = { firstName, lastName, email, phone, password };
-showNotification('Код для регистрации: 1234', 'info');
-openConfirmRegisterCodeModal();
+// Запрос кода подтверждения на телефон
+tempRegistrationData = { firstName, lastName, email, phone: phone.trim(), password };
+if (await requestVerificationCode(tempRegistrationData.phone, 'register')) {
+    openConfirmRegisterCodeModal();
+}
 }
 
 // Функция для извлечения города из адреса
@@ -1219,44 +1310,45 @@ const city2 = extractCityFromAddress(address2);
 return calculateDistance(city1, city2);
 }
 
-// Функция расчета цены с учетом расстояния и страховки 1%
-function calculateOrderPrice(orderData, distance) {
-// Базовые тарифы
-const BASE_PRICE = 1000; // Базовая стоимость заказа
-const PRICE_PER_KM = 45; // Стоимость за километр
-const PRICE_PER_KG = 80; // Стоимость за килограмм
-const PRICE_PER_M3 = 100; // Стоимость за кубический метр
-
-// Коэффициенты для типов груза
-const cargoTypeMultiplier = {
-    'general': 1.0,
-    'fragile': 1.3,
-    'dangerous': 1.5,
-    'perishable': 1.4
-};
+// Действующий тариф с сервера (GET /api/tariffs); браузер кэширует ответ по ETag
+let currentTariff = null;
+
+async function loadTariff() {
+try {
+    const response = await fetch(`${API_BASE_URL}/tariffs`, { credentials: 'include' });
+    const data = await response.json();
+    if (data.success) {
+        currentTariff = data.tariff;
+    }
+} catch (error) {
+    console.error('Ошибка загрузки тарифа:', error);
+}
+return currentTariff;
+}
+
+// Функция расчета цены по тарифу сервера (тот же расчет, что calculate_price на сервере)
+function calculateOrderPrice(orderData, distance, tariff = currentTariff) {
+if (!tariff) return null;
 
 // Рассчитываем компоненты стоимости
-const distanceCost = distance * PRICE_PER_KM;
-const weightCost = orderData.cargoWeight * PRICE_PER_KG;
-const volumeCost = orderData.cargoVolume * PRICE_PER_M3;
+const distanceCost = distance * tariff.perKm;
+const weightCost = orderData.cargoWeight * tariff.perKg;
+const volumeCost = orderData.cargoVolume * tariff.perM3;
 
 // Рассчитываем стоимость доставки
-let deliveryCost = BASE_PRICE + distanceCost + weightCost + volumeCost;
+let deliveryCost = tariff.basePrice + distanceCost + weightCost + volumeCost;
 
 // Применяем коэффициент типа груза
-const multiplier = cargoTypeMultiplier[orderData.cargoType] || 1.0;
+const multiplier = tariff.cargoMultipliers[orderData.cargoType] || 1.0;
 deliveryCost *= multiplier;
 
-// Дополнительные услуги
+// Дополнительные услуги: страховка считается от стоимости доставки
 let additionalCost = 0;
-if (orderData.packaging) {
-    additionalCost += 2000; // Упаковка
-}
-
-// Страховка - 1% от стоимости доставки
 if (orderData.insurance) {
-    const insuranceCost = deliveryCost * 0.01;
-    additionalCost += insuranceCost;
+    additionalCost += deliveryCost * tariff.insuranceRate;
+}
+if (orderData.packaging) {
+    additionalCost += tariff.packagingPrice;
 }
 
 // Итоговая стоимость
@@ -1265,6 +1357,9 @@ const totalPrice = Math.round(deliveryCost + additionalCost);
 return totalPrice;
 }
 
+// Ключ идемпотентности текущей отправки заказа (сбрасывается после успеха)
+let pendingOrderKey = null;
+
 // Функция c проверкой валидации в "Заказать перевозку"
 async function handleOrderSubmit(event) {
 event.preventDefault();
@@ -1347,10 +1442,16 @@ try {
     // Расчет расстояния
     const distance = calculateDistanceBetweenAddresses(pickupAddress, deliveryAddress);
 
+    // Один ключ на отправку формы: повтор после сбоя сети не создаст второй заказ
+    if (!pendingOrderKey) {
+        pendingOrderKey = crypto.randomUUID();
+    }
+
     const response = await fetch(`${API_BASE_URL}/orders`, {
         method: 'POST',
         headers: {
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'Idempotency-Key': pendingOrderKey
         },
         credentials: 'include',
         body: JSON.stringify({
@@ -1372,11 +1473,18 @@ try {
     });
 
     const data = await response.json();
+    // Сервер ответил - следующая отправка формы это уже новый запрос
+    pendingOrderKey = null;
 
     if (data.success) {
         // Перезагружаем заказы
         await loadOrders();
 
+    // Если тариф сменился после загрузки страницы - обновляем локальную копию
+    if (!currentTariff || currentTariff.version !== data.order.tariffVersion) {
+        loadTariff();
+    }
+
     // Показываем уведомление с информацией о цене и расстоянии
     let notificationMessage = `Заказ успешно оформлен!`;
         notificationMessage += `<br>Расстояние: ${data.order.distance} км`;
@@ -1728,7 +1836,7 @@ async function loadDriversList() {
     if (!container) return;
 
     try {
-        const response = await fetch(`${API_BASE_URL}/admin/drivers`, {
+        const response = await fetch(`${API_BASE_URL}/admin/drivers?view=summary`, {
             credentials: 'include'
         });
         const data = await response.json();
@@ -1890,7 +1998,7 @@ async function assignDriverModal(orderId) {
 // Загружаем список водителей если не загружен
 if (drivers.length === 0) {
     try {
-        const response = await fetch(`${API_BASE_URL}/admin/drivers`, { credentials: 'include' });
+        const response = await fetch(`${API_BASE_URL}/admin/drivers?view=summary`, { credentials: 'include' });
         const data = await response.json();
         if (data.success) {
             drivers = (data.drivers || []).map(normalizeDriver);
@@ -2213,7 +2321,7 @@ try {
 const userOrders = orders.filter(order => order.userId === currentUser.id);
 
 // Обновляем статистику
-updateProfileOrderStats(userOrders);
+updateProfileOrderStats();
 
 // Показываем или скрываем таблицу
 if (userOrders.length > 0) {
@@ -2233,33 +2341,37 @@ if (userOrders.length > 0) {
 }
 }
 
+// Счетчики заказов по статусам, категориям и датам (считает сервер)
+async function loadOrderFacets() {
+    try {
+        const response = await fetch(`${API_BASE_URL}/orders/facets`, {
+            credentials: 'include'
+        });
+        const data = await response.json();
+        return data.success ? data : null;
+    } catch (error) {
+        console.error('Ошибка загрузки счетчиков заказов:', error);
+        return null;
+    }
+}
+
 // Функция обновления статистики заказов
-function updateProfileOrderStats(userOrders = null) {
+async function updateProfileOrderStats() {
 if (!currentUser) return;
 
-const ordersToCount = userOrders || orders.filter(order => order.userId === currentUser.id);
+const data = await loadOrderFacets();
+if (!data) return;
+const byStatus = data.facets.clientStatus;
 
 const totalEl = document.getElementById('profile-total-orders-count');
 const processingEl = document.getElementById('profile-processing-orders-count');
 const transitEl = document.getElementById('profile-in-transit-orders-count');
 const deliveredEl = document.getElementById('profile-delivered-orders-count');
 
-if (totalEl) totalEl.textContent = ordersToCount.length;
-if (processingEl) processingEl.textContent =
-    ordersToCount.filter(order => {
-        const cs = order.clientStatus || order.status;
-        return cs === 'processing' || cs === 'new';
-    }).length;
-if (transitEl) transitEl.textContent =
-    ordersToCount.filter(order => {
-        const cs = order.clientStatus || order.status;
-        return cs === 'in_transit';
-    }).length;
-if (deliveredEl) deliveredEl.textContent =
-    ordersToCount.filter(order => {
-        const cs = order.clientStatus || order.status;
-        return cs === 'delivered';
-    }).length;
+if (totalEl) totalEl.textContent = data.total;
+if (processingEl) processingEl.textContent = (byStatus.processing || 0) + (byStatus.new || 0);
+if (transitEl) transitEl.textContent = byStatus.in_transit || 0;
+if (deliveredEl) deliveredEl.textContent = byStatus.delivered || 0;
 }
 
 // Инициализация
@@ -2271,6 +2383,9 @@ if (shippingDate) {
     shippingDate.min = today;
 }
 
+// Тариф нужен для расчета цены до отправки заказа
+loadTariff();
+
 // Загружаем текущего пользователя из API
 currentUser = await loadCurrentUser();
 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение записи в БД: коммит в потоке запроса (WRITER_MODE='direct')
+и единый поток записи с групповыми коммитами (WRITER_MODE='queue').
+
+--storage memory выполняет те же операции над БД в памяти (только режим 'queue').
+
+Запуск: python bench_writes.py [--threads 16] [--ops 200] [--storage sqlite|memory]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import transportco_backend as backend
+
+
+def create_order_op(user_id):
+    """Операция, аналогичная вставке в create_order()"""
+    values = (None, user_id, 'Иван', '+79123456789', '', 'Груз', 'other', 10, 1, 'general', '',
+              'Москва', 'Тверь', 180, 5600, 0, 0, '', 'new', 'processing', 1, 1, None)
+    return lambda cursor: backend.OrderRepo.create(cursor, values)
+
+
+def update_status_op(order_id):
+    """Операция, аналогичная update_order_status()"""
+    return lambda cursor: backend.OrderRepo.set_status(cursor, order_id, 'in_transit')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(mode, threads, ops, storage):
+    directory = tempfile.mkdtemp()
+    backend.app.config['STORAGE_BACKEND'] = storage
+    backend.app.config['DATABASE'] = os.path.join(directory, f'bench-{mode}.db')
+    backend.app.config['WRITER_MODE'] = mode
+    backend.init_db()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        local, failed = [], []
+        for i in range(ops):
+            started = time.perf_counter()
+            try:
+                order_id = backend.run_write(create_order_op(1))
+                if i % 2:
+                    backend.run_write(update_status_op(order_id))
+            except sqlite3.OperationalError as e:
+                failed.append(str(e))
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors.extend(failed)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    print(f'{mode:>6}: {len(latencies) / elapsed:8.0f} req/s  '
+          f'p50 {percentile(latencies, 0.50) * 1000:7.2f} ms  '
+          f'p99 {percentile(latencies, 0.99) * 1000:7.2f} ms  '
+          f'max {max(latencies) * 1000:8.2f} ms  errors {len(errors)}')
+    if mode == 'queue':
+        print(f'        группы: {backend.get_writer().stats}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=200)
+    parser.add_argument('--storage', choices=('sqlite', 'memory'), default='sqlite')
+    args = parser.parse_args()
+    # Общий кэш БД в памяти не ждет блокировок, параллельные коммиты в потоках запросов падают
+    for mode in ('direct', 'queue') if args.storage == 'sqlite' else ('queue',):
+        run(mode, args.threads, args.ops, args.storage)
+    if backend.app.config['REPO_TIMING']:
+        for name, timing in backend._repo_timings.snapshot().items():
+            print(f'        {name:<22} {timing["calls"]:7d} вызовов  avg {timing["avgMs"]:.4f} ms')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Перераспределение заказов между шардами (ORDER_SHARDS) по хэшу user_id.
+
+Запускается при остановленном сервере: заказы копируются потоком во
+временные файлы новых шардов, количество строк сверяется, затем файлы
+подменяются. Прежние файлы шардов сохраняются с суффиксом .bak.
+--to 0 возвращает заказы в основную БД. Курсоры GET /api/orders/changes
+после перераспределения не подходят по числу частей, клиенты получают
+список заново.
+
+Запуск: python reshard_orders.py --from 0 --to 4 [--database transport_company.db]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+import transportco_backend as backend
+
+TEMP_SUFFIX = '.reshard'
+BACKUP_SUFFIX = '.bak'
+
+
+def configure(database, template, shards):
+    backend.app.config['DATABASE'] = database
+    backend.app.config['ORDER_SHARD_TEMPLATE'] = template
+    backend.app.config['ORDER_SHARDS'] = shards
+    return backend.order_databases()
+
+
+def close_wal(path):
+    """Перенести WAL в файл БД, чтобы файл можно было переименовать без -wal/-shm"""
+    if not os.path.exists(path):
+        return
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.close()
+
+
+def count_orders(path, table='orders'):
+    conn = sqlite3.connect(path)
+    count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    conn.close()
+    return count
+
+
+def copy_orders(sources, targets, batch, table='orders'):
+    """Потоково разложить строки table из sources по targets; вернуть (скопировано, максимальный id).
+
+    table - orders или order_events: обе раскладываются по user_id, поэтому
+    история заказа попадает в тот же шард, что и сам заказ.
+    """
+    outputs = [sqlite3.connect(path) for path in targets]
+    copied = 0
+    max_id = 0
+    for source in sources:
+        conn = sqlite3.connect(source)
+        cursor = conn.execute(f'SELECT * FROM {table} ORDER BY 1')
+        columns = [column[0] for column in cursor.description]
+        user_column = columns.index('user_id')
+        insert = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                  f"VALUES ({', '.join('?' for _ in columns)})")
+        buffers = [[] for _ in targets]
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for row in rows:
+                buffers[backend.shard_of(row[user_column], len(targets))].append(row)
+                max_id = max(max_id, row[0])
+            for output, buffer in zip(outputs, buffers):
+                if buffer:
+                    output.executemany(insert, buffer)
+                    copied += len(buffer)
+                    buffer.clear()
+        conn.close()
+    for output in outputs:
+        output.commit()
+        output.close()
+    return copied, max_id
+
+
+def set_id_sequence(database, max_id):
+    """Продолжить глобальную последовательность id после перенесенных заказов"""
+    conn = sqlite3.connect(database)
+    conn.execute('DELETE FROM order_id_sequence')
+    updated = conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'order_id_sequence'",
+                           (max_id,)).rowcount
+    if not updated:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('order_id_sequence', ?)", (max_id,))
+    conn.commit()
+    conn.close()
+
+
+def set_change_counters(targets):
+    """Продолжить последовательность изменений каждого файла после перенесенных заказов"""
+    for path in targets:
+        conn = sqlite3.connect(path)
+        conn.execute('''
+            UPDATE order_change_counter
+            SET seq = MAX(seq, (SELECT IFNULL(MAX(change_seq), 0) FROM orders))
+        ''')
+        conn.commit()
+        conn.close()
+
+
+def reshard(database, template, old_shards, new_shards, batch):
+    if old_shards == new_shards:
+        sys.exit('Число шардов не меняется')
+    sources = configure(database, template, old_shards)
+    backend.init_db()
+    expected = sum(count_orders(path) for path in sources)
+    expected_events = sum(count_orders(path, 'order_events') for path in sources)
+    if new_shards:
+        # Новые шарды создаются рядом под временными именами со схемой основной БД
+        targets = configure(database, template + TEMP_SUFFIX, new_shards)
+        for path in targets:
+            if os.path.exists(path):
+                os.remove(path)
+        backend.init_order_shards()
+    else:
+        targets = [database]
+    copied, max_id = copy_orders(sources, targets, batch)
+    copied_events, _ = copy_orders(sources, targets, batch, 'order_events')
+    set_change_counters(targets)
+    actual = sum(count_orders(path) for path in targets) if new_shards else copied
+    if copied != expected or actual != expected or copied_events != expected_events:
+        sys.exit(f'Количество заказов не совпало: было {expected}, скопировано {copied}, в шардах {actual}; '
+                 f'событий истории было {expected_events}, скопировано {copied_events}. '
+                 f'Исходные файлы не изменены.')
+    # Подмена: старые файлы шардов сохраняются как .bak, из основной БД заказы удаляются
+    for path in sources:
+        if path == database:
+            conn = sqlite3.connect(database)
+            conn.execute('DELETE FROM orders')
+            conn.execute('DELETE FROM order_events')
+            # Удаление выше записало заказы в order_removals, но они не исчезли, а переехали
+            conn.execute('DELETE FROM order_removals')
+            conn.commit()
+            conn.close()
+        else:
+            close_wal(path)
+            os.replace(path, path + BACKUP_SUFFIX)
+    finals = configure(database, template, new_shards)
+    if new_shards:
+        for temp, final in zip(targets, finals):
+            close_wal(temp)
+            os.replace(temp, final)
+    set_id_sequence(database, max_id)
+    print(f'Перенесено заказов: {copied}; шардов: {old_shards} -> {new_shards}; '
+          f'последний id: {max_id}')
+    for path in finals:
+        print(f'  {path}: {count_orders(path)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=backend.app.config['DATABASE'])
+    parser.add_argument('--template', default=backend.app.config['ORDER_SHARD_TEMPLATE'],
+                        help='Шаблон имени файла шарда с {} для номера')
+    parser.add_argument('--from', dest='old_shards', type=int, required=True,
+                        help='Текущее значение ORDER_SHARDS')
+    parser.add_argument('--to', dest='new_shards', type=int, required=True,
+                        help='Новое значение ORDER_SHARDS')
+    parser.add_argument('--batch', type=int, default=5000)
+    args = parser.parse_args()
+    reshard(args.database, args.template, args.old_shards, args.new_shards, args.batch)
@@ -3,20 +3,152 @@
 """
 TransportCo - Транспортная компания: backend на Flask с SQLite и полной Swagger документацией
 """
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, request, jsonify, session, send_from_directory, g, has_request_context
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from pathlib import Path
+from types import MappingProxyType
+from urllib.parse import quote
 import sqlite3
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
 import os
+import queue
+import random
+import re
+import secrets
+import struct
 import sys
+import threading
+import time
+import weakref
+import zlib
 from functools import wraps
 from flasgger import Swagger, swag_from
 
+try:
+    import numpy as np
+except ImportError:  # без NumPy недоступна только аналитика (POST /api/admin/analytics/query)
+    np = None
+
 # === Flask приложение ===
 app = Flask(__name__)
 app.secret_key = 'transportco-secret-key-change-in-production'
 app.config['DATABASE'] = 'transport_company.db'
+# Архив завершенных заказов (подключается через ATTACH как схема archive)
+app.config['ARCHIVE_DATABASE'] = 'transport_company_archive.db'
+app.config['ARCHIVE_AFTER_DAYS'] = 90
+app.config['ARCHIVE_BATCH_SIZE'] = 500
+app.config['ARCHIVE_VACUUM_PAGES'] = 2000
+# Шардирование заказов по хэшу user_id: 0 - заказы в основной БД,
+# N > 0 - в N отдельных файлах (пользователи и справочники остаются в основной БД)
+app.config['ORDER_SHARDS'] = 0
+app.config['ORDER_SHARD_TEMPLATE'] = 'transport_company_orders_{}.db'
+# Запись в БД: 'queue' - единый поток записи с групповыми коммитами,
+# 'direct' - коммит в потоке запроса (прежнее поведение)
+app.config['WRITER_MODE'] = 'queue'
+app.config['WRITER_MAX_BATCH'] = 64
+app.config['WRITER_MAX_DELAY'] = 0.002  # сек ожидания операций для пополнения группы
+# Ожидание результата записи, сек. Операция, не начатая за это время,
+# отменяется (ответ 503, повтор безопасен); начатая ждет еще столько же,
+# затем ответ 202 - результат неизвестен (WriteTimeout)
+app.config['WRITER_TIMEOUT'] = 30
+app.config['WRITER_RETRY_AFTER'] = 5  # сек, заголовок Retry-After ответов 503/202
+# Пул соединений только для чтения и пороги проверки здоровья
+app.config['READ_POOL_SIZE'] = 8
+# Хранилище: 'sqlite' - файлы на диске, 'memory' - те же схемы и запросы в
+# разделяемой памяти процесса (бенчмарки и тесты, только WRITER_MODE='queue').
+# В режиме memory чтение "грязное" (read_uncommitted, см. connect_db): читатели
+# видят незафиксированную группу потока записи, в том числе операции, которые
+# потом откатятся (WriteRejected, ошибка COMMIT). Для боевой работы не годится
+app.config['STORAGE_BACKEND'] = 'sqlite'
+# Кэш подготовленных выражений на соединение и замер времени методов репозиториев
+app.config['STATEMENT_CACHE_SIZE'] = 256
+app.config['REPO_TIMING'] = True
+app.config['HEALTH_WAL_LAG_WARN'] = 10000  # кадров WAL, еще не перенесенных в БД
+app.config['HEALTH_SNAPSHOT_AGE_WARN'] = 60  # сек удержания снимка чтения
+# Ограничение частоты для маршрутов с дорогим хэшированием пароля:
+# маршрут -> {область: (максимум запросов, окно в секундах)}
+app.config['RATE_LIMITS'] = {
+    'login': {'ip': (30, 60), 'login': (10, 300)},
+    'register': {'ip': (10, 3600)},
+    'reset_password': {'ip': (10, 3600), 'login': (5, 3600)},
+    'verification_issue': {'ip': (20, 3600), 'login': (5, 3600)},
+    'verification_verify': {'ip': (60, 600), 'login': (10, 600)},
+}
+app.config['RATE_LIMIT_MAX_KEYS'] = 100000
+# Коды подтверждения (регистрация, восстановление пароля)
+app.config['VERIFICATION_REQUIRED'] = True
+app.config['VERIFICATION_CODE_LENGTH'] = 4
+app.config['VERIFICATION_CODE_TTL'] = 300  # сек жизни кода
+app.config['VERIFICATION_RESEND_AFTER'] = 60  # сек до повторной отправки
+app.config['VERIFICATION_MAX_ATTEMPTS'] = 5
+app.config['VERIFICATION_VERIFIED_TTL'] = 600  # сек, в течение которых подтверждение действует
+app.config['VERIFICATION_PURGE_INTERVAL'] = 600
+# Шлюза SMS/email нет: в демо-режиме (запуск этого файла с debug) код регистрации
+# возвращается в ответе. Код восстановления пароля не возвращается никогда -
+# иначе любой клиент сменит пароль чужой учетной записи
+app.config['VERIFICATION_EXPOSE_CODE'] = False
+# Фоновое обслуживание БД: задача -> интервал в секундах
+app.config['MAINTENANCE_ENABLED'] = True
+app.config['MAINTENANCE_INTERVALS'] = {
+    'checkpoint': 300,
+    'optimize': 3600,
+    'vacuum': 3600,
+    'verification_purge': 600,
+    'archive': 86400,
+    'gps_retention': 86400,
+    'idempotency_purge': 3600,
+    'change_log_compaction': 3600,
+    'driver_rollup': 300,
+    'driver_rollup_rebuild': 86400,
+}
+app.config['MAINTENANCE_TICK'] = 30  # сек между проверками расписания
+app.config['MAINTENANCE_LEASE_TTL'] = 90  # сек аренды роли исполнителя среди процессов
+app.config['MAINTENANCE_BUSY_LATENCY'] = 0.25  # сек среднего ответа, выше - задачи откладываются
+app.config['MAINTENANCE_BUSY_QUEUE'] = 100  # операций в очереди записи, выше - задачи откладываются
+app.config['MAINTENANCE_MAX_DEFER'] = 4  # после стольких интервалов задача выполняется несмотря на нагрузку
+# GPS-трекинг: точки хранятся в таблицах по дням (gps_points_ГГГГММДД)
+app.config['GPS_MAX_BATCH'] = 500
+app.config['GPS_RETENTION_DAYS'] = 30
+app.config['GPS_MAX_FUTURE_SKEW'] = 300  # сек, на которые часы телефона могут спешить
+# Маршрут водителя: бюджет времени на оптимизацию и размер кэша
+app.config['ROUTE_TIME_BUDGET'] = 0.05  # сек
+app.config['ROUTE_CACHE_SIZE'] = 1000
+app.config['ADDRESS_CACHE_SIZE'] = 10000  # адресов с уже определенным городом
+# Тарифы: как часто процесс проверяет, не опубликована ли новая версия
+app.config['TARIFF_REFRESH_INTERVAL'] = 30  # сек
+app.config['TARIFF_CACHE_MAX_AGE'] = 300  # сек кэширования GET /api/tariffs
+# Idempotency-Key: сколько хранится ответ и сколько ключей держать в памяти
+app.config['IDEMPOTENCY_TTL'] = 86400  # сек
+app.config['IDEMPOTENCY_CACHE_SIZE'] = 10000
+# Журнал изменений: события старше срока удаляются, даже если не подтверждены
+app.config['CHANGE_LOG_MAX_AGE'] = 7 * 86400
+# Показатели водителей: события моложе DRIVER_ROLLUP_LAG сек ждут следующего
+# прохода (запись могла еще не завершиться), ночной пересчет охватывает
+# DRIVER_ROLLUP_REBUILD_DAYS дней - меньше ARCHIVE_AFTER_DAYS, заказы еще не в архиве
+app.config['DRIVER_ROLLUP_LAG'] = 60
+app.config['DRIVER_ROLLUP_REBUILD_DAYS'] = 35
+app.config['ON_TIME_KM_PER_DAY'] = 500  # км в день пути, которые дает срок доставки
+app.config['ANALYTICS_REFRESH_INTERVAL'] = 30  # сек, после которых куб аналитики дочитывает изменения
+# Трассировка запросов: доля запросов, кольцо трасс в памяти, интервалов на трассу
+app.config['TRACE_SAMPLE_RATE'] = 0.01
+app.config['TRACE_BUFFER_SIZE'] = 200
+app.config['TRACE_MAX_SPANS'] = 5000
+# Значение X-Trace, по которому трассируется запрос любого клиента (нагрузочные
+# тесты, мониторинг). None - заголовок X-Trace: 1 учитывается только у администратора
+app.config['TRACE_SECRET'] = None
+# Кэш ответов списков администратора
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = 512
+app.config['RESPONSE_CACHE_MAX_BYTES'] = 16 * 1024 * 1024
 
 # Настройка Flasgger
 swagger_template = {
@@ -55,24 +187,1442 @@ swagger = Swagger(app, template=swagger_template)
 # Включаем CORS для работы с фронтендом
 CORS(app, supports_credentials=True)
 
+# === ТРАССИРОВКА ЗАПРОСОВ ===
+# Трасса - вложенные интервалы (span) одного запроса: проверка роли, методы
+# репозиториев, каждое SQL-выражение, хэширование пароля, расчет цены и
+# сериализация ответа. Операции записи и запросы к шардам выполняются в
+# других потоках и попадают в трассу своего запроса отдельными дорожками.
+# Сохраняется доля TRACE_SAMPLE_RATE запросов и запросы с заголовком X-Trace
+# (trace_requested); последние TRACE_BUFFER_SIZE трасс лежат в памяти процесса.
+# Трасса хранится под id, выданным сервером (X-Trace-Id ответа): X-Request-Id
+# задает клиент, и по нему чужие трассы можно было бы вытеснить или подменить.
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+_trace_local = threading.local()
+
+class RequestTrace:
+    """Интервалы одного запроса: (имя, категория, начало, конец, поток, аргументы)"""
+    def __init__(self, trace_id, request_id, name):
+        self.trace_id = trace_id
+        self.request_id = request_id
+        self.name = name
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.status = None
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, category, started, finished, args=None):
+        # list.append атомарен: интервалы добавляют поток запроса, записи и шардов
+        if len(self.spans) >= app.config['TRACE_MAX_SPANS']:
+            self.dropped += 1
+            return
+        self.spans.append((name, category, started, finished, threading.get_ident(), args))
+
+    def wrap(self, func, name, category='db'):
+        """Функция для другого потока, чьи интервалы записываются в эту трассу"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with bind_trace(self), trace_span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+
+    @property
+    def duration(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def summary(self):
+        return {
+            'traceId': self.trace_id,
+            'requestId': self.request_id,
+            'name': self.name,
+            'status': self.status,
+            'startedAt': datetime.fromtimestamp(self.wall).isoformat(sep=' ', timespec='milliseconds'),
+            'durationMs': round(self.duration * 1000, 3),
+            'spans': len(self.spans),
+            'dropped': self.dropped,
+        }
+
+    def chrome_events(self, pid):
+        """События формата Chrome trace (chrome://tracing, Perfetto): процесс pid - эта трасса"""
+        def micros(moment):
+            return round((self.wall + moment - self.started) * 1e6, 1)
+
+        threads = {span[4] for span in self.spans}
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        events = [{'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0,
+                   'args': {'name': f'{self.name} [{self.request_id}] {self.status}'}}]
+        events += [{'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                    'args': {'name': names.get(tid, str(tid))}} for tid in sorted(threads)]
+        for name, category, started, finished, tid, args in self.spans:
+            event = {'ph': 'X', 'name': name, 'cat': category, 'pid': pid, 'tid': tid,
+                     'ts': micros(started), 'dur': round((finished - started) * 1e6, 1)}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return events
+
+class TraceBuffer:
+    """Кольцо последних трасс процесса"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()  # trace_id -> RequestTrace
+
+    def add(self, trace):
+        with self.lock:
+            self.traces[trace.trace_id] = trace
+            while len(self.traces) > app.config['TRACE_BUFFER_SIZE']:
+                self.traces.popitem(last=False)
+
+    def select(self, trace_ids=None, min_ms=0.0, path=None, limit=None):
+        """Трассы от новых к старым: по id или по длительности и части имени"""
+        with self.lock:
+            traces = list(reversed(self.traces.values()))
+        if trace_ids:
+            return [trace for trace in traces if trace.trace_id in trace_ids]
+        selected = [trace for trace in traces
+                    if trace.duration * 1000 >= min_ms and (not path or path in trace.name)]
+        return selected[:limit] if limit else selected
+
+_traces = TraceBuffer()
+
+def current_trace():
+    return getattr(_trace_local, 'trace', None)
+
+@contextmanager
+def bind_trace(trace):
+    """Записывать интервалы текущего потока в trace (None - не записывать)"""
+    previous = getattr(_trace_local, 'trace', None)
+    _trace_local.trace = trace
+    try:
+        yield
+    finally:
+        _trace_local.trace = previous
+
+@contextmanager
+def trace_span(name, category='app', **args):
+    """Интервал в трассе текущего запроса; без трассы ничего не делает"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, category, started, time.perf_counter(), args or None)
+
+def traced(name, category='app'):
+    """Декоратор: вызов функции - интервал name в трассе запроса"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(name, category, started, time.perf_counter())
+        return wrapper
+    return decorator
+
+# Хэширование паролей и сериализация ответов видны в трассе под своими именами
+generate_password_hash = traced('password.hash', 'crypto')(generate_password_hash)
+check_password_hash = traced('password.check', 'crypto')(check_password_hash)
+jsonify = traced('serialize')(jsonify)
+
+def sql_span_args(sql):
+    return {'sql': ' '.join(sql.split())[:500]}
+
+def sql_span_name(sql):
+    return (sql.split(None, 1) or ['SQL'])[0].upper()
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, записывающий каждое выражение в трассу запроса (время до первой строки)"""
+    def execute(self, sql, parameters=()):
+        trace = current_trace()
+        if trace is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            trace.add(sql_span_name(sql), 'sql', started, time.perf_counter(), sql_span_args(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        trace = current_trace()
+        if trace is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            trace.add(sql_span_name(sql), 'sql', started, time.perf_counter(),
+                      {**sql_span_args(sql), 'rows': self.rowcount})
+
+class TracedConnection(sqlite3.Connection):
+    """Соединение, чьи курсоры и execute() пишут SQL-выражения в трассу"""
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
 # === УТИЛИТЫ БД ===
-def get_db():
-    """Получить подключение к БД"""
-    conn = sqlite3.connect(app.config['DATABASE'])
+# Соединения, удерживающие БД в памяти (STORAGE_BACKEND='memory'): путь -> соединение
+_memory_databases = {}
+_memory_lock = threading.Lock()
+
+def database_uri(database, readonly=False):
+    """URI файла БД; в режиме memory - разделяемая БД в памяти с тем же именем"""
+    if app.config['STORAGE_BACKEND'] == 'memory':
+        uri = f"file:{quote(os.path.abspath(database))}?mode=memory&cache=shared"
+        with _memory_lock:
+            if database not in _memory_databases:
+                # БД в памяти живет, пока открыто хотя бы одно соединение
+                _memory_databases[database] = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        return uri
+    uri = Path(database).resolve().as_uri()
+    return uri + '?mode=ro' if readonly else uri
+
+def database_exists(database):
+    """Создана ли уже БД (файл на диске или БД в памяти)"""
+    if app.config['STORAGE_BACKEND'] == 'memory':
+        return database in _memory_databases
+    return os.path.exists(database)
+
+def connect_db(database, readonly=False, **kwargs):
+    """Открыть соединение с БД с общим кэшем подготовленных выражений"""
+    kwargs.setdefault('factory', TracedConnection)
+    conn = sqlite3.connect(database_uri(database, readonly), uri=True,
+                           cached_statements=app.config['STATEMENT_CACHE_SIZE'], **kwargs)
+    if readonly and app.config['STORAGE_BACKEND'] == 'memory':
+        # mode=ro несовместим с mode=memory; read_uncommitted снимает табличные
+        # блокировки общего кэша между читателями и потоком записи. Цена -
+        # грязное чтение: WAL и снимков у общего кэша нет, поэтому без этой
+        # прагмы читатель получал бы SQLITE_LOCKED на все время группы записи.
+        # Проверки, которым нужны зафиксированные данные, выполняются внутри
+        # операции записи (run_write), а не по результатам такого чтения
+        conn.execute('PRAGMA query_only = 1')
+        conn.execute('PRAGMA read_uncommitted = 1')
+    return conn
+
+def attach_database(conn, database, alias):
+    """ATTACH файла (или БД в памяти) к соединению под именем alias"""
+    conn.execute(f'ATTACH DATABASE ? AS {alias}', (database_uri(database),))
+
+def get_db(database=None):
+    """Получить подключение к БД (по умолчанию - основной)"""
+    conn = connect_db(database or app.config['DATABASE'])
     conn.row_factory = sqlite3.Row
     return conn
 
+# === ОЧЕРЕДЬ ЗАПИСИ (один поток записи, групповые коммиты) ===
+class WriteRejected(Exception):
+    """Операция записи отклонена проверкой внутри транзакции"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+class WriteTimeout(WriteRejected):
+    """Поток записи не выполнил операцию за WRITER_TIMEOUT.
+
+    started=False - операция отменена до начала и не будет записана, запрос
+    можно повторить (503). started=True - операция уже выполняется и может
+    зафиксироваться позже: повтор без проверки создаст дубль (202); future
+    позволяет узнать ее итог.
+    """
+    def __init__(self, started, future=None):
+        if started:
+            super().__init__('Запрос принят и еще выполняется: проверьте результат, прежде чем повторять', 202)
+        else:
+            super().__init__('Сервер перегружен, запрос не выполнен: повторите позже', 503)
+        self.started = started
+        self.future = future
+
+class DatabaseWriter:
+    """Единственный поток записи в SQLite.
+
+    Операции - функции operation(cursor) - берутся из очереди и выполняются
+    группами в одной транзакции: группа закрывается по размеру (max_batch)
+    или по времени (max_delay). Каждая операция изолирована SAVEPOINT'ом,
+    поэтому ошибка одной не откатывает остальные. Результат возвращается
+    через Future только после COMMIT всей группы. Операция, Future которой
+    отменен до ее начала (run_write по таймауту), пропускается.
+
+    Исключительная операция (exclusive=True) - функция operation(conn) -
+    выполняется отдельно между группами на том же соединении вне транзакции
+    и сама управляет транзакциями: так проходят записи, которым нужен ATTACH
+    (архивация), без второго пишущего соединения к файлу.
+    """
+    def __init__(self, database, max_batch, max_delay):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        # Исключительная операция, встреченная при сборе группы: выполняется следующей
+        self.pending = None
+        self.stats = {'operations': 0, 'failed': 0, 'cancelled': 0, 'commits': 0, 'maxGroup': 0}
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, operation, exclusive=False):
+        """Поставить операцию в очередь, вернуть Future с ее результатом"""
+        future = Future()
+        self.queue.put((operation, future, exclusive))
+        return future
+
+    def stop(self):
+        """Дописать очередь и остановить поток"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self, first):
+        """Собрать группу операций начиная с first; второй элемент - признак остановки"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            if item[2]:
+                self.pending = item
+                break
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        conn = connect_db(self.database, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        stopping = False
+        while not stopping:
+            item, self.pending = self.pending or self.queue.get(), None
+            if item is None:
+                break
+            if item[2]:
+                self._run_exclusive(conn, item)
+                continue
+            batch, stopping = self._collect(item)
+            self._commit_group(conn, batch)
+        conn.close()
+
+    def _run_exclusive(self, conn, item):
+        operation, future, _ = item
+        if not future.set_running_or_notify_cancel():
+            self.stats['cancelled'] += 1
+            return
+        try:
+            result = operation(conn)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self.stats['failed'] += 1
+            future.set_exception(e)
+            return
+        if conn.in_transaction:
+            conn.execute('COMMIT')
+        self.stats['operations'] += 1
+        future.set_result(result)
+
+    def _commit_group(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            for operation, future, _ in batch:
+                if not future.set_running_or_notify_cancel():
+                    self.stats['cancelled'] += 1
+                    continue
+                conn.execute('SAVEPOINT op')
+                try:
+                    outcomes.append((future, operation(cursor), None))
+                    conn.execute('RELEASE op')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO op')
+                    conn.execute('RELEASE op')
+                    outcomes.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"[ERROR] DatabaseWriter: {e}", file=sys.stderr)
+            for _, future, _ in batch:
+                # Отмененные пропускаются; еще не начатые получают ошибку группы
+                if future.running() or future.set_running_or_notify_cancel():
+                    self.stats['failed'] += 1
+                    future.set_exception(e)
+            return
+        self.stats['operations'] += len(outcomes)
+        self.stats['commits'] += 1
+        self.stats['maxGroup'] = max(self.stats['maxGroup'], len(outcomes))
+        for future, result, error in outcomes:
+            if error is not None:
+                self.stats['failed'] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+# Поток записи на каждый файл БД (основная и шарды заказов)
+_writers = {}
+_writer_lock = threading.Lock()
+
+def get_writer(database=None):
+    """Поток записи текущего процесса для БД (создается лениво, в том числе после fork)"""
+    database = database or app.config['DATABASE']
+    with _writer_lock:
+        writer = _writers.get(database)
+        if writer is None or writer.pid != os.getpid():
+            writer = _writers[database] = DatabaseWriter(database,
+                                                         app.config['WRITER_MAX_BATCH'],
+                                                         app.config['WRITER_MAX_DELAY'])
+        return writer
+
+def run_write(operation, database=None):
+    """Выполнить операцию записи operation(cursor) и вернуть ее результат.
+
+    Операция не должна сама вызывать commit. Проверки, которые должны быть
+    атомарны с записью, выполняются внутри операции и сообщают об отказе
+    через WriteRejected. database - файл БД, по умолчанию основной.
+    Если поток записи не успел за WRITER_TIMEOUT, бросается WriteTimeout
+    (см. wait_write): повтор безопасен, только если операция была отменена.
+    """
+    trace = current_trace()
+    if trace is not None:
+        operation = trace.wrap(operation, 'write')
+    if app.config['WRITER_MODE'] == 'direct':
+        conn = get_db(database)
+        try:
+            result = operation(conn.cursor())
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+    with trace_span('write.wait', 'db'):
+        return wait_write(get_writer(database).submit(operation))
+
+def wait_write(future):
+    """Результат операции из очереди записи с ограничением ожидания.
+
+    Не начатая за WRITER_TIMEOUT операция отменяется: поток записи ее
+    пропустит. Начатая уже в транзакции группы - ее ждем еще WRITER_TIMEOUT,
+    потом сдаемся, не зная, зафиксируется ли она. В обоих случаях
+    бросается WriteTimeout; в запросе он же задает ответ (apply_write_timeout).
+    """
+    timeout = app.config['WRITER_TIMEOUT']
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        started = not future.cancel()
+    if started:
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            pass
+    error = WriteTimeout(started, future)
+    if has_request_context():
+        g.write_timeout = error
+    raise error
+
+def run_exclusive(operation, database=None):
+    """Выполнить operation(conn) в потоке записи между группами и вернуть результат.
+
+    Операция получает пишущее соединение вне транзакции и сама открывает и
+    фиксирует транзакции (BEGIN IMMEDIATE ... commit); незафиксированное
+    откатывается. Нужна для записи, которую нельзя выполнить внутри общей
+    транзакции группы, например с ATTACH. Подключенные БД операция
+    отключает сама: иначе они блокировались бы каждой следующей группой.
+    """
+    trace = current_trace()
+    if trace is not None:
+        operation = trace.wrap(operation, 'write')
+    if app.config['WRITER_MODE'] == 'direct':
+        conn = get_db(database)
+        try:
+            return operation(conn)
+        finally:
+            conn.close()
+    with trace_span('write.wait', 'db'):
+        return wait_write(get_writer(database).submit(operation, exclusive=True))
+
+# === ПУЛ СОЕДИНЕНИЙ ДЛЯ ЧТЕНИЯ ===
+class PooledConnection(TracedConnection):
+    """Соединение пула: close() возвращает его в пул вместо закрытия"""
+    pool = None
+
+    def close(self):
+        if self.pool is not None and self.pool.release(self):
+            return
+        super().close()
+
+class ReadPool:
+    """Пул соединений к БД, открытых только на чтение (mode=ro).
+
+    В режиме WAL читатели не блокируют поток записи и не блокируются им.
+    Выданные соединения учитываются в leased: соединение, которое не
+    вернули (исключение до close()), возвращается по окончании запроса
+    (release_read_connections), а потерянное совсем - сборщиком мусора
+    или завершением потока-владельца - заменяется новым.
+    """
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self.pid = os.getpid()
+        # LIFO: чаще используются соединения с "теплым" кэшем страниц
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        # id соединения -> (weakref на соединение, поток-владелец)
+        self.leased = {}
+        self.replaced = 0
+        # id соединения -> время начала закрепленного снимка
+        self.snapshots = {}
+
+    def acquire(self):
+        """Взять свободное соединение; при исчерпании пула - ждать освобождения"""
+        conn = self._take()
+        self.leased[id(conn)] = (weakref.ref(conn), threading.current_thread())
+        if has_request_context():
+            g.setdefault('read_connections', []).append(conn)
+        return conn
+
+    def _take(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        for attempt in range(2):
+            with self.lock:
+                if self.created < self.size:
+                    self.created += 1
+                    return self._connect()
+            if attempt == 0:
+                self._reclaim()
+        return self.idle.get(timeout=app.config['WRITER_TIMEOUT'])
+
+    def _reclaim(self):
+        """Заменить соединения, чьи потоки-владельцы завершились, не вернув их"""
+        with self.lock:
+            lost = [key for key, (_, owner) in self.leased.items() if not owner.is_alive()]
+            for key in lost:
+                ref, _ = self.leased.pop(key)
+                self.created -= 1
+                self.replaced += 1
+                conn = ref()
+                if conn is not None:
+                    conn.pool = None
+                    conn.close()
+
+    def _lost(self, key):
+        """Соединение удалено сборщиком мусора, не вернувшись в пул"""
+        with self.lock:
+            if self.leased.pop(key, None) is not None:
+                self.created -= 1
+                self.replaced += 1
+
+    def release(self, conn):
+        """Вернуть соединение в пул (False - соединение нужно просто закрыть)"""
+        if os.getpid() != self.pid:
+            return False
+        with self.lock:
+            if self.leased.pop(id(conn), None) is None:
+                # Уже возвращено (повторный close) или заменено
+                return True
+        if conn.in_transaction:
+            conn.rollback()
+        self.snapshots.pop(id(conn), None)
+        self.idle.put(conn)
+        return True
+
+    def _connect(self):
+        conn = connect_db(self.database, readonly=True, timeout=30,
+                          check_same_thread=False, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        conn.pool = self
+        weakref.finalize(conn, self._lost, id(conn))
+        return conn
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'size': self.size,
+            'open': self.created,
+            'idle': self.idle.qsize(),
+            'leased': len(self.leased),
+            'replaced': self.replaced,
+            'pinnedSnapshots': len(self.snapshots),
+            'oldestSnapshotAge': round(max((now - t for t in self.snapshots.values()), default=0), 3)
+        }
+
+# Пул чтения на каждый файл БД
+_read_pools = {}
+_read_pool_lock = threading.Lock()
+
+def get_read_pool(database=None):
+    """Пул чтения текущего процесса для БД (создается лениво, в том числе после fork)"""
+    database = database or app.config['DATABASE']
+    with _read_pool_lock:
+        pool = _read_pools.get(database)
+        if pool is None or pool.pid != os.getpid():
+            pool = _read_pools[database] = ReadPool(database, app.config['READ_POOL_SIZE'])
+        return pool
+
+def get_read_db(database=None):
+    """Получить соединение только для чтения; close() возвращает его в пул"""
+    return get_read_pool(database).acquire()
+
+@contextmanager
+def read_snapshot(with_archive=False):
+    """Закрепленная транзакция чтения для отчетов.
+
+    Все запросы внутри блока видят один и тот же снимок БД, даже если
+    поток записи тем временем фиксирует новые изменения.
+    """
+    conn = get_read_db()
+    try:
+        if with_archive:
+            # ATTACH невозможен внутри транзакции
+            attach_archive(conn)
+        conn.execute('BEGIN')
+        # В WAL снимок фиксируется первым чтением
+        conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        conn.pool.snapshots[id(conn)] = time.monotonic()
+        yield conn
+    finally:
+        conn.close()
+
+# === РЕПОЗИТОРИИ ===
+# Канонические тексты запросов: один и тот же SQL из любого обработчика
+# попадает в кэш подготовленных выражений соединения (STATEMENT_CACHE_SIZE).
+# Методы принимают соединение чтения или курсор потока записи; методы
+# записи сбрасывают теги кэша ответов своей таблицы (bump_cache_tags).
+class RepoTimings:
+    """Число вызовов и время методов репозиториев"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}  # имя -> [вызовы, суммарное время, максимум]
+
+    def record(self, name, elapsed):
+        with self.lock:
+            entry = self.methods.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            result = {
+                name: {
+                    'calls': calls,
+                    'totalMs': round(total * 1000, 3),
+                    'avgMs': round(total / calls * 1000, 4),
+                    'maxMs': round(peak * 1000, 3)
+                }
+                for name, (calls, total, peak) in sorted(self.methods.items())
+            }
+            if reset:
+                self.methods.clear()
+        return result
+
+_repo_timings = RepoTimings()
+
+def timed_method(name, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = current_trace()
+        if not app.config['REPO_TIMING'] and trace is None:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            finished = time.perf_counter()
+            if app.config['REPO_TIMING']:
+                _repo_timings.record(name, finished - started)
+            if trace is not None:
+                trace.add(name, 'repo', started, finished)
+    return wrapper
+
+def repository(cls):
+    """Декоратор класса: замер времени всех публичных методов"""
+    for name, member in list(vars(cls).items()):
+        if isinstance(member, staticmethod) and not name.startswith('_'):
+            setattr(cls, name, staticmethod(timed_method(f'{cls.__name__}.{name}', member.__func__)))
+    return cls
+
+@repository
+class UserRepo:
+    """Пользователи и их роли"""
+    COLUMNS = 'id, email, phone, first_name, last_name, verified, is_admin, is_driver'
+    ROLE = 'SELECT is_admin, is_driver FROM users WHERE id = ?'
+    BY_ID = f'SELECT {COLUMNS} FROM users WHERE id = ?'
+    BY_CONTACT = f'SELECT {COLUMNS}, password FROM users WHERE email = ? OR phone = ?'
+    PASSWORD = 'SELECT password FROM users WHERE id = ?'
+    CONTACT_TAKEN = 'SELECT id FROM users WHERE (email = ? OR phone = ?) AND id != ?'
+    INSERT = '''
+        INSERT INTO users (email, phone, password, first_name, last_name, verified)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    UPDATE_PROFILE = 'UPDATE users SET first_name = ?, last_name = ?, email = ?, phone = ? WHERE id = ?'
+    SET_PASSWORD = 'UPDATE users SET password = ? WHERE id = ?'
+    SET_DRIVER = 'UPDATE users SET is_driver = ? WHERE id = ?'
+
+    @staticmethod
+    def role(conn, user_id):
+        """Строка (is_admin, is_driver) или None"""
+        return conn.execute(UserRepo.ROLE, (user_id,)).fetchone()
+
+    @staticmethod
+    def is_admin(conn, user_id):
+        role = UserRepo.role(conn, user_id)
+        return bool(role and role['is_admin'])
+
+    @staticmethod
+    def is_driver(conn, user_id):
+        role = UserRepo.role(conn, user_id)
+        return bool(role and role['is_driver'])
+
+    @staticmethod
+    def get(conn, user_id):
+        return conn.execute(UserRepo.BY_ID, (user_id,)).fetchone()
+
+    @staticmethod
+    def find_by_contact(conn, contact):
+        """Пользователь по email или телефону (вместе с хэшем пароля)"""
+        return conn.execute(UserRepo.BY_CONTACT, (contact, contact)).fetchone()
+
+    @staticmethod
+    def password_hash(conn, user_id):
+        row = conn.execute(UserRepo.PASSWORD, (user_id,)).fetchone()
+        return row['password'] if row else None
+
+    @staticmethod
+    def contact_taken(conn, email, phone, exclude_id=0):
+        """Заняты ли email или телефон другим пользователем"""
+        return conn.execute(UserRepo.CONTACT_TAKEN, (email, phone, exclude_id)).fetchone() is not None
+
+    @staticmethod
+    def create(cursor, email, phone, password_hash, first_name, last_name):
+        cursor.execute(UserRepo.INSERT, (email, phone, password_hash, first_name, last_name, 1))
+        return cursor.lastrowid
+
+    @staticmethod
+    def update_profile(cursor, user_id, first_name, last_name, email, phone):
+        cursor.execute(UserRepo.UPDATE_PROFILE, (first_name, last_name, email, phone, user_id))
+        bump_cache_tags(cursor, 'users')
+
+    @staticmethod
+    def set_password(cursor, user_id, password_hash):
+        cursor.execute(UserRepo.SET_PASSWORD, (password_hash, user_id))
+
+    @staticmethod
+    def set_driver(cursor, user_ids, is_driver):
+        """Выдать или снять роль водителя сразу списку пользователей"""
+        cursor.executemany(UserRepo.SET_DRIVER, [(1 if is_driver else 0, user_id) for user_id in user_ids])
+        bump_cache_tags(cursor, 'users')
+
+@repository
+class DriverRepo:
+    """Карточки водителей"""
+    EXISTS = 'SELECT id FROM drivers WHERE user_id = ?'
+    PRESENT = 'SELECT user_id AS id FROM drivers WHERE user_id IN ({marks})'
+    INSERT = '''
+        INSERT INTO drivers (
+            user_id, license_number, experience, car_model, car_number,
+            max_weight, car_type, status, work_status, hire_date
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    DELETE = 'DELETE FROM drivers WHERE user_id = ?'
+    RESTORE = '''
+        UPDATE drivers
+        SET status = 'active',
+            inactive_since = NULL,
+            inactive_reason = NULL,
+            dismissal_reason = NULL,
+            dismissed_by = NULL
+        WHERE user_id = ?
+    '''
+    CREDIT_DELIVERY = 'UPDATE drivers SET completed_deliveries = completed_deliveries + 1 WHERE user_id = ?'
+    SET_WORK_STATUS = 'UPDATE drivers SET work_status = ? WHERE user_id = ?'
+    ACTIVE_FLEET = '''
+        SELECT user_id, car_type, max_weight FROM drivers
+        WHERE status = 'active' AND work_status = 'active' AND max_weight > 0
+    '''
+
+    @staticmethod
+    def exists(conn, user_id):
+        return conn.execute(DriverRepo.EXISTS, (user_id,)).fetchone() is not None
+
+    @staticmethod
+    def present(cursor, user_ids):
+        """Множество user_id из списка, у которых уже есть карточка водителя"""
+        return set(fetch_rows_by_ids(cursor, DriverRepo.PRESENT, user_ids))
+
+    @staticmethod
+    def create_from_applications(cursor, applications, hire_date):
+        """Создать карточки водителей по одобренным заявкам"""
+        cursor.executemany(DriverRepo.INSERT, [
+            (app['user_id'], app['license_number'], app['experience'], app['car_model'],
+             app['car_number'], app['max_weight'], app['car_type'], 'active', 'active', hire_date)
+            for app in applications
+        ])
+        bump_cache_tags(cursor, 'drivers')
+
+    @staticmethod
+    def delete(cursor, user_id):
+        cursor.execute(DriverRepo.DELETE, (user_id,))
+        bump_cache_tags(cursor, 'drivers')
+
+    @staticmethod
+    def restore(cursor, user_id):
+        cursor.execute(DriverRepo.RESTORE, (user_id,))
+        bump_cache_tags(cursor, 'drivers')
+
+    @staticmethod
+    def credit_delivery(cursor, user_id):
+        cursor.execute(DriverRepo.CREDIT_DELIVERY, (user_id,))
+        bump_cache_tags(cursor, 'drivers')
+
+    @staticmethod
+    def set_work_status(cursor, user_id, work_status):
+        cursor.execute(DriverRepo.SET_WORK_STATUS, (work_status, user_id))
+        bump_cache_tags(cursor, 'drivers')
+
+    @staticmethod
+    def active_fleet(conn):
+        """Машины активных водителей: [(user_id, car_type, max_weight)]"""
+        return [tuple(row) for row in conn.execute(DriverRepo.ACTIVE_FLEET).fetchall()]
+
+    @staticmethod
+    def select(conn, columns, user_id=None):
+        """Водители с данными пользователя; columns - результат select_list(DRIVER_FIELDS, ...)"""
+        if user_id is None:
+            return conn.execute(f'''
+                SELECT {columns} FROM drivers d JOIN users u ON d.user_id = u.id ORDER BY d.id DESC
+            ''').fetchall()
+        return conn.execute(f'''
+            SELECT {columns} FROM drivers d JOIN users u ON d.user_id = u.id WHERE d.user_id = ?
+        ''', (user_id,)).fetchall()
+
+@repository
+class ApplicationRepo:
+    """Заявки на роль водителя"""
+    BY_ID = 'SELECT * FROM driver_applications WHERE id = ?'
+    BY_IDS = 'SELECT * FROM driver_applications WHERE id IN ({marks})'
+    LATEST_FOR_USER = 'SELECT * FROM driver_applications WHERE user_id = ? ORDER BY applied_at DESC LIMIT 1'
+    PENDING_FOR_USER = "SELECT id FROM driver_applications WHERE user_id = ? AND status = 'pending'"
+    WITH_USERS = '''
+        SELECT da.*, u.first_name, u.last_name, u.phone, u.email
+        FROM driver_applications da
+        JOIN users u ON da.user_id = u.id
+        ORDER BY da.applied_at DESC
+    '''
+    INSERT = '''
+        INSERT INTO driver_applications (
+            user_id, license_number, experience, car_model, car_number,
+            max_weight, car_type
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+    '''
+    SET_STATUS = 'UPDATE driver_applications SET status = ?, processed_at = ?, processed_by = ? WHERE id = ?'
+
+    @staticmethod
+    def get(conn, app_id):
+        return conn.execute(ApplicationRepo.BY_ID, (app_id,)).fetchone()
+
+    @staticmethod
+    def get_many(cursor, app_ids):
+        """Заявки по списку id: {id: строка}"""
+        return fetch_rows_by_ids(cursor, ApplicationRepo.BY_IDS, app_ids)
+
+    @staticmethod
+    def latest_for_user(conn, user_id):
+        return conn.execute(ApplicationRepo.LATEST_FOR_USER, (user_id,)).fetchone()
+
+    @staticmethod
+    def has_pending(conn, user_id):
+        return conn.execute(ApplicationRepo.PENDING_FOR_USER, (user_id,)).fetchone() is not None
+
+    @staticmethod
+    def list_with_users(conn):
+        return conn.execute(ApplicationRepo.WITH_USERS).fetchall()
+
+    @staticmethod
+    def create(cursor, user_id, license_number, experience, car_model, car_number, max_weight, car_type):
+        cursor.execute(ApplicationRepo.INSERT, (user_id, license_number, experience, car_model,
+                                                car_number, max_weight, car_type))
+        bump_cache_tags(cursor, 'driver_applications')
+        return cursor.lastrowid
+
+    @staticmethod
+    def set_status(cursor, app_ids, status, admin_id, processed_at):
+        """Отметить решение по списку заявок одним executemany"""
+        cursor.executemany(ApplicationRepo.SET_STATUS,
+                           [(status, processed_at, admin_id, app_id) for app_id in app_ids])
+        bump_cache_tags(cursor, 'driver_applications')
+
+@repository
+class OrderRepo:
+    """Точечные чтения и изменения заказов в одном файле БД (основном или шарде).
+
+    Списки и поиск строятся из запрошенных полей и обходят шарды
+    (scatter_orders), поэтому остаются в обработчиках.
+    """
+    COLUMNS = (
+        'id, user_id, sender_name, sender_phone, sender_email, cargo_description, '
+        'product_category, cargo_weight, cargo_volume, cargo_type, shipping_date, '
+        'pickup_address, delivery_address, distance, price, insurance, packaging, '
+        'comments, status, client_status, tariff_version, pickup_city_id, delivery_city_id'
+    )
+    INSERT = (f"INSERT INTO orders ({COLUMNS}, change_seq, updated_at) "
+              f"VALUES ({', '.join('?' for _ in COLUMNS.split(', '))}, ?, CURRENT_TIMESTAMP)")
+    NEXT_CHANGE_SEQ = 'UPDATE order_change_counter SET seq = seq + ? RETURNING seq'
+    # Событие истории по текущему состоянию заказа (водитель - уже после изменения)
+    ADD_EVENT = '''
+        INSERT INTO order_events (order_id, seq, type, at, user_id, actor_id, driver_id)
+        SELECT id, (SELECT IFNULL(MAX(seq), 0) + 1 FROM order_events WHERE order_id = orders.id),
+               ?, ?, user_id, ?, driver_id
+        FROM orders WHERE id = ?
+    '''
+    EVENTS = 'SELECT seq, type, at, actor_id, driver_id FROM order_events WHERE order_id = ? ORDER BY seq'
+    LAST_CHANGE_SEQ = 'SELECT seq FROM order_change_counter'
+    PARTIES = 'SELECT user_id, driver_id, status FROM orders WHERE id = ?'
+    PRESENT = 'SELECT id FROM orders WHERE id IN ({marks})'
+    SET_DECISION = '''
+        UPDATE orders
+        SET status = ?, client_status = ?, admin_comment = ?, processed_at = ?,
+            change_seq = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    '''
+    ASSIGN = '''
+        UPDATE orders SET driver_id = ?, assigned_at = ?, change_seq = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    '''
+    ACCEPT = '''
+        UPDATE orders SET status = 'in_transit', client_status = 'in_transit', in_transit_at = ?, accepted_at = ?,
+                          change_seq = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    '''
+    SET_STATUS = '''
+        UPDATE orders
+        SET status = ?,
+            client_status = COALESCE(?, client_status),
+            in_transit_at = COALESCE(?, in_transit_at),
+            delivered_at = COALESCE(?, delivered_at),
+            change_seq = ?,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    '''
+
+    @staticmethod
+    def parties(conn, order_id):
+        """Строка (user_id, driver_id, status) или None"""
+        return conn.execute(OrderRepo.PARTIES, (order_id,)).fetchone()
+
+    @staticmethod
+    def present(cursor, order_ids):
+        """Множество id из списка, которые есть в этом файле БД"""
+        return set(fetch_rows_by_ids(cursor, OrderRepo.PRESENT, order_ids))
+
+    @staticmethod
+    def change_seqs(cursor, count):
+        """Зарезервировать count номеров изменений в транзакции записи"""
+        last = cursor.execute(OrderRepo.NEXT_CHANGE_SEQ, (count,)).fetchone()[0]
+        return range(last - count + 1, last + 1)
+
+    @staticmethod
+    def add_events(cursor, order_ids, event_type, at, actor_id=None):
+        """Добавить событие event_type в историю каждого заказа из списка"""
+        cursor.executemany(OrderRepo.ADD_EVENT,
+                           [(event_type, at.timestamp(), actor_id, order_id) for order_id in order_ids])
+
+    @staticmethod
+    def events(conn, order_id):
+        return conn.execute(OrderRepo.EVENTS, (order_id,)).fetchall()
+
+    @staticmethod
+    def create(cursor, values, created_at=None):
+        """values - значения колонок COLUMNS по порядку (id None - AUTOINCREMENT)"""
+        cursor.execute(OrderRepo.INSERT, (*values, OrderRepo.change_seqs(cursor, 1)[0]))
+        order_id = cursor.lastrowid
+        OrderRepo.add_events(cursor, [order_id], 'created', created_at or datetime.now(), values[1])
+        return order_id
+
+    @staticmethod
+    def set_decision(cursor, order_ids, status, comment, processed_at, actor_id=None):
+        cursor.executemany(OrderRepo.SET_DECISION, [
+            (status, status, comment, processed_at, seq, order_id)
+            for order_id, seq in zip(order_ids, OrderRepo.change_seqs(cursor, len(order_ids)))
+        ])
+        OrderRepo.add_events(cursor, order_ids, status, processed_at, actor_id)
+
+    @staticmethod
+    def assign(cursor, order_ids, driver_id, assigned_at, actor_id=None):
+        cursor.executemany(OrderRepo.ASSIGN, [
+            (driver_id, assigned_at, seq, order_id)
+            for order_id, seq in zip(order_ids, OrderRepo.change_seqs(cursor, len(order_ids)))
+        ])
+        OrderRepo.add_events(cursor, order_ids, 'assigned', assigned_at, actor_id)
+
+    @staticmethod
+    def accept(cursor, order_id, accepted_at, actor_id=None):
+        cursor.execute(OrderRepo.ACCEPT, (accepted_at, accepted_at, OrderRepo.change_seqs(cursor, 1)[0], order_id))
+        OrderRepo.add_events(cursor, [order_id], 'accepted', accepted_at, actor_id)
+
+    @staticmethod
+    def set_status(cursor, order_id, status, client_status=None, now=None, actor_id=None):
+        """Сменить статус; время in_transit/delivered проставляется по новому статусу"""
+        now = now or datetime.now()
+        cursor.execute(OrderRepo.SET_STATUS, (
+            status, client_status or None,
+            now if status == 'in_transit' else None,
+            now if status == 'delivered' else None,
+            OrderRepo.change_seqs(cursor, 1)[0],
+            order_id
+        ))
+        OrderRepo.add_events(cursor, [order_id], status, now, actor_id)
+
+# Колонки, добавленные после первой версии схемы: (таблица, колонка, тип)
+COLUMN_MIGRATIONS = [
+    ('orders', 'tariff_version', 'INTEGER'),
+    ('orders', 'change_seq', 'INTEGER'),
+    ('orders', 'updated_at', 'TIMESTAMP'),
+    # Города адресов из CITY_CATALOG, определяются при создании заказа
+    ('orders', 'pickup_city_id', 'INTEGER'),
+    ('orders', 'delivery_city_id', 'INTEGER'),
+    # Неудачные попытки ввода кода: счетчик общий для всех процессов
+    ('verification_codes', 'attempts', 'INTEGER DEFAULT 0'),
+]
+
+# Идемпотентные изменения схемы: применяются и к новой, и к уже существующей БД
+SCHEMA_MIGRATIONS = [
+    # Глобальная последовательность id заказов при шардировании
+    'CREATE TABLE IF NOT EXISTS order_id_sequence (id INTEGER PRIMARY KEY AUTOINCREMENT)',
+    # Сохраненные ответы для повторов запросов с заголовком Idempotency-Key
+    '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            route TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, route, idempotency_key)
+        ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)',
+    # Версии тарифов: data - JSON с коэффициентами, версия только растет
+    '''
+        CREATE TABLE IF NOT EXISTS tariffs (
+            version INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by INTEGER
+        )
+    ''',
+    # Планировщик обслуживания: аренда роли исполнителя и история задач
+    '''
+        CREATE TABLE IF NOT EXISTS maintenance_lease (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS maintenance_tasks (
+            name TEXT PRIMARY KEY,
+            last_run REAL NOT NULL,
+            duration REAL NOT NULL,
+            runs INTEGER DEFAULT 1,
+            result TEXT,
+            error TEXT
+        )
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS idx_verification_codes_contact
+        ON verification_codes (contact, purpose)
+    ''',
+    # Подтвержденные позиции потребителей журнала изменений по источникам
+    '''
+        CREATE TABLE IF NOT EXISTS change_consumers (
+            consumer TEXT NOT NULL,
+            source TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            acked_at TIMESTAMP,
+            PRIMARY KEY (consumer, source)
+        ) WITHOUT ROWID
+    ''',
+    # Показатели водителей: дневные суммы по доставкам и готовые итоги за периоды.
+    # Строятся задачами driver_rollup/driver_rollup_rebuild из order_events
+    '''
+        CREATE TABLE IF NOT EXISTS driver_daily_stats (
+            driver_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            deliveries INTEGER NOT NULL DEFAULT 0,
+            on_time INTEGER NOT NULL DEFAULT 0,
+            with_deadline INTEGER NOT NULL DEFAULT 0,
+            transit_seconds REAL NOT NULL DEFAULT 0,
+            transit_count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            distance REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (driver_id, day)
+        ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_driver_daily_stats_day ON driver_daily_stats (day)',
+    '''
+        CREATE TABLE IF NOT EXISTS driver_rollups (
+            period TEXT NOT NULL,
+            driver_id INTEGER NOT NULL,
+            deliveries INTEGER NOT NULL,
+            on_time INTEGER NOT NULL,
+            with_deadline INTEGER NOT NULL,
+            on_time_rate REAL,
+            avg_transit REAL,
+            weekly_volume REAL NOT NULL,
+            revenue REAL NOT NULL,
+            distance REAL NOT NULL,
+            PRIMARY KEY (period, driver_id)
+        ) WITHOUT ROWID
+    ''',
+    # Время последнего учтенного события delivered по каждому файлу заказов
+    '''
+        CREATE TABLE IF NOT EXISTS driver_rollup_watermarks (
+            source TEXT PRIMARY KEY,
+            watermark REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''',
+]
+
+# Схема вокруг таблицы orders: применяется к основной БД и к каждому шарду заказов
+ORDER_SCHEMA_MIGRATIONS = [
+    # История переходов заказа: только добавление, seq - номер события внутри заказа.
+    # user_id - клиент заказа: по нему события раскладываются по шардам вместе с заказом
+    '''
+        CREATE TABLE IF NOT EXISTS order_events (
+            order_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            at REAL NOT NULL,
+            user_id INTEGER NOT NULL,
+            actor_id INTEGER,
+            driver_id INTEGER,
+            PRIMARY KEY (order_id, seq)
+        ) WITHOUT ROWID
+    ''',
+    # Покрывает поиск концов этапов в order_stage_durations
+    'CREATE INDEX IF NOT EXISTS idx_order_events_type_at ON order_events (type, at, order_id, seq)',
+    # Журнал изменений (триггеры - sync_change_log_triggers). AUTOINCREMENT:
+    # номера не повторяются после сжатия журнала
+    '''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            operation TEXT NOT NULL,
+            columns TEXT,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Версии тегов кэша ответов (bump_cache_tags). Есть в каждом файле с
+    # заказами: теги заказов увеличиваются триггерами в той же транзакции
+    '''
+        CREATE TABLE IF NOT EXISTS cache_tags (
+            tag TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''',
+    # Покрывающие индексы для компактных списков заказов (view=compact)
+    '''
+        CREATE INDEX IF NOT EXISTS idx_orders_user_created
+        ON orders (user_id, created_at, status, client_status, driver_id, price)
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS idx_orders_driver_created
+        ON orders (driver_id, created_at, status, client_status, user_id, price)
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS idx_orders_created
+        ON orders (created_at, status, client_status, user_id, driver_id, price)
+    ''',
+    # Счетчики списка заказов (ORDER_FACET_COLUMNS): GROUP BY читает только индекс.
+    # idx_orders_facets начинается со status и заменяет idx_orders_status
+    '''
+        CREATE INDEX IF NOT EXISTS idx_orders_facets
+        ON orders (status, client_status, product_category, cargo_type, shipping_date)
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS idx_orders_user_facets
+        ON orders (user_id, status, client_status, product_category, cargo_type, shipping_date)
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS idx_orders_driver_facets
+        ON orders (driver_id, status, client_status, product_category, cargo_type, shipping_date)
+    ''',
+    'DROP INDEX IF EXISTS idx_orders_status',
+    # Последовательность изменений заказов (OrderRepo.change_seqs) для GET /api/orders/changes.
+    # Своя в каждом файле с заказами: единственный поток записи файла
+    # гарантирует, что номера фиксируются по возрастанию
+    '''
+        CREATE TABLE IF NOT EXISTS order_change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL
+        )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_orders_change_seq ON orders (change_seq)',
+    # Заказы, созданные до появления change_seq, получают номер по id
+    '''
+        UPDATE orders SET change_seq = id, updated_at = COALESCE(updated_at, created_at)
+        WHERE change_seq IS NULL
+    ''',
+    '''
+        INSERT OR IGNORE INTO order_change_counter (id, seq)
+        SELECT 1, IFNULL(MAX(change_seq), 0) FROM orders
+    ''',
+    # Заказы, пропавшие из видимости (GET /api/orders/changes, поле removed):
+    # reassigned - водитель driver_id снят с заказа, archived - заказ перенесен в архив.
+    # change_seq - из той же последовательности order_change_counter, что и у заказов
+    '''
+        CREATE TABLE IF NOT EXISTS order_removals (
+            change_seq INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            driver_id INTEGER,
+            PRIMARY KEY (change_seq, order_id)
+        ) WITHOUT ROWID
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_removals_au AFTER UPDATE OF driver_id ON orders
+        WHEN old.driver_id IS NOT NULL AND old.driver_id IS NOT new.driver_id BEGIN
+            INSERT OR IGNORE INTO order_removals (change_seq, order_id, kind, user_id, driver_id)
+            VALUES (new.change_seq, new.id, 'reassigned', new.user_id, old.driver_id);
+        END
+    ''',
+    # Удаление не проходит через OrderRepo.change_seqs: номер берет сам триггер
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_removals_ad AFTER DELETE ON orders BEGIN
+            UPDATE order_change_counter SET seq = seq + 1;
+            INSERT INTO order_removals (change_seq, order_id, kind, user_id, driver_id)
+            SELECT seq, old.id, 'archived', old.user_id, old.driver_id FROM order_change_counter;
+        END
+    ''',
+    # Любое изменение заказа сбрасывает кэш счетчиков: общий тег, тег клиента и тег водителя
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_cache_tags_ai AFTER INSERT ON orders BEGIN
+            INSERT INTO cache_tags (tag, version)
+            SELECT tag, 1 FROM (
+                SELECT 'orders' AS tag
+                UNION SELECT 'orders:user:' || new.user_id
+                UNION SELECT 'orders:driver:' || new.driver_id
+            ) WHERE tag IS NOT NULL
+            ON CONFLICT (tag) DO UPDATE SET version = version + 1;
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_cache_tags_au AFTER UPDATE ON orders BEGIN
+            INSERT INTO cache_tags (tag, version)
+            SELECT tag, 1 FROM (
+                SELECT 'orders' AS tag
+                UNION SELECT 'orders:user:' || new.user_id
+                UNION SELECT 'orders:user:' || old.user_id
+                UNION SELECT 'orders:driver:' || new.driver_id
+                UNION SELECT 'orders:driver:' || old.driver_id
+            ) WHERE tag IS NOT NULL
+            ON CONFLICT (tag) DO UPDATE SET version = version + 1;
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_cache_tags_ad AFTER DELETE ON orders BEGIN
+            INSERT INTO cache_tags (tag, version)
+            SELECT tag, 1 FROM (
+                SELECT 'orders' AS tag
+                UNION SELECT 'orders:user:' || old.user_id
+                UNION SELECT 'orders:driver:' || old.driver_id
+            ) WHERE tag IS NOT NULL
+            ON CONFLICT (tag) DO UPDATE SET version = version + 1;
+        END
+    ''',
+    # Полнотекстовый индекс по заказам (external content, синхронизируется триггерами)
+    '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+            cargo_description, sender_name, sender_phone,
+            pickup_address, delivery_address, comments,
+            content='orders', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_ai AFTER INSERT ON orders BEGIN
+            INSERT INTO orders_fts (rowid, cargo_description, sender_name, sender_phone,
+                                    pickup_address, delivery_address, comments)
+            VALUES (new.id, new.cargo_description, new.sender_name, new.sender_phone,
+                    new.pickup_address, new.delivery_address, new.comments);
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_ad AFTER DELETE ON orders BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, cargo_description, sender_name, sender_phone,
+                                    pickup_address, delivery_address, comments)
+            VALUES ('delete', old.id, old.cargo_description, old.sender_name, old.sender_phone,
+                    old.pickup_address, old.delivery_address, old.comments);
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_au AFTER UPDATE OF
+            cargo_description, sender_name, sender_phone, pickup_address, delivery_address, comments
+        ON orders BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, cargo_description, sender_name, sender_phone,
+                                    pickup_address, delivery_address, comments)
+            VALUES ('delete', old.id, old.cargo_description, old.sender_name, old.sender_phone,
+                    old.pickup_address, old.delivery_address, old.comments);
+            INSERT INTO orders_fts (rowid, cargo_description, sender_name, sender_phone,
+                                    pickup_address, delivery_address, comments)
+            VALUES (new.id, new.cargo_description, new.sender_name, new.sender_phone,
+                    new.pickup_address, new.delivery_address, new.comments);
+        END
+    ''',
+]
+
+# Журнал изменений для внешних потребителей (биллинг, аналитика): строка
+# change_log пишется триггером в той же транзакции, что и изменение
+CHANGE_LOG_TABLES = ('orders', 'drivers', 'driver_applications')
+# Служебные колонки, изменение только которых не попадает в журнал
+CHANGE_LOG_SKIP_COLUMNS = {'orders': {'change_seq', 'updated_at', 'pickup_city_id', 'delivery_city_id'}}
+
+def change_log_triggers(cursor, table):
+    """Тексты триггеров журнала для table по ее текущим колонкам: {имя: SQL}"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    skip = CHANGE_LOG_SKIP_COLUMNS.get(table, set())
+    columns = [row[1] for row in cursor.fetchall() if row[1] not in skip and not row[5]]
+    # ',status,client_status' - список изменившихся колонок с ведущей запятой
+    changed = ' || '.join(f"CASE WHEN old.{column} IS NOT new.{column} THEN ',{column}' ELSE '' END"
+                          for column in columns)
+    insert = 'INSERT INTO change_log (table_name, row_id, operation, columns)'
+    return {
+        f'{table}_change_log_ai': (f'CREATE TRIGGER {table}_change_log_ai AFTER INSERT ON {table} BEGIN '
+                                   f"{insert} VALUES ('{table}', new.id, 'insert', NULL); END"),
+        f'{table}_change_log_au': (f'CREATE TRIGGER {table}_change_log_au AFTER UPDATE ON {table} '
+                                   f"WHEN ({changed}) != '' BEGIN "
+                                   f"{insert} VALUES ('{table}', new.id, 'update', substr({changed}, 2)); END"),
+        f'{table}_change_log_ad': (f'CREATE TRIGGER {table}_change_log_ad AFTER DELETE ON {table} BEGIN '
+                                   f"{insert} VALUES ('{table}', old.id, 'delete', NULL); END"),
+    }
+
+def sync_change_log_triggers(cursor, table):
+    """Пересоздать триггеры журнала, если набор колонок таблицы изменился"""
+    for name, sql in change_log_triggers(cursor, table).items():
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,))
+        row = cursor.fetchone()
+        if row is None or row[0] != sql:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(sql)
+
+# Заполнение order_events по колонкам времени заказов, созданных до появления истории.
+# created_at записан SQLite в UTC, остальные колонки - локальное время сервера
+ORDER_EVENTS_BACKFILL = '''
+    INSERT INTO order_events (order_id, seq, type, at, user_id, actor_id, driver_id)
+    SELECT order_id, ROW_NUMBER() OVER (PARTITION BY order_id ORDER BY at, stage),
+           type, at, user_id, actor_id, driver_id
+    FROM (
+        SELECT id AS order_id, 0 AS stage, 'created' AS type,
+               (julianday(created_at) - 2440587.5) * 86400.0 AS at,
+               user_id, user_id AS actor_id, NULL AS driver_id
+        FROM orders WHERE created_at IS NOT NULL
+        UNION ALL
+        SELECT id, 1, CASE WHEN status = 'rejected' THEN 'rejected' ELSE 'confirmed' END,
+               (julianday(processed_at, 'utc') - 2440587.5) * 86400.0, user_id, NULL, NULL
+        FROM orders WHERE processed_at IS NOT NULL
+        UNION ALL
+        SELECT id, 2, 'assigned', (julianday(assigned_at, 'utc') - 2440587.5) * 86400.0, user_id, NULL, driver_id
+        FROM orders WHERE assigned_at IS NOT NULL
+        UNION ALL
+        SELECT id, 3, 'accepted', (julianday(accepted_at, 'utc') - 2440587.5) * 86400.0, user_id, driver_id, driver_id
+        FROM orders WHERE accepted_at IS NOT NULL
+        UNION ALL
+        SELECT id, 4, 'in_transit', (julianday(in_transit_at, 'utc') - 2440587.5) * 86400.0, user_id, driver_id, driver_id
+        FROM orders WHERE in_transit_at IS NOT NULL AND accepted_at IS NULL
+        UNION ALL
+        SELECT id, 5, 'delivered', (julianday(delivered_at, 'utc') - 2440587.5) * 86400.0, user_id, driver_id, driver_id
+        FROM orders WHERE delivered_at IS NOT NULL
+        UNION ALL
+        SELECT id, 6, 'cancelled', (julianday(cancelled_at, 'utc') - 2440587.5) * 86400.0, user_id, NULL, driver_id
+        FROM orders WHERE cancelled_at IS NOT NULL
+    )
+    WHERE at IS NOT NULL
+'''
+
+def migrate_db(conn, orders_only=False):
+    """Применить идемпотентные изменения схемы.
+
+    orders_only - файл шарда заказов: только колонки, индексы,
+    полнотекстовый индекс и журнал изменений таблицы orders.
+    """
+    cursor = conn.cursor()
+    # WAL: читатели не блокируют единственный поток записи
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'orders_fts'")
+    fts_missing = cursor.fetchone() is None
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'order_events'")
+    events_missing = cursor.fetchone() is None
+    cursor.execute('PRAGMA table_info(orders)')
+    cities_missing = 'pickup_city_id' not in {row[1] for row in cursor.fetchall()}
+    for table, column, column_type in COLUMN_MIGRATIONS:
+        if orders_only and table != 'orders':
+            continue
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    for statement in ([] if orders_only else SCHEMA_MIGRATIONS) + ORDER_SCHEMA_MIGRATIONS:
+        cursor.execute(statement)
+    for table in ('orders',) if orders_only else CHANGE_LOG_TABLES:
+        sync_change_log_triggers(cursor, table)
+    if fts_missing:
+        # Индекс создан впервые - заполняем его уже существующими заказами
+        cursor.execute("INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')")
+    if events_missing:
+        # История создана впервые - восстанавливаем ее из колонок времени заказов
+        cursor.execute(ORDER_EVENTS_BACKFILL)
+    if cities_missing:
+        # Колонки городов добавлены только что - определяем города существующих заказов
+        backfill_order_cities(cursor)
+    if not orders_only:
+        # Первая версия тарифа - коэффициенты, которыми сервер считал цену до версионирования
+        cursor.execute('INSERT INTO tariffs (version, data) SELECT 1, ? WHERE NOT EXISTS (SELECT 1 FROM tariffs)',
+                       (json.dumps(DEFAULT_TARIFF),))
+    conn.commit()
+
 def init_db():
     """Инициализация базы данных при первом запуске"""
-    if os.path.exists(app.config['DATABASE']):
+    if database_exists(app.config['DATABASE']):
         if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
             print("[INFO] База уже существует")
+        try:
+            conn = connect_db(app.config['DATABASE'])
+            migrate_db(conn)
+            conn.close()
+            init_order_shards()
+        except Exception as e:
+            print(f"[ERROR] Ошибка при обновлении схемы БД: {e}", file=sys.stderr)
         return
     try:
-        conn = sqlite3.connect(app.config['DATABASE'])
+        conn = connect_db(app.config['DATABASE'])
         cursor = conn.cursor()
         if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
             print("[INFO] Создание таблиц базы данных...")
+        # Позволяет постепенно возвращать место после архивации (PRAGMA incremental_vacuum)
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
         # Таблица пользователей
         cursor.execute('''
             CREATE TABLE users (
@@ -123,6 +1673,7 @@ def init_db():
                 in_transit_at TIMESTAMP,
                 delivered_at TIMESTAMP,
                 cancelled_at TIMESTAMP,
+                tariff_version INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (driver_id) REFERENCES users (id)
             )
@@ -190,6 +1741,7 @@ def init_db():
                 purpose TEXT NOT NULL,
                 expires_at TIMESTAMP NOT NULL,
                 used INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -200,12 +1752,271 @@ def init_db():
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', ('admin@transportco.ru', '+79123456780', admin_password, 'Александр', 'Петров', 1, 1))
         conn.commit()
+        migrate_db(conn)
         conn.close()
+        init_order_shards()
         if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
             print("[INFO] Таблицы транспортной компании успешно созданы!")
     except Exception as e:
         print(f"[ERROR] Ошибка при инициализации БД: {e}", file=sys.stderr)
 
+# === АРХИВ ЗАКАЗОВ ===
+# Статусы, после которых заказ больше не меняется
+ARCHIVABLE_STATUSES = ('delivered', 'cancelled', 'rejected')
+# Пути архивных БД, для которых схема уже проверена в этом процессе
+_archive_schema_ready = set()
+
+def attach_archive(conn):
+    """Подключить архивную БД к соединению как схему archive"""
+    if app.config['ARCHIVE_DATABASE'] not in _archive_schema_ready:
+        ensure_archive_schema()
+        _archive_schema_ready.add(app.config['ARCHIVE_DATABASE'])
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA database_list')
+    if any(row[1] == 'archive' for row in cursor.fetchall()):
+        return
+    attach_database(cursor.connection, app.config['ARCHIVE_DATABASE'], 'archive')
+
+def orders_table_ddl(cursor, target):
+    """DDL таблицы target по схеме main.orders без внешних ключей.
+
+    Таблицы users в архиве и шардах нет, поэтому ссылки на нее не переносим.
+    """
+    cursor.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = 'orders'")
+    ddl = cursor.fetchone()[0]
+    ddl = re.sub(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)', '', ddl)
+    return re.sub(r'^CREATE TABLE\s+"?orders"?', f'CREATE TABLE {target}', ddl)
+
+def ensure_archive_schema():
+    """Создать archive.orders по схеме main.orders или дополнить недостающими колонками.
+
+    Выполняется на отдельном пишущем соединении: соединения пула чтения
+    открыты только на чтение и не могут менять схему архива.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    attach_database(cursor.connection, app.config['ARCHIVE_DATABASE'], 'archive')
+    cursor.execute("SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'orders'")
+    if not cursor.fetchone():
+        cursor.execute('PRAGMA archive.auto_vacuum = INCREMENTAL')
+        cursor.execute(orders_table_ddl(cursor, 'archive.orders'))
+    else:
+        cursor.execute('PRAGMA archive.table_info(orders)')
+        archive_columns = {row[1] for row in cursor.fetchall()}
+        cursor.execute('PRAGMA main.table_info(orders)')
+        for row in cursor.fetchall():
+            if row[1] not in archive_columns:
+                cursor.execute(f'ALTER TABLE archive.orders ADD COLUMN {row[1]} {row[2]}')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_user ON orders (user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_driver ON orders (driver_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_created ON orders (created_at)')
+    conn.commit()
+    conn.close()
+
+def archive_finished_orders(days=None, batch_size=None, max_batches=None):
+    """Перенести заказы, завершенные более days дней назад, в архивную БД.
+
+    Перенос идет пачками по batch_size заказов, каждая пачка - отдельная
+    короткая транзакция. После переноса освобождается часть страниц
+    основной БД (incremental_vacuum). При шардировании каждый шард
+    переносится по очереди, max_batches действует на шард.
+    Возвращает словарь со статистикой.
+    """
+    days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.now() - timedelta(days=days)
+    stats = {'moved': 0, 'batches': 0, 'cutoff': cutoff.isoformat(sep=' '), 'reclaimedPages': 0, 'freePages': 0}
+    for database in order_databases():
+        moved, batches, reclaimed, free_pages = archive_database_orders(database, cutoff, batch_size, max_batches)
+        stats['moved'] += moved
+        stats['batches'] += batches
+        stats['reclaimedPages'] += reclaimed
+        stats['freePages'] += free_pages
+    return stats
+
+def archive_database_orders(database, cutoff, batch_size, max_batches):
+    """Архивация одного файла с таблицей orders; (перенесено, пачек, освобождено, свободно).
+
+    Каждая пачка - исключительная операция потока записи файла (run_exclusive):
+    ей нужен ATTACH архива, который невозможен внутри групповой транзакции,
+    а отдельное пишущее соединение конкурировало бы с потоком записи.
+    """
+    status_marks = ', '.join('?' for _ in ARCHIVABLE_STATUSES)
+
+    def archive_batch(conn):
+        attach_archive(conn)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA main.table_info(orders)')
+            columns = ', '.join(row[1] for row in cursor.fetchall())
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'''
+                SELECT id FROM main.orders
+                WHERE status IN ({status_marks})
+                  AND COALESCE(delivered_at, cancelled_at, processed_at) < ?
+                LIMIT ?
+            ''', (*ARCHIVABLE_STATUSES, cutoff, batch_size))
+            ids = [row['id'] for row in cursor.fetchall()]
+            if ids:
+                id_marks = ', '.join('?' for _ in ids)
+                cursor.execute(f'''
+                    INSERT OR REPLACE INTO archive.orders ({columns})
+                    SELECT {columns} FROM main.orders WHERE id IN ({id_marks})
+                ''', ids)
+                cursor.execute(f'DELETE FROM main.orders WHERE id IN ({id_marks})', ids)
+            conn.commit()
+            return len(ids)
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.execute('DETACH DATABASE archive')
+
+    moved = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        count = run_exclusive(archive_batch, database)
+        if not count:
+            break
+        moved += count
+        batches += 1
+    # Возвращаем освободившиеся страницы ограниченными порциями
+    reclaimed, free_pages = run_write(
+        lambda cursor: incremental_vacuum(cursor, int(app.config['ARCHIVE_VACUUM_PAGES'])), database)
+    return moved, batches, reclaimed, free_pages
+
+def orders_source(conn, include_archived):
+    """Источник строк заказов для FROM: только горячие данные или вместе с архивом"""
+    if not include_archived or not database_exists(app.config['ARCHIVE_DATABASE']):
+        return 'main.orders'
+    attach_archive(conn)
+    columns = ', '.join(ORDER_FIELDS)
+    return f'(SELECT {columns} FROM main.orders UNION ALL SELECT {columns} FROM archive.orders)'
+
+def parse_bool_arg(name):
+    """Прочитать булев параметр строки запроса (1/true/yes)"""
+    return request.args.get(name, '').strip().lower() in ('1', 'true', 'yes')
+
+# === ШАРДИРОВАНИЕ ЗАКАЗОВ ===
+# Пул потоков для параллельного опроса шардов (по процессу)
+_shard_executor = None
+_shard_executor_pid = None
+
+def order_databases():
+    """Файлы БД с таблицей orders: основная БД или все шарды по порядку"""
+    shards = app.config['ORDER_SHARDS']
+    if not shards:
+        return [app.config['DATABASE']]
+    return [app.config['ORDER_SHARD_TEMPLATE'].format(i) for i in range(shards)]
+
+def all_databases():
+    """Основная БД и файлы шардов заказов без повторов"""
+    return list(dict.fromkeys([app.config['DATABASE'], *order_databases()]))
+
+def shard_of(user_id, shards):
+    """Номер шарда клиента: crc32 стабилен между процессами, в отличие от hash()"""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+def order_database_for_user(user_id):
+    """Файл БД, в котором лежат заказы клиента"""
+    databases = order_databases()
+    return databases[shard_of(user_id, len(databases))]
+
+def init_order_shards():
+    """Создать в файлах шардов таблицу orders по схеме основной БД"""
+    if not app.config['ORDER_SHARDS']:
+        return
+    conn = get_db()
+    for database in order_databases():
+        attach_database(conn, database, 'shard')
+        if not conn.execute("SELECT 1 FROM shard.sqlite_master WHERE type = 'table' AND name = 'orders'").fetchone():
+            conn.execute('PRAGMA shard.auto_vacuum = INCREMENTAL')
+            conn.execute(orders_table_ddl(conn.cursor(), 'shard.orders'))
+            conn.commit()
+        conn.execute('DETACH DATABASE shard')
+        shard = connect_db(database)
+        migrate_db(shard, orders_only=True)
+        shard.close()
+    conn.close()
+
+def allocate_order_id():
+    """Глобально уникальный id нового заказа (только в режиме шардов).
+
+    AUTOINCREMENT не переиспользует номера, поэтому выданные строки
+    последовательности сразу удаляются.
+    """
+    def write(cursor):
+        order_id = cursor.execute('INSERT INTO order_id_sequence DEFAULT VALUES').lastrowid
+        cursor.execute('DELETE FROM order_id_sequence')
+        return order_id
+    return run_write(write)
+
+def scatter_orders(query, params=(), databases=None, include_archived=False):
+    """Выполнить запрос к orders на каждом шарде параллельно.
+
+    В query подставляется {source} - источник строк заказов. Архив общий
+    для всех шардов, поэтому подключается только к первому потоку строк.
+    params - кортеж или функция от номера файла в databases, если
+    параметры у шардов разные. Возвращает списки строк в порядке шардов.
+    """
+    global _shard_executor, _shard_executor_pid
+    databases = databases or order_databases()
+    trace = current_trace()
+
+    def run(index):
+        with bind_trace(trace), trace_span(f'shard {index}', 'db'):
+            conn = get_read_db(databases[index])
+            try:
+                source = orders_source(conn, include_archived and index == 0)
+                return conn.execute(query.format(source=source),
+                                    params(index) if callable(params) else params).fetchall()
+            finally:
+                conn.close()
+
+    if len(databases) == 1:
+        return [run(0)]
+    if _shard_executor is None or _shard_executor_pid != os.getpid():
+        _shard_executor = ThreadPoolExecutor(max_workers=len(databases), thread_name_prefix='order-shard')
+        _shard_executor_pid = os.getpid()
+    return list(_shard_executor.map(run, range(len(databases))))
+
+def merge_shard_rows(row_lists, key, reverse=False, limit=None):
+    """k-way слияние уже отсортированных результатов шардов"""
+    merged = heapq.merge(*row_lists, key=key, reverse=reverse)
+    return list(itertools.islice(merged, limit)) if limit else list(merged)
+
+def newest_first(row):
+    """Ключ слияния по created_at DESC (NULL - в конце, как в SQLite)"""
+    return row['created_at'] or ''
+
+def locate_order(order_id):
+    """Файл БД (основной или шард), в котором лежит заказ; None, если нет"""
+    databases = order_databases()
+    if len(databases) == 1:
+        return databases[0]
+    for database in databases:
+        conn = get_read_db(database)
+        found = OrderRepo.parties(conn, order_id)
+        conn.close()
+        if found:
+            return database
+    return None
+
+def fetch_order_row(columns, order_id):
+    """Найти заказ сначала в шардах (основной БД), затем в архиве"""
+    databases = order_databases()
+    for database in databases:
+        conn = get_read_db(database)
+        try:
+            row = conn.execute(f'SELECT {columns} FROM main.orders WHERE id = ?', (order_id,)).fetchone()
+            if row is None and database == databases[-1] and database_exists(app.config['ARCHIVE_DATABASE']):
+                attach_archive(conn)
+                row = conn.execute(f'SELECT {columns} FROM archive.orders WHERE id = ?', (order_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is not None:
+            return row
+    return None
+
 # === ДЕКОРАТОРЫ ===
 def login_required(f):
     """Декоратор для проверки авторизации"""
@@ -222,136 +2033,4073 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT is_admin FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
-        conn.close()
-        if not user or not user['is_admin']:
+        with trace_span('auth.role', 'auth'):
+            conn = get_read_db()
+            is_admin = UserRepo.is_admin(conn, session['user_id'])
+            conn.close()
+        if not is_admin:
             return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
         return f(*args, **kwargs)
     return decorated_function
 
-# === МАРШРУТЫ ДЛЯ СТАТИКИ ===
-@app.route('/')
-def index():
-    """Главная страница - отдаем main.html"""
-    return send_from_directory('', 'main.html')
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ===
+class SlidingWindowLimiter:
+    """Скользящее окно по каждому ключу в кольцевом буфере.
 
-@app.route('/css/<path:filename>')
-def styles(filename):
-    """Раздача CSS файлов"""
-    return send_from_directory('css', filename)
+    Для ключа с лимитом N хранятся времена последних N запросов. Самая
+    старая отметка - та, что будет перезаписана следующей: если она моложе
+    окна, запрос отклоняется. Проверка и запись - O(1), память - N чисел
+    на ключ. Число ключей ограничено, давно не использованные вытесняются (LRU).
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # ключ -> [кольцевой буфер, позиция]
+        self.lock = threading.Lock()
 
-@app.route('/js/<path:filename>')
-def scripts(filename):
-    """Раздача JS файлов"""
-    return send_from_directory('js', filename)
+    def hit(self, checks, now=None):
+        """Атомарно проверить и учесть запрос по всем ключам checks = [(key, limit, window)].
 
-# === API ENDPOINTS ===
-# === АВТОРИЗАЦИЯ ===
-@app.route('/api/register', methods=['POST'])
-@swag_from({
-    'tags': ['Авторизация'],
-    'parameters': [
-        {
-            'name': 'body',
-            'in': 'body',
-            'required': True,
-            'schema': {
-                'type': 'object',
-                'properties': {
-                    'email': {'type': 'string', 'example': 'user@example.com'},
-                    'phone': {'type': 'string', 'example': '+79123456789'},
-                    'password': {'type': 'string', 'example': 'secure123'},
-                    'firstName': {'type': 'string', 'example': 'Иван'},
-                    'lastName': {'type': 'string', 'example': 'Иванов'}
-                },
-                'required': ['email', 'phone', 'password', 'firstName', 'lastName']
+        Возвращает None, если запрос разрешен, иначе (ключ, секунд до повтора).
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            buckets = []
+            for key, limit, window in checks:
+                bucket = self.buckets.get(key)
+                if bucket is None or len(bucket[0]) != limit:
+                    bucket = [array('d', [float('-inf')] * limit), 0]
+                    self.buckets[key] = bucket
+                else:
+                    self.buckets.move_to_end(key)
+                oldest = bucket[0][bucket[1]]
+                if now - oldest < window:
+                    return key, max(int(window - (now - oldest)) + 1, 1)
+                buckets.append(bucket)
+            for bucket in buckets:
+                ring, position = bucket
+                ring[position] = now
+                bucket[1] = (position + 1) % len(ring)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return None
+
+_rate_limiter = SlidingWindowLimiter(app.config['RATE_LIMIT_MAX_KEYS'])
+# маршрут -> счетчики разрешенных и отклоненных запросов
+rate_limit_counters = {}
+
+def rate_limited(route, login_fields=()):
+    """Декоратор: отклонить запрос по лимитам RATE_LIMITS[route] до обращения к БД и хэшированию.
+
+    login_fields - поля JSON тела, первое непустое из которых задает
+    идентификатор для лимита области 'login'.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            limits = app.config['RATE_LIMITS'].get(route, {})
+            checks = []
+            if 'ip' in limits:
+                checks.append((f'{route}:ip:{request.remote_addr}', *limits['ip']))
+            if 'login' in limits:
+                data = request.get_json(silent=True) or {}
+                identifier = next((str(data[name]).strip().lower() for name in login_fields
+                                   if isinstance(data, dict) and data.get(name)), '')
+                if identifier:
+                    checks.append((f'{route}:login:{identifier}', *limits['login']))
+            counters = rate_limit_counters.setdefault(route, {'allowed': 0, 'rejectedIp': 0, 'rejectedLogin': 0})
+            rejected = _rate_limiter.hit(checks) if checks else None
+            if rejected:
+                key, retry_after = rejected
+                counters['rejectedIp' if ':ip:' in key else 'rejectedLogin'] += 1
+                response = jsonify({'success': False, 'message': 'Слишком много попыток, попробуйте позже'})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
+            counters['allowed'] += 1
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# === ИДЕМПОТЕНТНОСТЬ (Idempotency-Key) ===
+IDEMPOTENCY_KEY_PARAM = {
+    'name': 'Idempotency-Key',
+    'in': 'header',
+    'type': 'string',
+    'required': False,
+    'description': 'Ключ повтора: запрос с тем же ключом не выполняется повторно, возвращается сохраненный ответ'
+}
+# Статусы, ответы с которыми не сохраняются: запрос можно повторить.
+# 202 - запись не дождалась потока записи (WriteTimeout), итог еще неизвестен
+IDEMPOTENCY_RETRYABLE = (202, 409, 429)
+# Статус-метка ключа, запись по которому началась, но еще не зафиксирована
+IDEMPOTENCY_PENDING = 0
+
+# Последние ответы в памяти: (user_id, route, key) -> (хэш запроса, статус, тело, время)
+_idempotency_cache = OrderedDict()
+# Ключи, запрос по которым выполняется прямо сейчас
+_idempotency_in_flight = set()
+_idempotency_lock = threading.Lock()
+
+def idempotency_lookup(cache_key, now):
+    """Сохраненный ответ из памяти или из таблицы (с прогревом памяти)"""
+    with _idempotency_lock:
+        entry = _idempotency_cache.get(cache_key)
+        if entry is not None:
+            if now - entry[3] <= app.config['IDEMPOTENCY_TTL']:
+                _idempotency_cache.move_to_end(cache_key)
+                return entry
+            del _idempotency_cache[cache_key]
+    conn = get_read_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT request_hash, status, response, created_at FROM idempotency_keys
+        WHERE user_id = ? AND route = ? AND idempotency_key = ? AND created_at > ?
+    ''', (*cache_key, now - app.config['IDEMPOTENCY_TTL']))
+    row = cursor.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    entry = tuple(row)
+    idempotency_remember(cache_key, entry)
+    return entry
+
+def idempotency_remember(cache_key, entry):
+    with _idempotency_lock:
+        _idempotency_cache[cache_key] = entry
+        _idempotency_cache.move_to_end(cache_key)
+        while len(_idempotency_cache) > app.config['IDEMPOTENCY_CACHE_SIZE']:
+            _idempotency_cache.popitem(last=False)
+
+def idempotency_mark_pending(cache_key, request_hash, future, now):
+    """Запомнить ключ как ожидающий итога записи future (после WriteTimeout).
+
+    Пока future не завершен, повторы получают 409. Итог записывается через
+    очередь основной БД без ожидания: callback future выполняется в потоке
+    записи. Операция завершилась - сохраняется ответ об успехе (исходный ответ
+    обработчика уже потерян); отменена или откатилась - ключ удаляется, и
+    повтор выполнит запрос заново.
+    """
+    writer = get_writer()
+    pending = (request_hash, IDEMPOTENCY_PENDING, '', now)
+    idempotency_remember(cache_key, pending)
+    writer.submit(lambda cursor: cursor.execute('''
+        INSERT OR REPLACE INTO idempotency_keys
+            (user_id, route, idempotency_key, request_hash, status, response, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (*cache_key, *pending)))
+
+    def settle(done):
+        if done.cancelled() or done.exception() is not None:
+            with _idempotency_lock:
+                _idempotency_cache.pop(cache_key, None)
+            writer.submit(lambda cursor: cursor.execute('''
+                DELETE FROM idempotency_keys
+                WHERE user_id = ? AND route = ? AND idempotency_key = ? AND status = ?
+            ''', (*cache_key, IDEMPOTENCY_PENDING)))
+            return
+        body = json.dumps({'success': True,
+                           'message': 'Запрос выполнен, ответ недоступен: обновите данные'},
+                          ensure_ascii=False)
+        entry = (request_hash, 200, body, now)
+        idempotency_remember(cache_key, entry)
+        writer.submit(lambda cursor: cursor.execute('''
+            INSERT OR REPLACE INTO idempotency_keys
+                (user_id, route, idempotency_key, request_hash, status, response, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (*cache_key, *entry)))
+
+    future.add_done_callback(settle)
+
+def idempotent(route):
+    """Декоратор: повтор запроса с тем же Idempotency-Key возвращает сохраненный ответ.
+
+    Ключ действует в пределах пользователя и маршрута. Тот же ключ с
+    другим телом запроса - ошибка 422; пока первый запрос выполняется,
+    повтор получает 409. Если запись первого запроса началась, но не
+    дождалась потока записи (202), ключ ожидает ее итога, повторы тоже
+    получают 409 с Retry-After. Применяется после login_required/admin_required.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key', '').strip()
+            if not key:
+                return f(*args, **kwargs)
+            if len(key) > 255:
+                return jsonify({'success': False, 'message': 'Idempotency-Key длиннее 255 символов'}), 400
+            cache_key = (session['user_id'], route, key)
+            request_hash = hashlib.sha256(request.path.encode('utf-8') + b'\n' + request.get_data()).hexdigest()
+            now = time.time()
+            entry = idempotency_lookup(cache_key, now)
+            if entry is None:
+                with _idempotency_lock:
+                    if cache_key in _idempotency_in_flight:
+                        return jsonify({'success': False, 'message': 'Запрос с этим ключом еще выполняется'}), 409
+                    _idempotency_in_flight.add(cache_key)
+                try:
+                    response = app.make_response(f(*args, **kwargs))
+                    # Ответ после WriteTimeout не окончательный, даже если обработчик вернул свой статус
+                    timeout = g.get('write_timeout')
+                    final = timeout is None
+                    if timeout is not None and timeout.started and timeout.future is not None:
+                        idempotency_mark_pending(cache_key, request_hash, timeout.future, now)
+                    if final and response.status_code < 500 and response.status_code not in IDEMPOTENCY_RETRYABLE:
+                        entry = (request_hash, response.status_code, response.get_data(as_text=True), now)
+                        idempotency_remember(cache_key, entry)
+                        try:
+                            run_write(lambda cursor: cursor.execute('''
+                                INSERT OR REPLACE INTO idempotency_keys
+                                    (user_id, route, idempotency_key, request_hash, status, response, created_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ''', (*cache_key, *entry)))
+                        except WriteTimeout:
+                            # Сам запрос выполнен: ответ отдаем, ключ остается в памяти процесса
+                            g.pop('write_timeout', None)
+                    return response
+                finally:
+                    with _idempotency_lock:
+                        _idempotency_in_flight.discard(cache_key)
+            if entry[0] != request_hash:
+                return jsonify({'success': False,
+                                'message': 'Idempotency-Key уже использован для другого запроса'}), 422
+            if entry[1] == IDEMPOTENCY_PENDING:
+                response = jsonify({'success': False, 'message': 'Запрос с этим ключом еще выполняется'})
+                response.status_code = 409
+                response.headers['Retry-After'] = str(app.config['WRITER_RETRY_AFTER'])
+                return response
+            response = app.response_class(entry[2], status=entry[1], mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        return decorated_function
+    return decorator
+
+def purge_idempotency_keys():
+    """Удалить ответы старше IDEMPOTENCY_TTL"""
+    cutoff = time.time() - app.config['IDEMPOTENCY_TTL']
+    deleted = run_write(lambda cursor: cursor.execute(
+        'DELETE FROM idempotency_keys WHERE created_at < ?', (cutoff,)).rowcount)
+    return {'deleted': deleted}
+
+# === КЭШ ОТВЕТОВ ===
+# Готовые JSON-ответы списков администратора и счетчиков заказов. Версии
+# тегов лежат в БД (cache_tags) и увеличиваются в транзакции записи,
+# поэтому сброс виден всем процессам сервера.
+class ResponseCache:
+    """LRU-кэш ответов, ограниченный числом записей и суммарным размером"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # ключ -> (версии тегов, тело ответа)
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != versions:
+                self._drop(key)
+                self.stats['stale'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, versions, body):
+        if len(body) > app.config['RESPONSE_CACHE_MAX_BYTES']:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (versions, body)
+            self.size += len(body)
+            while (len(self.entries) > app.config['RESPONSE_CACHE_MAX_ENTRIES']
+                   or self.size > app.config['RESPONSE_CACHE_MAX_BYTES']):
+                self._drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def _drop(self, key):
+        self.size -= len(self.entries.pop(key)[1])
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hitRate': round(self.stats['hits'] / lookups, 4) if lookups else None,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'maxEntries': app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+                'maxBytes': app.config['RESPONSE_CACHE_MAX_BYTES'],
             }
-        }
-    ],
-    'responses': {
-        200: {
-            'description': 'Успешная регистрация',
+
+_response_cache = ResponseCache()
+
+def bump_cache_tags(cursor, *tags):
+    """Сбросить закэшированные ответы с тегами tags; вызывается в транзакции записи"""
+    cursor.executemany('''
+        INSERT INTO cache_tags (tag, version) VALUES (?, 1)
+        ON CONFLICT (tag) DO UPDATE SET version = version + 1
+    ''', [(tag,) for tag in tags])
+
+def cache_tag_versions(tags, databases=None):
+    """Версии тегов; по нескольким файлам БД (шардам) - сумма, она тоже только растет"""
+    versions = dict.fromkeys(tags, 0)
+    for database in databases or [None]:
+        conn = get_read_db(database)
+        for tag, version in conn.execute(
+                f"SELECT tag, version FROM cache_tags WHERE tag IN ({', '.join('?' for _ in tags)})", tags):
+            versions[tag] += version
+        conn.close()
+    return tuple(versions.values())
+
+def cached_json(key, tags, build, databases=None):
+    """Вернуть ответ из кэша или построить его через build() и сохранить, если это 200.
+
+    Версии тегов читаются до build(): если запись пройдет между чтением
+    версий и ответом, ответ сохранится со старыми версиями и будет
+    отброшен при следующем обращении.
+    """
+    versions = cache_tag_versions(tags, databases)
+    body = _response_cache.get(key, versions)
+    if body is not None:
+        response = app.response_class(body, mimetype='application/json')
+        response.headers['X-Cache'] = 'HIT'
+        return response
+    response = app.make_response(build())
+    if response.status_code == 200:
+        _response_cache.put(key, versions, response.get_data())
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+def cached_response(name, tags):
+    """Декоратор: ответ 200 кэшируется по имени маршрута и параметрам запроса.
+
+    Для ответов, не зависящих от пользователя; применяется после admin_required.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = (name, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+            return cached_json(key, tags, lambda: f(*args, **kwargs))
+        return decorated_function
+    return decorator
+
+# === ЖУРНАЛ ИЗМЕНЕНИЙ (change_log) ===
+# Источник - файл БД с журналом (основная БД или шард заказов) по имени
+# файла. Потребитель читает события после своего курсора и подтверждает
+# обработанное; сжатие удаляет события, подтвержденные всеми потребителями,
+# и события старше CHANGE_LOG_MAX_AGE.
+CHANGE_LOG_FETCH = 1000
+CHANGE_LOG_LIMIT = 10000
+CHANGE_LOG_MAX_LIMIT = 100000
+# Сжатие удаляет не больше стольких событий за операцию записи, чтобы
+# не задерживать очередь записи одной большой транзакцией
+CHANGE_LOG_COMPACT_BATCH = 5000
+CHANGE_CONSUMER_NAME = re.compile(r'[A-Za-z0-9_.-]{1,64}')
+
+def change_log_sources():
+    """{имя источника: файл БД} для основной БД и шардов заказов"""
+    return {os.path.basename(database): database for database in all_databases()}
+
+def change_consumer_cursor(consumer):
+    """Подтвержденные позиции потребителя: {источник: seq}"""
+    conn = get_read_db()
+    rows = conn.execute('SELECT source, seq FROM change_consumers WHERE consumer = ?', (consumer,)).fetchall()
+    conn.close()
+    return {row['source']: row['seq'] for row in rows}
+
+def stream_change_log(sources, cursor, limit):
+    """Строки NDJSON: события после cursor по источникам, в конце - новый курсор.
+
+    Событие читается порциями по CHANGE_LOG_FETCH строк без загрузки всей
+    выборки в память. gaps - источники, где события после курсора уже
+    удалены сжатием по возрасту: потребителю нужна полная сверка.
+    """
+    cursor = dict(cursor)
+    gaps = []
+    remaining = limit
+    has_more = False
+    for source, database in sources.items():
+        conn = get_read_db(database)
+        try:
+            since = cursor.get(source, 0)
+            # Первое доступное событие; журнал пуст - следующий номер после последнего выданного
+            oldest = conn.execute('''
+                SELECT IFNULL((SELECT MIN(seq) FROM change_log),
+                              (SELECT seq + 1 FROM sqlite_sequence WHERE name = 'change_log'))
+            ''').fetchone()[0]
+            if oldest is not None and oldest > since + 1:
+                gaps.append(source)
+            rows = conn.execute('''
+                SELECT seq, table_name, row_id, operation, columns, changed_at
+                FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?
+            ''', (since, remaining + 1))
+            while remaining:
+                batch = rows.fetchmany(min(CHANGE_LOG_FETCH, remaining))
+                if not batch:
+                    break
+                remaining -= len(batch)
+                cursor[source] = batch[-1]['seq']
+                yield ''.join(json.dumps({
+                    'source': source,
+                    'seq': row['seq'],
+                    'table': row['table_name'],
+                    'rowId': row['row_id'],
+                    'operation': row['operation'],
+                    'columns': row['columns'].split(',') if row['columns'] else [],
+                    'changedAt': row['changed_at']
+                }, ensure_ascii=False) + '\n' for row in batch)
+            has_more = has_more or rows.fetchone() is not None
+        finally:
+            conn.close()
+    yield json.dumps({'cursor': cursor, 'count': limit - remaining, 'hasMore': has_more, 'gaps': gaps}) + '\n'
+
+def ack_change_consumer(consumer, cursor):
+    """Сохранить позиции потребителя; позиция только растет"""
+    run_write(lambda db: db.executemany('''
+        INSERT INTO change_consumers (consumer, source, seq, acked_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (consumer, source) DO UPDATE
+        SET seq = MAX(seq, excluded.seq), acked_at = excluded.acked_at
+    ''', [(consumer, source, seq) for source, seq in cursor.items()]))
+
+def compact_change_log():
+    """Удалить события, подтвержденные всеми потребителями источника, и события старше CHANGE_LOG_MAX_AGE.
+
+    Потребитель, ни разу не подтверждавший источник (новый шард, первое
+    чтение), считается стоящим на seq 0 и удерживает весь журнал источника.
+    Удаление идет пачками по CHANGE_LOG_COMPACT_BATCH событий.
+    """
+    sources = change_log_sources()
+    conn = get_read_db()
+    positions = {(row['consumer'], row['source']): row['seq'] for row in conn.execute(
+        'SELECT consumer, source, seq FROM change_consumers').fetchall()}
+    conn.close()
+    consumers = {consumer for consumer, _ in positions}
+    acked = {source: min((positions.get((consumer, source), 0) for consumer in consumers), default=0)
+             for source in sources}
+    max_age = f"-{int(app.config['CHANGE_LOG_MAX_AGE'])} seconds"
+
+    def compact(cursor, source):
+        # Журнал упорядочен по времени: граница возраста - первое событие не старше CHANGE_LOG_MAX_AGE
+        cursor.execute("SELECT seq FROM change_log WHERE changed_at >= datetime('now', ?) ORDER BY seq LIMIT 1",
+                       (max_age,))
+        fresh = cursor.fetchone()
+        expired = fresh[0] - 1 if fresh else cursor.execute('SELECT IFNULL(MAX(seq), 0) FROM change_log').fetchone()[0]
+        cursor.execute('DELETE FROM change_log WHERE seq IN '
+                       '(SELECT seq FROM change_log WHERE seq <= ? ORDER BY seq LIMIT ?)',
+                       (max(expired, acked[source]), CHANGE_LOG_COMPACT_BATCH))
+        return cursor.rowcount
+
+    result = {}
+    for source, database in sources.items():
+        result[source] = 0
+        while True:
+            deleted = run_write(lambda cursor, source=source: compact(cursor, source), database)
+            result[source] += deleted
+            if deleted < CHANGE_LOG_COMPACT_BATCH:
+                break
+    return result if len(result) > 1 else next(iter(result.values()))
+
+# === МАССОВЫЕ ОПЕРАЦИИ ===
+BULK_MAX_ITEMS = 1000
+# Размер пачки id в одном IN (...): ниже лимита параметров старых сборок SQLite
+BULK_CHUNK = 500
+
+def parse_bulk_ids(data, field):
+    """Список id из тела запроса без повторов; ValueError при ошибке формата"""
+    ids = data.get(field)
+    if not isinstance(ids, list) or not ids:
+        raise ValueError(f'{field} должен быть непустым массивом')
+    if len(ids) > BULK_MAX_ITEMS:
+        raise ValueError(f'Не более {BULK_MAX_ITEMS} элементов за запрос')
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise ValueError(f'{field} должен содержать только числа')
+    return list(dict.fromkeys(ids))
+
+def fetch_rows_by_ids(cursor, query, ids):
+    """Выполнить query с {marks} вместо списка id пачками; вернуть строки по id"""
+    rows = {}
+    for start in range(0, len(ids), BULK_CHUNK):
+        chunk = ids[start:start + BULK_CHUNK]
+        cursor.execute(query.format(marks=', '.join('?' for _ in chunk)), chunk)
+        rows.update((row['id'], row) for row in cursor.fetchall())
+    return rows
+
+def bulk_response(results):
+    succeeded = sum(1 for item in results if item['success'])
+    return jsonify({
+        'success': True,
+        'processed': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'results': results
+    })
+
+# === КОДЫ ПОДТВЕРЖДЕНИЯ ===
+VERIFICATION_PURPOSES = ('register', 'reset_password')
+# Цели, код которых можно вернуть в ответе в демо-режиме (VERIFICATION_EXPOSE_CODE)
+VERIFICATION_EXPOSABLE_PURPOSES = ('register',)
+
+class VerificationCodeStore:
+    """Активные коды подтверждения в памяти: (contact, purpose) -> запись.
+
+    Срок действия проверяется лениво при обращении; purge() убирает
+    истекшие записи целиком. Таблица verification_codes - копия для
+    надежности (write-through), из нее запись подгружается после
+    перезапуска или в другом процессе.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['expires_at'] <= now:
+                del self.entries[key]
+                return None
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+    def pop(self, key):
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    def attempt(self, key, entry, code_hash, attempts):
+        """Учесть попытку ввода кода; True - код совпал.
+
+        attempts - счетчик неудачных попыток из таблицы (None - код там уже
+        погашен). Погашенный или исчерпавший попытки код убирается, если
+        запись key не заменена новым кодом.
+        """
+        with self.lock:
+            matched = attempts is not None and hmac.compare_digest(entry['hash'], code_hash)
+            if not matched and attempts is not None:
+                entry['attempts'] = max(entry['attempts'] + 1, attempts)
+            if (matched or attempts is None or entry['attempts'] >= app.config['VERIFICATION_MAX_ATTEMPTS']) \
+                    and self.entries.get(key) is entry:
+                del self.entries[key]
+            return matched
+
+    def purge(self, now):
+        with self.lock:
+            expired = [key for key, entry in self.entries.items() if entry['expires_at'] <= now]
+            for key in expired:
+                del self.entries[key]
+        return len(expired)
+
+_verification_codes = VerificationCodeStore()
+_verification_last_purge = [time.time()]
+
+def hash_verification_code(contact, purpose, code):
+    """HMAC кода: в памяти и в таблице сам код не хранится"""
+    message = f'{purpose}:{contact}:{code}'.encode('utf-8')
+    return hmac.new(app.secret_key.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def load_verification_entry(contact, purpose, now):
+    """Подгрузить последний неиспользованный код из таблицы (после перезапуска)"""
+    conn = get_read_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, code, expires_at, attempts, created_at FROM verification_codes
+        WHERE contact = ? AND purpose = ? AND used = 0
+        ORDER BY id DESC LIMIT 1
+    ''', (contact, purpose))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    expires_at = datetime.fromisoformat(str(row['expires_at'])).timestamp()
+    if expires_at <= now:
+        return None
+    entry = {'id': row['id'], 'hash': row['code'], 'expires_at': expires_at, 'issued_at': 0,
+             'attempts': row['attempts'] or 0}
+    _verification_codes.put((contact, purpose), entry)
+    return entry
+
+def issue_verification_code(contact, purpose):
+    """Выпустить новый код. Возвращает (код, None) или (None, секунд до повторной отправки)"""
+    now = time.time()
+    key = (contact, purpose)
+    entry = _verification_codes.get(key, now)
+    if entry is not None and now - entry['issued_at'] < app.config['VERIFICATION_RESEND_AFTER']:
+        return None, int(app.config['VERIFICATION_RESEND_AFTER'] - (now - entry['issued_at'])) + 1
+    length = app.config['VERIFICATION_CODE_LENGTH']
+    code = f'{secrets.randbelow(10 ** length):0{length}d}'
+    code_hash = hash_verification_code(contact, purpose, code)
+    expires_at = now + app.config['VERIFICATION_CODE_TTL']
+    def write(cursor):
+        # Предыдущие коды для того же контакта больше не действуют
+        cursor.execute('''
+            UPDATE verification_codes SET used = 1
+            WHERE contact = ? AND purpose = ? AND used = 0
+        ''', (contact, purpose))
+        cursor.execute('''
+            INSERT INTO verification_codes (contact, code, purpose, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (contact, code_hash, purpose, datetime.fromtimestamp(expires_at)))
+        return cursor.lastrowid
+    row_id = run_write(write)
+    _verification_codes.put(key, {'id': row_id, 'hash': code_hash, 'expires_at': expires_at,
+                                  'issued_at': now, 'attempts': 0})
+    # Таблицу чистит планировщик обслуживания, память - каждый процесс сам
+    if now - _verification_last_purge[0] > app.config['VERIFICATION_PURGE_INTERVAL']:
+        _verification_last_purge[0] = now
+        _verification_codes.purge(now)
+    return code, None
+
+def check_verification_code(contact, purpose, code):
+    """Проверить код; успешно проверенный или исчерпавший попытки код погашается"""
+    now = time.time()
+    key = (contact, purpose)
+    entry = _verification_codes.get(key, now) or load_verification_entry(contact, purpose, now)
+    if entry is None:
+        return False, 'Код истек или не запрашивался'
+    code_hash = hash_verification_code(contact, purpose, code)
+    max_attempts = app.config['VERIFICATION_MAX_ATTEMPTS']
+    def write(cursor):
+        # Погашение и счетчик попыток - в одной транзакции: параллельные
+        # проверки в разных процессах не превысят VERIFICATION_MAX_ATTEMPTS
+        if hmac.compare_digest(entry['hash'], code_hash):
+            cursor.execute('UPDATE verification_codes SET used = 1 WHERE id = ? AND used = 0', (entry['id'],))
+            return 0 if cursor.rowcount else None
+        cursor.execute('''
+            UPDATE verification_codes SET attempts = COALESCE(attempts, 0) + 1,
+                used = CASE WHEN COALESCE(attempts, 0) + 1 >= ? THEN 1 ELSE used END
+            WHERE id = ? AND used = 0
+        ''', (max_attempts, entry['id']))
+        if not cursor.rowcount:
+            return None
+        cursor.execute('SELECT attempts FROM verification_codes WHERE id = ?', (entry['id'],))
+        return cursor.fetchone()[0]
+    attempts = run_write(write)
+    if _verification_codes.attempt(key, entry, code_hash, attempts):
+        return True, None
+    if attempts is None:
+        return False, 'Код истек или не запрашивался'
+    if attempts >= max_attempts:
+        return False, 'Превышено число попыток, запросите новый код'
+    return False, 'Неверный код подтверждения'
+
+def purge_verification_codes():
+    """Удалить истекшие и использованные коды из памяти и одним запросом из таблицы"""
+    _verification_last_purge[0] = time.time()
+    removed = _verification_codes.purge(time.time())
+    deleted = run_write(lambda cursor: cursor.execute(
+        'DELETE FROM verification_codes WHERE used = 1 OR expires_at < ?', (datetime.now(),)
+    ).rowcount)
+    return {'memory': removed, 'table': deleted}
+
+def mark_contact_verified(purpose, contact):
+    """Запомнить в сессии подтвержденный контакт"""
+    verified = dict(session.get('verified', {}))
+    verified[purpose] = {'contact': contact, 'expires': time.time() + app.config['VERIFICATION_VERIFIED_TTL']}
+    session['verified'] = verified
+
+def is_contact_verified(purpose, contact):
+    """Подтвержден ли контакт для цели в текущей сессии"""
+    if not app.config['VERIFICATION_REQUIRED']:
+        return True
+    item = session.get('verified', {}).get(purpose)
+    return bool(item) and item['contact'] == contact and item['expires'] > time.time()
+
+def clear_verified_contact(purpose):
+    verified = dict(session.get('verified', {}))
+    if verified.pop(purpose, None) is not None:
+        session['verified'] = verified
+
+# === ПЛАНИРОВЩИК ОБСЛУЖИВАНИЯ БД ===
+class LatencyMonitor:
+    """Скользящее среднее времени ответа (EWMA) для решения об отсрочке обслуживания"""
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.average = 0.0
+        self.last_seen = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.average += self.alpha * (seconds - self.average)
+            self.last_seen = time.monotonic()
+
+    def current(self, idle_after):
+        """Среднее время ответа; если запросов давно не было - 0 (сервис простаивает)"""
+        with self.lock:
+            if time.monotonic() - self.last_seen > idle_after:
+                return 0.0
+            return self.average
+
+_latency = LatencyMonitor()
+
+def maintenance_checkpoint(database=None):
+    """Перенести WAL в основную БД, не дожидаясь читателей.
+
+    Контрольная точка не выполняется внутри транзакции, поэтому идет мимо
+    потока записи; режим PASSIVE не берет блокировку записи и не мешает ему.
+    """
+    conn = get_db(database)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    busy, wal_frames, checkpointed = cursor.fetchone()
+    conn.close()
+    return {'busy': bool(busy), 'walFrames': wal_frames, 'checkpointedFrames': checkpointed}
+
+def maintenance_optimize(database=None):
+    """Обновить статистику планировщика запросов (ANALYZE при первом запуске).
+
+    Идет через поток записи файла: ANALYZE пишет sqlite_stat1 и не должен
+    ждать блокировку записи в обход очереди.
+    """
+    def write(cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        analyze = cursor.fetchone() is None
+        cursor.execute('ANALYZE' if analyze else 'PRAGMA optimize')
+        cursor.fetchall()
+        return {'analyze': analyze}
+    return run_write(write, database)
+
+def incremental_vacuum(cursor, pages, schema='main'):
+    """Освободить до pages свободных страниц; (освобождено, осталось свободных).
+
+    incremental_vacuum возвращает одну страницу за шаг запроса, а sqlite3
+    делает только первый шаг запроса без строк, поэтому PRAGMA повторяется.
+    """
+    cursor.execute(f'PRAGMA {schema}.freelist_count')
+    free_before = cursor.fetchone()[0]
+    for _ in range(min(free_before, pages)):
+        cursor.execute(f'PRAGMA {schema}.incremental_vacuum(1)')
+    cursor.execute(f'PRAGMA {schema}.freelist_count')
+    free_after = cursor.fetchone()[0]
+    return free_before - free_after, free_after
+
+def maintenance_vacuum(database=None):
+    """Вернуть ограниченную порцию свободных страниц БД (через поток записи файла)"""
+    def write(cursor):
+        reclaimed, free = incremental_vacuum(cursor, int(app.config['ARCHIVE_VACUUM_PAGES']))
+        return {'reclaimedPages': reclaimed, 'freePages': free}
+    return run_write(write, database)
+
+def on_all_databases(task):
+    """Выполнить задачу обслуживания для основной БД и каждого шарда заказов"""
+    databases = all_databases()
+    if len(databases) == 1:
+        return task(databases[0])
+    return {os.path.basename(database): task(database) for database in databases}
+
+MAINTENANCE_TASKS = {
+    'checkpoint': lambda: on_all_databases(maintenance_checkpoint),
+    'optimize': lambda: on_all_databases(maintenance_optimize),
+    'vacuum': lambda: on_all_databases(maintenance_vacuum),
+    'verification_purge': lambda: purge_verification_codes(),
+    'archive': lambda: archive_finished_orders(),
+    'gps_retention': lambda: drop_expired_gps_partitions(),
+    'idempotency_purge': lambda: purge_idempotency_keys(),
+    'change_log_compaction': lambda: compact_change_log(),
+    'driver_rollup': lambda: refresh_driver_rollups(),
+    'driver_rollup_rebuild': lambda: refresh_driver_rollups(rebuild=True),
+}
+
+class MaintenanceScheduler:
+    """Фоновый поток обслуживания БД.
+
+    При нескольких процессах (gunicorn -w N) задачи выполняет только
+    владелец аренды в таблице maintenance_lease; остальные процессы
+    периодически пытаются ее перехватить, если владелец пропал. История
+    запусков хранится в maintenance_tasks, поэтому новый владелец
+    продолжает расписание, а не начинает его заново. Пока сервис
+    нагружен (среднее время ответа или очередь записи выше порога),
+    задачи откладываются, но не дольше MAINTENANCE_MAX_DEFER интервалов.
+    """
+    def __init__(self, database):
+        self.database = database
+        self.pid = os.getpid()
+        self.owner = f'{self.pid}-{secrets.token_hex(4)}'
+        self.started = time.time()
+        self.leader = False
+        self.busy = None
+        self.deferred = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='db-maintenance', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(app.config['MAINTENANCE_TICK']):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[ERROR] MaintenanceScheduler: {e}", file=sys.stderr)
+
+    def acquire_lease(self, now):
+        """Продлить свою аренду или занять просроченную чужую"""
+        expires_at = now + app.config['MAINTENANCE_LEASE_TTL']
+        def write(cursor):
+            cursor.execute('''
+                INSERT INTO maintenance_lease (id, owner, expires_at) VALUES (1, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE maintenance_lease.owner = excluded.owner OR maintenance_lease.expires_at < ?
+            ''', (self.owner, expires_at, now))
+            return cursor.rowcount
+        self.leader = run_write(write) == 1
+        return self.leader
+
+    def busy_reason(self):
+        """Причина отложить обслуживание или None"""
+        latency = _latency.current(idle_after=app.config['MAINTENANCE_TICK'])
+        if latency > app.config['MAINTENANCE_BUSY_LATENCY']:
+            return f'Среднее время ответа {latency * 1000:.0f} мс'
+        if app.config['WRITER_MODE'] == 'queue':
+            depth = get_writer().queue.qsize()
+            if depth > app.config['MAINTENANCE_BUSY_QUEUE']:
+                return f'Очередь записи: {depth}'
+        return None
+
+    def tick(self):
+        now = time.time()
+        if not self.acquire_lease(now):
+            return
+        conn = get_read_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, last_run FROM maintenance_tasks')
+        last_runs = {row['name']: row['last_run'] for row in cursor.fetchall()}
+        conn.close()
+        self.busy = self.busy_reason()
+        for name, interval in app.config['MAINTENANCE_INTERVALS'].items():
+            overdue = now - last_runs.get(name, self.started) - interval
+            if overdue < 0:
+                continue
+            if self.busy and overdue < interval * (app.config['MAINTENANCE_MAX_DEFER'] - 1):
+                self.deferred += 1
+                continue
+            self.run_task(name)
+
+    def run_task(self, name):
+        """Выполнить задачу и записать результат в maintenance_tasks"""
+        started = time.time()
+        result, error = None, None
+        try:
+            result = MAINTENANCE_TASKS[name]()
+        except Exception as e:
+            error = str(e)
+            print(f"[ERROR] Обслуживание {name}: {e}", file=sys.stderr)
+        duration = time.time() - started
+        run_write(lambda cursor: cursor.execute('''
+            INSERT INTO maintenance_tasks (name, last_run, duration, runs, result, error)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET last_run = excluded.last_run, duration = excluded.duration,
+                runs = runs + 1, result = excluded.result, error = excluded.error
+        ''', (name, started, duration, json.dumps(result, ensure_ascii=False), error)))
+        return result, error
+
+_maintenance = None
+_maintenance_lock = threading.Lock()
+
+def get_maintenance():
+    """Планировщик обслуживания текущего процесса (создается лениво, в том числе после fork)"""
+    global _maintenance
+    with _maintenance_lock:
+        if _maintenance is None or _maintenance.pid != os.getpid() or _maintenance.database != app.config['DATABASE']:
+            _maintenance = MaintenanceScheduler(app.config['DATABASE'])
+        return _maintenance
+
+def trace_requested():
+    """Запрошена ли трасса заголовком X-Trace.
+
+    Значение TRACE_SECRET включает трассу для любого клиента, X-Trace: 1 -
+    только в сессии администратора: иначе анонимный клиент мог бы
+    трассировать каждый свой запрос и вытеснять трассы из кольца.
+    """
+    value = request.headers.get('X-Trace', '').strip()
+    if not value:
+        return False
+    secret = app.config['TRACE_SECRET']
+    if secret and hmac.compare_digest(value.encode('utf-8'), secret.encode('utf-8')):
+        return True
+    if value.lower() not in ('1', 'true', 'yes') or 'user_id' not in session:
+        return False
+    conn = get_read_db()
+    is_admin = UserRepo.is_admin(conn, session['user_id'])
+    conn.close()
+    return is_admin
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    request_id = request.headers.get('X-Request-Id', '')
+    g.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else secrets.token_hex(8)
+    if random.random() < app.config['TRACE_SAMPLE_RATE'] or trace_requested():
+        rule = request.url_rule.rule if request.url_rule else request.path
+        _trace_local.trace = RequestTrace(secrets.token_hex(8), g.request_id, f'{request.method} {rule}')
+    if app.config['MAINTENANCE_ENABLED'] and (_maintenance is None or _maintenance.pid != os.getpid()):
+        get_maintenance()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        _latency.record(time.perf_counter() - started)
+    if g.get('request_id'):
+        response.headers['X-Request-Id'] = g.request_id
+    trace = current_trace()
+    if trace is not None:
+        response.headers['X-Trace-Id'] = trace.trace_id
+        trace.finished = time.perf_counter()
+        trace.status = response.status_code
+        trace.add(trace.name, 'request', trace.started, trace.finished, {'status': response.status_code})
+        _traces.add(trace)
+    return response
+
+@app.after_request
+def apply_write_timeout(response):
+    """Ответ запроса, чья запись не дождалась потока записи (WriteTimeout).
+
+    Большинство обработчиков превращают любое исключение в 500; здесь ответ
+    заменяется на 503 (запись отменена, повторите) или 202 (запись еще
+    выполняется) с Retry-After, чтобы клиент не повторял запрос вслепую.
+    """
+    error = g.pop('write_timeout', None)
+    if error is None:
+        return response
+    response = jsonify({'success': False, 'message': error.message, 'writeStarted': error.started})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(app.config['WRITER_RETRY_AFTER'])
+    return response
+
+@app.teardown_request
+def unbind_request_trace(error=None):
+    _trace_local.trace = None
+
+@app.teardown_request
+def release_read_connections(error=None):
+    """Вернуть в пул соединения чтения, которые обработчик не закрыл (исключение до close())"""
+    for conn in g.pop('read_connections', ()):
+        if conn.pool is not None and id(conn) in conn.pool.leased:
+            conn.close()
+
+# === ВЫБОРКА ПОЛЕЙ (fields= / view=) ===
+# Разрешенные поля ресурса: имя поля в ответе -> выражение в SELECT
+ORDER_FIELDS = {name: name for name in (
+    'id', 'user_id', 'driver_id', 'sender_name', 'sender_phone', 'sender_email',
+    'cargo_description', 'product_category', 'cargo_weight', 'cargo_volume', 'cargo_type',
+    'shipping_date', 'pickup_address', 'delivery_address', 'distance', 'price',
+    'insurance', 'packaging', 'comments', 'status', 'client_status', 'admin_comment',
+    'cancellation_reason', 'cancellation_fee', 'refund_amount', 'created_at',
+    'processed_at', 'assigned_at', 'accepted_at', 'in_transit_at', 'delivered_at',
+    'cancelled_at', 'tariff_version', 'updated_at', 'change_seq', 'pickup_city_id', 'delivery_city_id'
+)}
+
+# Именованные представления заказов.
+# compact целиком покрывается индексами idx_orders_*_created,
+# summary - поля, которые выводят списки заказов во фронтенде.
+ORDER_VIEWS = {
+    'compact': ['id', 'user_id', 'driver_id', 'status', 'client_status', 'price', 'created_at'],
+    'summary': [
+        'id', 'user_id', 'driver_id', 'sender_name', 'sender_phone', 'cargo_description',
+        'product_category', 'cargo_type', 'shipping_date', 'pickup_address',
+        'delivery_address', 'distance', 'price', 'status', 'client_status',
+        'created_at', 'delivered_at'
+    ],
+    'full': list(ORDER_FIELDS),
+}
+
+DRIVER_FIELDS = {name: f'd.{name}' for name in (
+    'id', 'user_id', 'license_number', 'experience', 'car_model', 'car_number',
+    'max_weight', 'car_type', 'status', 'work_status', 'completed_deliveries',
+    'hire_date', 'inactive_since', 'inactive_reason', 'resignation_reason',
+    'dismissal_reason', 'dismissed_by'
+)}
+DRIVER_FIELDS.update({name: f'u.{name}' for name in ('first_name', 'last_name', 'phone', 'email')})
+
+DRIVER_VIEWS = {
+    'summary': [
+        'id', 'user_id', 'first_name', 'last_name', 'phone', 'car_model', 'car_number',
+        'car_type', 'max_weight', 'status', 'work_status', 'completed_deliveries', 'hire_date'
+    ],
+    'full': list(DRIVER_FIELDS),
+}
+
+def resolve_fields(allowed, views, default_view='full'):
+    """Определить список полей по параметрам запроса fields= и view=.
+
+    fields - список через запятую, имеет приоритет над view.
+    Неизвестные поля и представления приводят к ValueError.
+    """
+    raw_fields = request.args.get('fields', '').strip()
+    if raw_fields:
+        fields = []
+        for name in raw_fields.split(','):
+            name = name.strip()
+            if not name:
+                continue
+            if name not in allowed:
+                raise ValueError(f'Недопустимое поле: {name}')
+            if name not in fields:
+                fields.append(name)
+        if not fields:
+            raise ValueError('Не указаны поля')
+        return fields
+    view = request.args.get('view', default_view)
+    if view not in views:
+        raise ValueError(f'Неизвестное представление: {view}')
+    return list(views[view])
+
+def select_list(allowed, fields):
+    """SQL-проекция для списка полей (только из белого списка)"""
+    return ', '.join(
+        allowed[name] if allowed[name] == name else f'{allowed[name]} AS {name}'
+        for name in fields
+    )
+
+# === ИЗМЕНЕНИЯ ЗАКАЗОВ ===
+# Курсор - последние change_seq файлов с заказами через точку, по одному на шард
+ORDER_CHANGES_LIMIT = 500
+ORDER_CHANGES_MAX_LIMIT = 2000
+
+def order_change_seqs(databases=None):
+    """Последние выданные change_seq файлов с заказами по порядку"""
+    seqs = []
+    for database in databases or order_databases():
+        conn = get_read_db(database)
+        seqs.append(conn.execute(OrderRepo.LAST_CHANGE_SEQ).fetchone()[0])
+        conn.close()
+    return seqs
+
+def order_change_cursor(databases=None):
+    """Текущий курсор изменений: последние change_seq всех файлов с заказами"""
+    return format_change_cursor(order_change_seqs(databases))
+
+def format_change_cursor(seqs):
+    return '.'.join(str(seq) for seq in seqs)
+
+def parse_change_cursor(value, count):
+    """Список change_seq по файлам БД; None, если курсор пуст или от другого числа шардов"""
+    try:
+        seqs = [int(part) for part in value.split('.')]
+    except ValueError:
+        return None
+    return seqs if len(seqs) == count and min(seqs) >= 0 else None
+
+# === СЧЕТЧИКИ СПИСКА ЗАКАЗОВ ===
+# Поля счетчиков списка заказов (GET /api/orders/facets) в порядке индексов idx_orders*_facets
+ORDER_FACET_COLUMNS = ('status', 'client_status', 'product_category', 'cargo_type', 'shipping_date')
+ORDER_FACET_NAMES = {
+    'status': 'status',
+    'client_status': 'clientStatus',
+    'product_category': 'productCategory',
+    'cargo_type': 'cargoType',
+}
+
+def shipping_date_bucket(shipping_date, today):
+    """Корзина даты отправки относительно today: past, today, week, later или none"""
+    if not shipping_date:
+        return 'none'
+    try:
+        day = datetime.strptime(str(shipping_date)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return 'none'
+    if day < today:
+        return 'past'
+    if day == today:
+        return 'today'
+    return 'week' if day <= today + timedelta(days=7) else 'later'
+
+def fold_order_facets(rows, today):
+    """Свести строки GROUP BY по всем полям счетчиков в отдельные счетчики по каждому полю"""
+    facets = {name: {} for name in ORDER_FACET_NAMES.values()}
+    facets['shippingDate'] = {}
+    total = 0
+    for row in rows:
+        count = row['orders']
+        total += count
+        for column, name in ORDER_FACET_NAMES.items():
+            value = row[column] or ''
+            facets[name][value] = facets[name].get(value, 0) + count
+        bucket = shipping_date_bucket(row['shipping_date'], today)
+        facets['shippingDate'][bucket] = facets['shippingDate'].get(bucket, 0) + count
+    return {'total': total, 'facets': facets}
+
+# === ИСТОРИЯ ЗАКАЗОВ (order_events) ===
+# Этапы жизненного цикла для перцентилей: событие начала (любое из
+# списка) -> событие конца. Начало берется последнее перед концом, поэтому
+# переназначение водителя не искажает длительность.
+ORDER_EVENT_STAGES = {
+    'confirmToAssign': (('confirmed',), 'assigned'),
+    'assignToAccept': (('assigned',), 'accepted'),
+    'transitToDelivered': (('accepted', 'in_transit'), 'delivered'),
+}
+ORDER_STAGE_PERCENTILES = (50, 90, 99)
+ORDER_STAGE_MAX_DAYS = 365
+
+def order_event_time(value):
+    """Время события (секунды эпохи) в строку того же вида, что остальные даты заказа"""
+    return datetime.fromtimestamp(value).isoformat(sep=' ', timespec='seconds')
+
+def percentile_summary(values):
+    """count/avg/max и перцентили ORDER_STAGE_PERCENTILES по возрастающему списку (ближайший ранг)"""
+    if not values:
+        return {'count': 0}
+    summary = {'count': len(values), 'avg': round(sum(values) / len(values), 1), 'max': round(values[-1], 1)}
+    for p in ORDER_STAGE_PERCENTILES:
+        summary[f'p{p}'] = round(values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))], 1)
+    return summary
+
+def order_stage_durations(since):
+    """Длительности этапов ORDER_EVENT_STAGES, завершенных после since, по всем шардам.
+
+    Конец этапа ищется по индексу (type, at), начало - по ключу
+    (order_id, seq); таблица orders не читается.
+    """
+    stages = {}
+    for name, (starts, end) in ORDER_EVENT_STAGES.items():
+        marks = ', '.join('?' for _ in starts)
+        row_lists = scatter_orders(f'''
+            SELECT e.at - s.at AS duration
+            FROM order_events e
+            JOIN order_events s ON s.order_id = e.order_id AND s.seq = (
+                SELECT MAX(seq) FROM order_events
+                WHERE order_id = e.order_id AND seq < e.seq AND type IN ({marks})
+            )
+            WHERE e.type = ? AND e.at >= ?
+        ''', (*starts, end, since))
+        stages[name] = percentile_summary(sorted(row['duration'] for rows in row_lists for row in rows))
+    return stages
+
+# === ПОКАЗАТЕЛИ ВОДИТЕЛЕЙ ===
+# Итоги за периоды для таблицы лидеров: период -> дней (None - вся история)
+DRIVER_ROLLUP_PERIODS = {'week': 7, 'month': 30, 'all': None}
+# Параметр sort -> столбец driver_rollups
+DRIVER_LEADERBOARD_SORTS = {
+    'deliveries': 'deliveries',
+    'onTimeRate': 'on_time_rate',
+    'avgTransit': 'avg_transit',
+    'weeklyVolume': 'weekly_volume',
+    'revenue': 'revenue',
+    'distance': 'distance',
+}
+DRIVER_LEADERBOARD_LIMIT = 50
+DRIVER_LEADERBOARD_MAX_LIMIT = 1000
+
+def driver_delivery_rows(lower, upper, inclusive):
+    """События delivered в (lower, upper] каждого файла заказов с полями заказа.
+
+    lower - список по файлам order_databases(); inclusive - нижняя граница
+    включается (пересчет с начала дня). Время в пути считается от
+    последнего перед доставкой accepted/in_transit, как в ORDER_EVENT_STAGES.
+    """
+    starts = ORDER_EVENT_STAGES['transitToDelivered'][0]
+    marks = ', '.join('?' for _ in starts)
+    return scatter_orders(f'''
+        SELECT e.driver_id, e.at, o.price, o.distance, o.shipping_date,
+               (SELECT s.at FROM order_events s
+                WHERE s.order_id = e.order_id AND s.seq = (
+                    SELECT MAX(seq) FROM order_events
+                    WHERE order_id = e.order_id AND seq < e.seq AND type IN ({marks})
+                )) AS started_at
+        FROM order_events e
+        LEFT JOIN {{source}} o ON o.id = e.order_id
+        WHERE e.type = 'delivered' AND e.driver_id IS NOT NULL
+          AND e.at {'>=' if inclusive else '>'} ? AND e.at <= ?
+    ''', lambda index: (*starts, lower[index], upper))
+
+def fold_driver_deliveries(row_lists):
+    """Сложить доставки в дневные суммы {(driver_id, день): [deliveries, on_time,
+    with_deadline, transit_seconds, transit_count, revenue, distance]}.
+
+    Срок доставки - shipping_date плюс день на каждые ON_TIME_KM_PER_DAY км
+    (не меньше одного дня); заказы без shipping_date в долю вовремя не входят.
+    """
+    km_per_day = app.config['ON_TIME_KM_PER_DAY']
+    daily = {}
+    for rows in row_lists:
+        for row in rows:
+            day = datetime.fromtimestamp(row['at']).date()
+            stats = daily.setdefault((row['driver_id'], day.isoformat()), [0, 0, 0, 0.0, 0, 0.0, 0.0])
+            distance = row['distance'] or 0
+            stats[0] += 1
+            stats[5] += row['price'] or 0
+            stats[6] += distance
+            if row['started_at'] is not None:
+                stats[3] += row['at'] - row['started_at']
+                stats[4] += 1
+            if row['shipping_date']:
+                try:
+                    shipped = datetime.strptime(str(row['shipping_date'])[:10], '%Y-%m-%d').date()
+                except ValueError:
+                    continue
+                stats[2] += 1
+                if day <= shipped + timedelta(days=max(1, -(-distance // km_per_day))):
+                    stats[1] += 1
+    return daily
+
+def rebuild_driver_rollups(cursor, driver_ids=None):
+    """Пересчитать driver_rollups из driver_daily_stats (всех водителей или только driver_ids).
+
+    weekly_volume - доставок в неделю: за неделю/месяц делится на длину
+    периода, за всю историю - на срок с первого дня с доставками.
+    """
+    today = datetime.now().date()
+    where, params = '', ()
+    if driver_ids is not None:
+        where = f"AND driver_id IN ({', '.join('?' for _ in driver_ids)})"
+        params = tuple(driver_ids)
+    cursor.execute(f'DELETE FROM driver_rollups WHERE 1 {where}', params)
+    for period, days in DRIVER_ROLLUP_PERIODS.items():
+        since = (today - timedelta(days=days - 1)).isoformat() if days else ''
+        cursor.execute(f'''
+            INSERT INTO driver_rollups (period, driver_id, deliveries, on_time, with_deadline,
+                                        on_time_rate, avg_transit, weekly_volume, revenue, distance)
+            SELECT ?, driver_id, SUM(deliveries), SUM(on_time), SUM(with_deadline),
+                   CASE WHEN SUM(with_deadline) > 0 THEN 1.0 * SUM(on_time) / SUM(with_deadline) END,
+                   CASE WHEN SUM(transit_count) > 0 THEN SUM(transit_seconds) / SUM(transit_count) END,
+                   SUM(deliveries) * 7.0 / MAX(?, julianday(?) - julianday(MIN(day)) + 1),
+                   SUM(revenue), SUM(distance)
+            FROM driver_daily_stats
+            WHERE day >= ? {where}
+            GROUP BY driver_id
+        ''', (period, days or 7, today.isoformat(), since, *params))
+
+def refresh_driver_rollups(rebuild=False):
+    """Учесть новые доставки в driver_daily_stats и обновить driver_rollups.
+
+    Обычный проход читает события после сохраненной отметки каждого файла
+    заказов и пересчитывает итоги только затронутых водителей. rebuild
+    (ночная задача) заново считает последние DRIVER_ROLLUP_REBUILD_DAYS
+    дней и итоги всех водителей, чтобы недельное окно сдвигалось. Без
+    отметок (первый запуск) считается вся история; если отметки нет только
+    у части файлов (после reshard_orders.py), выполняется rebuild.
+    """
+    databases = order_databases()
+    sources = [os.path.basename(database) for database in databases]
+    conn = get_read_db()
+    marks = {row['source']: row['watermark']
+             for row in conn.execute('SELECT source, watermark FROM driver_rollup_watermarks')}
+    conn.close()
+    now = time.time()
+    upper = now - app.config['DRIVER_ROLLUP_LAG']
+    from_day = None
+    if not marks:
+        rebuild = True
+        lower = [0] * len(sources)
+    elif rebuild or any(source not in marks for source in sources):
+        rebuild = True
+        start = datetime.combine(datetime.now().date() - timedelta(days=app.config['DRIVER_ROLLUP_REBUILD_DAYS']),
+                                 datetime.min.time())
+        from_day = start.date().isoformat()
+        lower = [start.timestamp()] * len(sources)
+    else:
+        lower = [marks[source] for source in sources]
+    daily = fold_driver_deliveries(driver_delivery_rows(lower, upper, inclusive=rebuild))
+
+    def write(cursor):
+        if rebuild:
+            cursor.execute('DELETE FROM driver_daily_stats WHERE day >= ?', (from_day or '',))
+        cursor.executemany('''
+            INSERT INTO driver_daily_stats (driver_id, day, deliveries, on_time, with_deadline,
+                                            transit_seconds, transit_count, revenue, distance)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (driver_id, day) DO UPDATE SET
+                deliveries = deliveries + excluded.deliveries,
+                on_time = on_time + excluded.on_time,
+                with_deadline = with_deadline + excluded.with_deadline,
+                transit_seconds = transit_seconds + excluded.transit_seconds,
+                transit_count = transit_count + excluded.transit_count,
+                revenue = revenue + excluded.revenue,
+                distance = distance + excluded.distance
+        ''', [(*key, *stats) for key, stats in daily.items()])
+        # Отметки прежнего набора файлов после перераспределения не нужны
+        cursor.execute('DELETE FROM driver_rollup_watermarks')
+        cursor.executemany('INSERT INTO driver_rollup_watermarks (source, watermark, updated_at) VALUES (?, ?, ?)',
+                           [(source, upper, now) for source in sources])
+        rebuild_driver_rollups(cursor, None if rebuild else sorted({driver_id for driver_id, _ in daily}))
+
+    run_write(write)
+    return {'rebuild': rebuild, 'deliveries': sum(stats[0] for stats in daily.values()),
+            'drivers': len({driver_id for driver_id, _ in daily})}
+
+# === АНАЛИТИКА (колоночный куб заказов) ===
+# Куб держит столбцы заказов (вместе с архивом) в непрерывных массивах
+# NumPy; категории хранятся кодами словаря. Каждый процесс сервера строит
+# свой куб при первом запросе и дочитывает заказы с change_seq больше
+# запомненного. Архивированные заказы не меняются, поэтому их удаление из
+# горячих таблиц кубу безразлично.
+# Параметр запроса -> числовой столбец orders
+ANALYTICS_NUMBERS = {
+    'price': 'price',
+    'distance': 'distance',
+    'weight': 'cargo_weight',
+    'volume': 'cargo_volume',
+    'insurance': 'insurance',
+    'packaging': 'packaging',
+}
+ANALYTICS_CATEGORIES = {
+    'cargoType': 'cargo_type',
+    'productCategory': 'product_category',
+    'status': 'status',
+    'clientStatus': 'client_status',
+}
+ANALYTICS_DATES = {'created': 'created_at', 'shipping': 'shipping_date'}
+ANALYTICS_BUCKETS = ('Day', 'Week', 'Month')
+ANALYTICS_FLAGS = ('insurance', 'packaging')
+# Измерения группировки: категории, флаги и даты по дням/неделям/месяцам (createdWeek)
+ANALYTICS_DIMENSIONS = (tuple(ANALYTICS_CATEGORIES) + ANALYTICS_FLAGS
+                        + tuple(date + bucket for date in ANALYTICS_DATES for bucket in ANALYTICS_BUCKETS))
+# Производные показатели: цена за км считается только по заказам с distance > 0
+ANALYTICS_FIELDS = tuple(ANALYTICS_NUMBERS) + ('pricePerKm',)
+ANALYTICS_OPS = ('count', 'sum', 'avg', 'min', 'max')
+ANALYTICS_MAX_DIMENSIONS = 4
+ANALYTICS_MAX_METRICS = 16
+ANALYTICS_LIMIT = 1000
+ANALYTICS_MAX_LIMIT = 10000
+
+def analytics_days(values):
+    """Даты (строки ГГГГ-ММ-ДД...) в дни от 1970-01-01; пустые и нечитаемые - NaT"""
+    strings = [str(value)[:10] if value else 'NaT' for value in values]
+    try:
+        return np.array(strings, dtype='datetime64[D]').astype(np.int64)
+    except ValueError:
+        days = []
+        for value in strings:
+            try:
+                days.append(np.datetime64(value, 'D'))
+            except ValueError:
+                days.append(np.datetime64('NaT'))
+        return np.array(days, dtype='datetime64[D]').astype(np.int64)
+
+class OrderCube:
+    """Столбцы заказов в памяти процесса для группировок POST /api/admin/analytics/query"""
+
+    NAT = np.iinfo(np.int64).min if np else None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.size = 0
+        self.positions = {}  # id заказа -> строка куба
+        self.ids = np.empty(0, dtype=np.int64)
+        self.numbers = {name: np.empty(0, dtype=np.float64) for name in ANALYTICS_NUMBERS}
+        self.codes = {name: np.empty(0, dtype=np.int32) for name in ANALYTICS_CATEGORIES}
+        self.dictionaries = {name: [] for name in ANALYTICS_CATEGORIES}
+        self.lookups = {name: {} for name in ANALYTICS_CATEGORIES}
+        self.days = {name: np.empty(0, dtype=np.int64) for name in ANALYTICS_DATES}
+        self.databases = None
+        self.seqs = None
+        self.refreshed_at = None
+        self.refreshed = 0.0
+
+    def columns(self):
+        return ', '.join(('id', *ANALYTICS_NUMBERS.values(), *ANALYTICS_CATEGORIES.values(),
+                          *ANALYTICS_DATES.values()))
+
+    def reserve(self, extra):
+        """Увеличить емкость массивов вдвое, если новые строки не помещаются"""
+        needed = self.size + extra
+        if needed <= len(self.ids):
+            return
+        capacity = max(needed, 2 * len(self.ids), 1024)
+
+        def grow(column):
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            return grown
+
+        self.ids = grow(self.ids)
+        self.numbers = {name: grow(column) for name, column in self.numbers.items()}
+        self.codes = {name: grow(column) for name, column in self.codes.items()}
+        self.days = {name: grow(column) for name, column in self.days.items()}
+
+    def encode(self, name, values):
+        """Коды словаря категории name; новые значения дописываются в словарь"""
+        lookup, dictionary = self.lookups[name], self.dictionaries[name]
+        codes = []
+        for value in values:
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(dictionary)
+                dictionary.append(value)
+            codes.append(code)
+        return np.array(codes, dtype=np.int32)
+
+    def store(self, rows):
+        """Записать строки заказов: известные id перезаписываются на месте, новые дописываются"""
+        if not rows:
+            return
+        self.reserve(len(rows))
+        slots = []
+        for row in rows:
+            slot = self.positions.get(row['id'])
+            if slot is None:
+                slot = self.positions[row['id']] = self.size
+                self.size += 1
+            slots.append(slot)
+        slots = np.array(slots, dtype=np.int64)
+        self.ids[slots] = [row['id'] for row in rows]
+        for name, column in ANALYTICS_NUMBERS.items():
+            # None становится NaN и не участвует в суммах и средних
+            self.numbers[name][slots] = np.array([row[column] for row in rows], dtype=np.float64)
+        for name, column in ANALYTICS_CATEGORIES.items():
+            self.codes[name][slots] = self.encode(name, [row[column] for row in rows])
+        for name, column in ANALYTICS_DATES.items():
+            self.days[name][slots] = analytics_days([row[column] for row in rows])
+
+    def refresh(self):
+        """Дочитать изменившиеся заказы; при первом вызове или смене шардов - загрузить все"""
+        databases = order_databases()
+        if self.seqs is None or databases != self.databases:
+            self.reset()
+            self.databases = databases
+            # Курсор берется до чтения: изменения во время загрузки дочитаются в следующий раз
+            self.seqs = []
+            for database in databases:
+                conn = get_read_db(database)
+                self.seqs.append(conn.execute(OrderRepo.LAST_CHANGE_SEQ).fetchone()[0])
+                conn.close()
+            for rows in scatter_orders(f'SELECT {self.columns()} FROM {{source}}', (), databases,
+                                       include_archived=True):
+                self.store(rows)
+        else:
+            row_lists = scatter_orders(f'''
+                SELECT {self.columns()}, change_seq FROM {{source}}
+                WHERE change_seq > ? ORDER BY change_seq
+            ''', lambda index: (self.seqs[index],), databases)
+            for index, rows in enumerate(row_lists):
+                self.store(rows)
+                if rows:
+                    self.seqs[index] = rows[-1]['change_seq']
+        self.refreshed = time.monotonic()
+        self.refreshed_at = datetime.now().isoformat(sep=' ', timespec='seconds')
+
+    def dimension(self, name, rows):
+        """Значения измерения name для строк rows: целочисленные ключи и функция подписи"""
+        if name in ANALYTICS_CATEGORIES:
+            dictionary = self.dictionaries[name]
+            return self.codes[name][rows], lambda code: dictionary[code]
+        if name in ANALYTICS_FLAGS:
+            values = self.numbers[name][rows]
+            keys = np.where(np.isnan(values), -1, values != 0).astype(np.int64)
+            return keys, lambda key: None if key < 0 else bool(key)
+        for date, column in ANALYTICS_DATES.items():
+            if name.startswith(date) and name[len(date):] in ANALYTICS_BUCKETS:
+                days = self.days[date][rows]
+                bucket = name[len(date):]
+                if bucket == 'Week':
+                    # 1970-01-01 - четверг: неделя начинается с понедельника
+                    days = np.where(days == self.NAT, self.NAT, days - (days + 3) % 7)
+                elif bucket == 'Month':
+                    days = days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+                return days, lambda day: None if day == self.NAT else str(np.datetime64(day, 'D'))
+        raise ValueError(f'Неизвестное измерение: {name}')
+
+    def field(self, name, rows):
+        if name == 'pricePerKm':
+            price, distance = self.numbers['price'][rows], self.numbers['distance'][rows]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(distance > 0, price / distance, np.nan)
+        return self.numbers[name][rows]
+
+    def query(self, spec):
+        """Отфильтровать строки, сгруппировать по измерениям и посчитать показатели векторно"""
+        size = self.size
+        mask = np.ones(size, dtype=bool)
+        for name, values in spec['filters'].items():
+            keys, label = self.dimension(name, slice(0, size))
+            wanted = [key for key in np.unique(keys).tolist() if label(key) in values]
+            mask &= np.isin(keys, wanted)
+        for date, (since, until) in spec['ranges'].items():
+            days = self.days[date][:size]
+            if since is not None:
+                mask &= (days != self.NAT) & (days >= since)
+            if until is not None:
+                mask &= (days != self.NAT) & (days <= until)
+        rows = np.flatnonzero(mask)
+        # Ключ группы - номер сочетания значений измерений
+        group = np.zeros(len(rows), dtype=np.int64)
+        labels = []
+        for name in spec['groupBy']:
+            keys, label = self.dimension(name, rows)
+            unique, inverse = np.unique(keys, return_inverse=True)
+            group = group * len(unique) + inverse
+            labels.append((name, unique, label))
+        if labels:
+            groups, group = np.unique(group, return_inverse=True)
+        else:
+            groups = np.zeros(1, dtype=np.int64)
+        count = np.bincount(group, minlength=len(groups))
+        results = {'count': count.astype(np.float64)}
+        for metric in spec['metrics']:
+            if metric['op'] == 'count':
+                continue
+            values = self.field(metric['field'], rows)
+            valid = ~np.isnan(values)
+            member, values = group[valid], values[valid]
+            if metric['op'] in ('sum', 'avg'):
+                result = np.bincount(member, weights=values, minlength=len(groups))
+                if metric['op'] == 'avg':
+                    present = np.bincount(member, minlength=len(groups))
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        result = np.where(present > 0, result / present, np.nan)
+            else:
+                reduce = np.minimum if metric['op'] == 'min' else np.maximum
+                result = np.full(len(groups), np.inf if metric['op'] == 'min' else -np.inf)
+                reduce.at(result, member, values)
+                result[np.isinf(result)] = np.nan
+            results[metric['as']] = result
+        # Подписи групп: номер сочетания раскладывается обратно по измерениям
+        parts = np.unravel_index(groups, [len(unique) for _, unique, _ in labels]) if labels else []
+        output = []
+        for index in range(len(groups)):
+            if labels and not count[index]:
+                continue
+            item = {name: label(unique[part[index]].item())
+                    for (name, unique, label), part in zip(labels, parts)}
+            for metric in spec['metrics']:
+                value = results[metric['as']][index]
+                if metric['op'] == 'count':
+                    item[metric['as']] = int(value)
+                else:
+                    item[metric['as']] = None if np.isnan(value) else round(float(value), 4)
+            output.append(item)
+        return output
+
+def parse_analytics_query(data):
+    """Проверить тело POST /api/admin/analytics/query; ошибки - ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError('Ожидается JSON-объект')
+    group_by = data.get('groupBy', [])
+    if not isinstance(group_by, list) or len(group_by) > ANALYTICS_MAX_DIMENSIONS:
+        raise ValueError(f'groupBy - список не более чем из {ANALYTICS_MAX_DIMENSIONS} измерений')
+    for name in group_by:
+        if name not in ANALYTICS_DIMENSIONS:
+            raise ValueError(f'Неизвестное измерение: {name}')
+    metrics = []
+    raw_metrics = data.get('metrics') or [{'op': 'count'}]
+    if not isinstance(raw_metrics, list) or len(raw_metrics) > ANALYTICS_MAX_METRICS:
+        raise ValueError(f'metrics - список не более чем из {ANALYTICS_MAX_METRICS} показателей')
+    for metric in raw_metrics:
+        op = metric.get('op') if isinstance(metric, dict) else None
+        if op not in ANALYTICS_OPS:
+            raise ValueError(f'Неизвестная операция: {op}')
+        field = metric.get('field')
+        if op != 'count' and field not in ANALYTICS_FIELDS:
+            raise ValueError(f'Неизвестное поле: {field}')
+        alias = metric.get('as') or (op if op == 'count' else op + field[0].upper() + field[1:])
+        if alias in group_by or any(alias == other['as'] for other in metrics):
+            raise ValueError(f'Повторяющееся имя показателя: {alias}')
+        metrics.append({'op': op, 'field': field, 'as': alias})
+    filters = {}
+    ranges = {}
+    for name, values in (data.get('filters') or {}).items():
+        for date in ANALYTICS_DATES:
+            if name in (date + 'From', date + 'To'):
+                try:
+                    day = int(np.datetime64(str(values)[:10], 'D').astype(np.int64))
+                except ValueError:
+                    raise ValueError(f'Некорректная дата: {name}')
+                bounds = ranges.setdefault(date, [None, None])
+                bounds[0 if name.endswith('From') else 1] = day
+                break
+        else:
+            if name not in ANALYTICS_CATEGORIES and name not in ANALYTICS_FLAGS:
+                raise ValueError(f'Недопустимый фильтр: {name}')
+            filters[name] = values if isinstance(values, list) else [values]
+    order_by = data.get('orderBy')
+    if order_by is not None and order_by not in group_by and all(order_by != m['as'] for m in metrics):
+        raise ValueError(f'orderBy должен быть измерением или показателем запроса: {order_by}')
+    order = data.get('order', 'asc' if order_by in group_by or order_by is None else 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError('order - asc или desc')
+    try:
+        limit = min(max(int(data.get('limit', ANALYTICS_LIMIT)), 1), ANALYTICS_MAX_LIMIT)
+    except (TypeError, ValueError):
+        raise ValueError('limit должен быть числом')
+    return {'groupBy': group_by, 'metrics': metrics, 'filters': filters, 'ranges': ranges,
+            'orderBy': order_by, 'order': order, 'limit': limit}
+
+_order_cube = None
+_order_cube_pid = None
+_order_cube_lock = threading.Lock()
+
+def order_cube(fresh=False):
+    """Куб процесса, дочитанный не реже ANALYTICS_REFRESH_INTERVAL (fresh - дочитать сейчас)"""
+    global _order_cube, _order_cube_pid
+    with _order_cube_lock:
+        if _order_cube is None or _order_cube_pid != os.getpid():
+            _order_cube = OrderCube()
+            _order_cube_pid = os.getpid()
+    cube = _order_cube
+    with cube.lock:
+        if fresh or cube.seqs is None or time.monotonic() - cube.refreshed >= app.config['ANALYTICS_REFRESH_INTERVAL']:
+            cube.refresh()
+    return cube
+
+def run_analytics_query(spec, fresh=False):
+    """Выполнить разобранный запрос; группы упорядочиваются по orderBy (пустые значения в конце)"""
+    cube = order_cube(fresh)
+    with cube.lock:
+        groups = cube.query(spec)
+        rows, refreshed_at = cube.size, cube.refreshed_at
+    keys = spec['orderBy'] and [spec['orderBy']] or spec['groupBy']
+    present = [item for item in groups if all(item[key] is not None for key in keys)]
+    missing = [item for item in groups if any(item[key] is None for key in keys)]
+    present.sort(key=lambda item: [item[key] for key in keys], reverse=spec['order'] == 'desc')
+    groups = present + missing
+    return {'rows': rows, 'refreshedAt': refreshed_at, 'totalGroups': len(groups),
+            'groups': groups[:spec['limit']]}
+
+# === ПОЛНОТЕКСТОВЫЙ ПОИСК ===
+ORDER_SEARCH_LIMIT = 50
+ORDER_SEARCH_MAX_LIMIT = 200
+# Веса колонок orders_fts для bm25: описание груза и отправитель важнее комментария
+ORDER_SEARCH_WEIGHTS = '4.0, 3.0, 3.0, 2.0, 2.0, 1.0'
+
+def build_fts_query(text):
+    """Преобразовать ввод пользователя в запрос FTS5: каждое слово ищется по префиксу"""
+    terms = re.findall(r'\w+', text.lower())[:10]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+# === НОРМАЛИЗАЦИЯ АДРЕСОВ ===
+# Каталог городов: id -> (название, псевдонимы). id сохраняются в заказах
+# (pickup_city_id, delivery_city_id), поэтому новые города только дописываются
+# в конец, а номера не переиспользуются.
+CITY_CATALOG = {
+    1: ('Москва', ('мск', 'moscow')),
+    2: ('Санкт-Петербург', ('спб', 'питер', 'петербург', 'ленинград', 'saint petersburg', 'st petersburg')),
+    3: ('Кострома', ()),
+    4: ('Ярославль', ()),
+    5: ('Владимир', ()),
+    6: ('Казань', ('kazan',)),
+    7: ('Нижний Новгород', ('н новгород', 'нижний нов')),
+    8: ('Екатеринбург', ('екб', 'екат')),
+    9: ('Новосибирск', ('нск', 'новосиб')),
+    10: ('Сочи', ()),
+    11: ('Великий Новгород', ('в новгород', 'вел новгород')),
+    12: ('Псков', ()),
+    13: ('Мурманск', ()),
+    14: ('Иваново', ()),
+    15: ('Вологда', ()),
+    16: ('Рыбинск', ()),
+}
+CITY_IDS = {name: city_id for city_id, (name, _) in CITY_CATALOG.items()}
+ADDRESS_TOKEN = re.compile(r'[0-9a-zа-я]+')
+# Слова, с которых начинается часть адреса с улицей: такую часть не сравниваем
+# с городами приблизительно ("ул. Ярославская" не должна стать Ярославлем)
+ADDRESS_STREET_WORDS = {'ул', 'улица', 'пр', 'проспект', 'пер', 'переулок', 'ш', 'шоссе', 'наб', 'набережная',
+                        'б', 'бул', 'бульвар', 'пл', 'площадь', 'д', 'дом', 'мкр', 'микрорайон'}
+# Слова перед названием города, которые не участвуют в приблизительном сравнении
+ADDRESS_SKIP_WORDS = {'г', 'гор', 'город', 'россия', 'рф'}
+# Начала слов, по которым часть адреса считается регионом: "Ярославская область"
+# похожа на Ярославль, но города в ней нет
+ADDRESS_REGION_PREFIXES = ('обл', 'край', 'респ', 'район')
+CITY_FUZZY_THRESHOLD = 0.55  # коэффициент Дайса по триграммам
+CITY_FUZZY_MIN_LENGTH = 4  # короче - только точное совпадение
+CITY_FUZZY_MAX_WORDS = 3
+# Допустимое число правок в каждом слове: 1, для слов от CITY_FUZZY_LONG_WORD букв - 2.
+# Слова сравниваются целиком, поэтому "Казанская" (4 правки) не становится Казанью
+CITY_FUZZY_LONG_WORD = 8
+
+def address_tokens(text):
+    """Слова текста в нижнем регистре, ё -> е, без знаков препинания"""
+    return ADDRESS_TOKEN.findall((text or '').lower().replace('ё', 'е'))
+
+def city_trigrams(phrase):
+    padded = f'  {phrase} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build_city_index(catalog):
+    """Префиксное дерево по словам названий и псевдонимов и индекс триграмм для опечаток.
+
+    Узел дерева - словарь слово -> узел, ключ None - id города, на котором
+    заканчивается название. Триграммы: триграмма -> фразы; фраза -> (id, триграммы).
+    """
+    trie = {}
+    phrases = {}
+    for city_id, (name, aliases) in catalog.items():
+        for variant in (name, *aliases):
+            tokens = address_tokens(variant)
+            node = trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[None] = city_id
+            phrase = ' '.join(tokens)
+            if len(phrase) >= CITY_FUZZY_MIN_LENGTH:
+                phrases[phrase] = (city_id, city_trigrams(phrase))
+    trigrams = {}
+    for phrase, (_, grams) in phrases.items():
+        for gram in grams:
+            trigrams.setdefault(gram, []).append(phrase)
+    return trie, phrases, trigrams
+
+CITY_TRIE, CITY_PHRASES, CITY_TRIGRAM_INDEX = build_city_index(CITY_CATALOG)
+
+def match_city_exact(tokens):
+    """Самое длинное название из дерева, начинающееся с любого слова; первое по порядку"""
+    for start in range(len(tokens)):
+        node, found = CITY_TRIE, None
+        for token in tokens[start:]:
+            node = node.get(token)
+            if node is None:
+                break
+            found = node.get(None, found)
+        if found is not None:
+            return found
+    return None
+
+def is_region_part(tokens):
+    """Часть адреса с областью, краем, республикой или районом"""
+    return any(token.startswith(ADDRESS_REGION_PREFIXES) for token in tokens)
+
+def edit_distance(a, b, limit):
+    """Расстояние Дамерау-Левенштейна (с перестановкой соседних букв); limit + 1, если больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other))
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == other:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+def words_match(tokens, candidate):
+    """Слова фразы совпадают со словами названия по одному, каждое - в пределах допустимых правок"""
+    words = candidate.split(' ')
+    if len(words) != len(tokens):
+        return False
+    for token, word in zip(tokens, words):
+        limit = 0 if len(word) < CITY_FUZZY_MIN_LENGTH else 1 if len(word) < CITY_FUZZY_LONG_WORD else 2
+        if edit_distance(token, word, limit) > limit:
+            return False
+    return True
+
+def match_city_fuzzy(tokens):
+    """Город с наибольшим сходством триграмм для первых 1..CITY_FUZZY_MAX_WORDS слов.
+
+    Триграммы отбирают и ранжируют кандидатов, а принимается только название
+    с тем же числом слов, каждое из которых отличается от слова адреса
+    не больше чем на допустимое число правок. У фраз короче
+    CITY_FUZZY_LONG_WORD одна опечатка меняет большую часть триграмм
+    ("Мсоква"), поэтому для них порог не действует и проверяются все
+    названия справочника.
+    """
+    tokens = [token for token in tokens if token not in ADDRESS_SKIP_WORDS]
+    if not tokens or tokens[0] in ADDRESS_STREET_WORDS or is_region_part(tokens):
+        return None
+    best, best_score = None, 0
+    for count in range(1, min(len(tokens), CITY_FUZZY_MAX_WORDS) + 1):
+        phrase = ' '.join(tokens[:count])
+        if len(phrase) < CITY_FUZZY_MIN_LENGTH:
+            continue
+        short = len(phrase) < CITY_FUZZY_LONG_WORD
+        grams = city_trigrams(phrase)
+        shared = {}
+        for gram in grams:
+            for candidate in CITY_TRIGRAM_INDEX.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        for candidate in CITY_PHRASES if short else shared:
+            city_id, candidate_grams = CITY_PHRASES[candidate]
+            score = 2 * shared.get(candidate, 0) / (len(grams) + len(candidate_grams))
+            if not short and score <= CITY_FUZZY_THRESHOLD:
+                continue
+            better = best is None or score > best_score or (score == best_score and city_id < best)
+            if better and words_match(tokens[:count], candidate):
+                best, best_score = city_id, score
+    return best
+
+_address_cache = OrderedDict()
+_address_cache_lock = threading.Lock()
+
+def resolve_address(address):
+    """Город адреса: (id, способ 'exact' | 'fuzzy') или (None, None).
+
+    Части адреса просматриваются по запятым слева направо, в каждой ищется
+    точное название или псевдоним, в том числе из нескольких слов. Если
+    точного совпадения нет, первая часть, не являющаяся регионом, сравнивается
+    с городами по словам с опечатками. Результаты запоминаются (ADDRESS_CACHE_SIZE).
+
+    Примеры (python -m doctest transportco_backend.py):
+
+    >>> resolve_address('ул. Ярославская, 5, Кострома')
+    (3, 'exact')
+    >>> resolve_address('Масква, ул. Ленина')
+    (1, 'fuzzy')
+    >>> resolve_address('Мсоква')
+    (1, 'fuzzy')
+    >>> resolve_address('Нижний Новгарод, ул. Минина')
+    (7, 'fuzzy')
+    >>> resolve_address('Ивановская обл., Иванова')
+    (14, 'fuzzy')
+    >>> resolve_address('Ярославская область, Углич')
+    (None, None)
+    >>> resolve_address('Ивановская обл., Шуя')
+    (None, None)
+    >>> resolve_address('Владимирская обл., Ковров')
+    (None, None)
+    >>> resolve_address('Казанская 5')
+    (None, None)
+    """
+    key = address or ''
+    with _address_cache_lock:
+        cached = _address_cache.get(key)
+        if cached is not None:
+            _address_cache.move_to_end(key)
+            return cached
+    parts = [address_tokens(part) for part in key.split(',')]
+    result = (None, None)
+    for tokens in parts:
+        city_id = match_city_exact(tokens)
+        if city_id is not None:
+            result = (city_id, 'exact')
+            break
+    else:
+        tokens = next((tokens for tokens in parts if not is_region_part(tokens)), [])
+        city_id = match_city_fuzzy(tokens)
+        if city_id is not None:
+            result = (city_id, 'fuzzy')
+    with _address_cache_lock:
+        _address_cache[key] = result
+        while len(_address_cache) > app.config['ADDRESS_CACHE_SIZE']:
+            _address_cache.popitem(last=False)
+    return result
+
+def address_city_id(address):
+    return resolve_address(address)[0]
+
+def backfill_order_cities(cursor):
+    """Заполнить pickup_city_id/delivery_city_id заказов, созданных до нормализации адресов"""
+    rows = cursor.execute('SELECT id, pickup_address, delivery_address FROM orders '
+                          'WHERE pickup_city_id IS NULL AND delivery_city_id IS NULL').fetchall()
+    cursor.executemany('UPDATE orders SET pickup_city_id = ?, delivery_city_id = ? WHERE id = ?',
+                       [(address_city_id(row[1]), address_city_id(row[2]), row[0]) for row in rows])
+
+# === ГОРОДА И РАССТОЯНИЯ ===
+# Расстояния между городами по дорогам, км (та же таблица, что cityDistances в js/script.js)
+CITY_DISTANCES = {
+    'Москва': {
+        'Санкт-Петербург': 714, 'Кострома': 346, 'Ярославль': 274, 'Владимир': 194,
+        'Казань': 807, 'Нижний Новгород': 416, 'Екатеринбург': 1745, 'Новосибирск': 3350, 'Сочи': 1584
+    },
+    'Санкт-Петербург': {
+        'Москва': 710, 'Кострома': 860, 'Ярославль': 800, 'Великий Новгород': 180, 'Псков': 280, 'Мурманск': 1400
+    },
+    'Кострома': {
+        'Москва': 340, 'Санкт-Петербург': 860, 'Ярославль': 85, 'Иваново': 110, 'Нижний Новгород': 330, 'Вологда': 220
+    },
+    'Ярославль': {
+        'Москва': 280, 'Санкт-Петербург': 800, 'Кострома': 85, 'Вологда': 200, 'Рыбинск': 75
+    }
+}
+CITY_SAME_DISTANCE = 10  # км внутри одного города
+CITY_UNKNOWN_DISTANCE = 100  # км, если город не найден в таблице
+
+def build_city_matrix(table):
+    """Кратчайшие расстояния между всеми городами таблицы (Флойд-Уоршелл)"""
+    cities = sorted({city for origin, neighbours in table.items() for city in (origin, *neighbours)})
+    index = {city: i for i, city in enumerate(cities)}
+    size = len(cities)
+    matrix = [[0 if i == j else float('inf') for j in range(size)] for i in range(size)]
+    for origin, neighbours in table.items():
+        for city, km in neighbours.items():
+            i, j = index[origin], index[city]
+            # Туда и обратно в таблице бывают разные значения - берем меньшее
+            matrix[i][j] = matrix[j][i] = min(matrix[i][j], km)
+    for k in range(size):
+        row_k = matrix[k]
+        for i in range(size):
+            via = matrix[i][k]
+            if via == float('inf'):
+                continue
+            row_i = matrix[i]
+            for j in range(size):
+                if via + row_k[j] < row_i[j]:
+                    row_i[j] = via + row_k[j]
+    return cities, index, matrix
+
+CITY_NAMES, CITY_INDEX, CITY_MATRIX = build_city_matrix(CITY_DISTANCES)
+
+def normalize_city(name):
+    """Привести название к записи каталога городов; неизвестное - как есть"""
+    city_id = address_city_id(name)
+    return CITY_CATALOG[city_id][0] if city_id else (name or '').strip()
+
+def extract_city(address):
+    """Город из адреса (resolve_address); неизвестный - часть до первой запятой"""
+    city_id = address_city_id(address)
+    return CITY_CATALOG[city_id][0] if city_id else (address or '').split(',')[0].strip()
+
+def city_distance(origin, destination):
+    """Расстояние между городами, км"""
+    if not origin or not destination:
+        return CITY_UNKNOWN_DISTANCE
+    if origin == destination:
+        return CITY_SAME_DISTANCE
+    i, j = CITY_INDEX.get(origin), CITY_INDEX.get(destination)
+    if i is None or j is None or CITY_MATRIX[i][j] == float('inf'):
+        return CITY_UNKNOWN_DISTANCE
+    return CITY_MATRIX[i][j]
+
+# === МАРШРУТ ВОДИТЕЛЯ ===
+# Заказы водителя, которые еще нужно забрать или довезти
+ROUTE_OPEN_STATUSES = ('confirmed', 'in_transit')
+
+def route_length(route, dist, start):
+    """Длина маршрута по матрице dist; start - индекс точки старта или None"""
+    total = dist[start][route[0]] if start is not None and route else 0
+    for a, b in zip(route, route[1:]):
+        total += dist[a][b]
+    return total
+
+def route_feasible(route, pickup_of):
+    """Каждая доставка идет после погрузки того же заказа"""
+    position = {stop: i for i, stop in enumerate(route)}
+    return all(position[pickup] < position[delivery] for delivery, pickup in pickup_of.items())
+
+def plan_route(stops, start_city=None, budget=None):
+    """Упорядочить остановки: погрузка раньше доставки, минимум километров.
+
+    stops - список словарей с ключами city, type ('pickup'/'delivery'),
+    orderId. Сначала жадное построение (ближайшая допустимая остановка,
+    перебор стартовых точек), затем локальный поиск перестановками
+    (relocate) и разворотами отрезков (2-opt) с проверкой порядка
+    погрузки/доставки, пока есть улучшения и не исчерпан бюджет времени.
+    """
+    budget = app.config['ROUTE_TIME_BUDGET'] if budget is None else budget
+    deadline = time.perf_counter() + budget
+    cities = [stop['city'] for stop in stops] + ([start_city] if start_city else [])
+    dist = [[city_distance(a, b) for b in cities] for a in cities]
+    start = len(stops) if start_city else None
+    pickup_index = {stop['orderId']: i for i, stop in enumerate(stops) if stop['type'] == 'pickup'}
+    pickup_of = {i: pickup_index[stop['orderId']] for i, stop in enumerate(stops)
+                 if stop['type'] == 'delivery' and stop['orderId'] in pickup_index}
+
+    def greedy(first):
+        route = [first]
+        visited = {first}
+        while len(route) < len(stops):
+            current = route[-1]
+            candidates = [i for i in range(len(stops)) if i not in visited
+                          and (i not in pickup_of or pickup_of[i] in visited)]
+            nxt = min(candidates, key=lambda i: dist[current][i])
+            route.append(nxt)
+            visited.add(nxt)
+        return route
+
+    firsts = [i for i in range(len(stops)) if i not in pickup_of]
+    if start is not None:
+        firsts.sort(key=lambda i: dist[start][i])
+    best, best_length = None, float('inf')
+    for first in firsts:
+        route = greedy(first)
+        length = route_length(route, dist, start)
+        if length < best_length:
+            best, best_length = route, length
+        if time.perf_counter() > deadline:
+            break
+    constructed = best_length
+    improvements = 0
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(len(best)):
+            for j in range(len(best)):
+                if i == j:
+                    continue
+                candidate = best[:i] + best[i + 1:]
+                candidate.insert(j, best[i])
+                length = route_length(candidate, dist, start)
+                if length < best_length and route_feasible(candidate, pickup_of):
+                    best, best_length = candidate, length
+                    improvements += 1
+                    improved = True
+            if time.perf_counter() > deadline:
+                break
+        for i in range(len(best) - 1):
+            for j in range(i + 2, len(best) + 1):
+                candidate = best[:i] + best[i:j][::-1] + best[j:]
+                length = route_length(candidate, dist, start)
+                if length < best_length and route_feasible(candidate, pickup_of):
+                    best, best_length = candidate, length
+                    improvements += 1
+                    improved = True
+            if time.perf_counter() > deadline:
+                break
+    legs = []
+    previous = start
+    for i in best:
+        legs.append({**stops[i], 'legKm': dist[previous][i] if previous is not None else 0})
+        previous = i
+    return {
+        'stops': legs,
+        'totalKm': best_length,
+        'constructedKm': constructed,
+        'improvements': improvements
+    }
+
+# Кэш маршрутов: водитель -> (набор заказов, результат); сбрасывается при смене набора
+_route_cache = OrderedDict()
+_route_cache_lock = threading.Lock()
+
+# === КОНСОЛИДАЦИЯ ГРУЗОВ ===
+# Полезный объем кузова по типу, м³ (в drivers хранится только грузоподъемность)
+CAR_TYPE_VOLUME = {
+    'tent': 82,
+    'refrigerator': 68,
+    'container': 67,
+    'tank': 30,
+    'flatbed': 60,
+}
+CAR_TYPE_DEFAULT_VOLUME = 60
+# Типы груза, которые можно везти только в определенных кузовах
+CARGO_CAR_TYPES = {
+    'perishable': ('refrigerator',),
+}
+
+class Truck:
+    """Машина в плане консолидации: остаток грузоподъемности и объема"""
+    __slots__ = ('driver_id', 'car_type', 'max_weight', 'max_volume', 'weight', 'volume', 'order_ids', 'car_types')
+
+    def __init__(self, vehicle):
+        self.driver_id, self.car_type, self.max_weight, self.max_volume = vehicle
+        self.weight = 0.0
+        self.volume = 0.0
+        self.order_ids = []
+        # Допустимые кузова с учетом уже погруженных заказов (None - любые)
+        self.car_types = None
+
+    def fits(self, weight, volume):
+        return self.weight + weight <= self.max_weight and self.volume + volume <= self.max_volume
+
+    def add(self, order_id, weight, volume, car_types=None):
+        self.weight += weight
+        self.volume += volume
+        self.order_ids.append(order_id)
+        if car_types:
+            self.car_types = car_types if self.car_types is None else \
+                tuple(t for t in self.car_types if t in car_types)
+
+    def to_dict(self):
+        return {
+            'driverId': self.driver_id,
+            'carType': self.car_type,
+            'maxWeight': self.max_weight,
+            'maxVolume': self.max_volume,
+            'orderIds': self.order_ids,
+            'weight': round(self.weight, 2),
+            'volume': round(self.volume, 3),
+            'weightFill': round(self.weight / self.max_weight, 3) if self.max_weight else 0,
+            'volumeFill': round(self.volume / self.max_volume, 3) if self.max_volume else 0
+        }
+
+def pick_vehicle(pool, weight, volume, remaining_weight, remaining_volume, car_types):
+    """Выбрать из пула машину для нового рейса.
+
+    Берется самая маленькая машина, вмещающая весь оставшийся груз
+    направления; если такой нет - самая большая, вмещающая хотя бы
+    текущий заказ. Пул отсортирован по возрастанию грузоподъемности.
+    """
+    largest = None
+    for index, vehicle in enumerate(pool):
+        _, car_type, max_weight, max_volume = vehicle
+        if car_types and car_type not in car_types:
+            continue
+        if max_weight < weight or max_volume < volume:
+            continue
+        if max_weight >= remaining_weight and max_volume >= remaining_volume:
+            return pool.pop(index)
+        largest = index
+    return pool.pop(largest) if largest is not None else None
+
+def pack_lane(orders, pool):
+    """Упаковать заказы одного направления и даты (First-Fit Decreasing по двум измерениям).
+
+    orders - список (id, вес, объем, тип груза); pool - свободные машины
+    на эту дату, из него забираются использованные. Возвращает
+    (машины, неразмещенные id).
+    """
+    reference_weight = max((vehicle[2] for vehicle in pool), default=1) or 1
+    reference_volume = max((vehicle[3] for vehicle in pool), default=1) or 1
+    # Сначала самые "тяжелые" заказы по наиболее загруженному измерению
+    orders = sorted(orders, key=lambda o: max(o[1] / reference_weight, o[2] / reference_volume), reverse=True)
+    remaining_weight = sum(o[1] for o in orders)
+    remaining_volume = sum(o[2] for o in orders)
+    trucks = []
+    unplaced = []
+    for order_id, weight, volume, cargo_type in orders:
+        car_types = CARGO_CAR_TYPES.get(cargo_type)
+        truck = next((t for t in trucks if (not car_types or t.car_type in car_types)
+                      and t.fits(weight, volume)), None)
+        if truck is None:
+            vehicle = pick_vehicle(pool, weight, volume, remaining_weight, remaining_volume, car_types)
+            if vehicle is None:
+                unplaced.append(order_id)
+                remaining_weight -= weight
+                remaining_volume -= volume
+                continue
+            truck = Truck(vehicle)
+            trucks.append(truck)
+        truck.add(order_id, weight, volume, car_types)
+        remaining_weight -= weight
+        remaining_volume -= volume
+    # Возвращаем в пул машины покрупнее, если груз помещается в свободную поменьше
+    for truck in trucks:
+        for index, (driver_id, car_type, max_weight, max_volume) in enumerate(pool):
+            if max_weight >= truck.max_weight:
+                break
+            if truck.car_types and car_type not in truck.car_types:
+                continue
+            if max_weight >= truck.weight and max_volume >= truck.volume:
+                pool[index] = (truck.driver_id, truck.car_type, truck.max_weight, truck.max_volume)
+                truck.driver_id, truck.car_type, truck.max_weight, truck.max_volume = \
+                    driver_id, car_type, max_weight, max_volume
+                pool.sort(key=lambda v: (v[2], v[3]))
+                break
+    return trucks, unplaced
+
+def plan_consolidation(orders, fleet):
+    """План загрузки: группы (направление, дата) и машины по каждой.
+
+    orders - строки с id, cargo_weight, cargo_volume, cargo_type,
+    shipping_date, pickup_address, delivery_address; fleet - (driver_id,
+    car_type, max_weight) активных водителей. Каждая машина используется
+    не больше одного раза за дату; в пределах даты первыми
+    распределяются самые загруженные направления.
+    """
+    vehicles = sorted(((driver_id, car_type, float(max_weight or 0),
+                        float(CAR_TYPE_VOLUME.get(car_type, CAR_TYPE_DEFAULT_VOLUME)))
+                       for driver_id, car_type, max_weight in fleet), key=lambda v: (v[2], v[3]))
+    lanes = {}
+    cities = {}
+    for order in orders:
+        # Одинаковые адреса встречаются часто - город извлекаем один раз
+        origin = cities.get(order['pickup_address'])
+        if origin is None:
+            origin = cities[order['pickup_address']] = extract_city(order['pickup_address'])
+        destination = cities.get(order['delivery_address'])
+        if destination is None:
+            destination = cities[order['delivery_address']] = extract_city(order['delivery_address'])
+        key = (order['shipping_date'] or '', origin, destination)
+        lanes.setdefault(key, []).append((order['id'], float(order['cargo_weight'] or 0),
+                                          float(order['cargo_volume'] or 0), order['cargo_type']))
+    pools = {}
+    plans = []
+    ordered = sorted(lanes.items(), key=lambda item: (item[0][0], -sum(o[1] for o in item[1])))
+    for (shipping_date, origin, destination), lane_orders in ordered:
+        pool = pools.setdefault(shipping_date, list(vehicles))
+        trucks, unplaced = pack_lane(lane_orders, pool)
+        plans.append({
+            'shippingDate': shipping_date or None,
+            'from': origin,
+            'to': destination,
+            'orders': len(lane_orders),
+            'trucks': [truck.to_dict() for truck in trucks],
+            'unplaced': unplaced
+        })
+    return plans
+
+# === ТАРИФЫ ===
+DEFAULT_TARIFF = {
+    'basePrice': 1000,
+    'perKm': 20,
+    'perKg': 80,
+    'perM3': 400,
+    'cargoMultipliers': {'general': 1.0, 'fragile': 1.3, 'dangerous': 1.5, 'perishable': 1.4},
+    'insuranceRate': 0.01,
+    'packagingPrice': 2000,
+}
+TARIFF_NUMBERS = ('basePrice', 'perKm', 'perKg', 'perM3', 'insuranceRate', 'packagingPrice')
+
+# Неизменяемая версия тарифа: при публикации новой версии объект заменяется целиком
+Tariff = namedtuple('Tariff', ('version', 'created_at', 'base_price', 'per_km', 'per_kg', 'per_m3',
+                               'cargo_multipliers', 'insurance_rate', 'packaging_price'))
+
+def make_tariff(version, data, created_at=None):
+    """Собрать Tariff из JSON-словаря версии"""
+    return Tariff(
+        version=version,
+        created_at=str(created_at) if created_at else None,
+        base_price=float(data['basePrice']),
+        per_km=float(data['perKm']),
+        per_kg=float(data['perKg']),
+        per_m3=float(data['perM3']),
+        cargo_multipliers=MappingProxyType({k: float(v) for k, v in data['cargoMultipliers'].items()}),
+        insurance_rate=float(data['insuranceRate']),
+        packaging_price=float(data['packagingPrice'])
+    )
+
+def tariff_to_dict(tariff):
+    return {
+        'version': tariff.version,
+        'createdAt': tariff.created_at,
+        'basePrice': tariff.base_price,
+        'perKm': tariff.per_km,
+        'perKg': tariff.per_kg,
+        'perM3': tariff.per_m3,
+        'cargoMultipliers': dict(tariff.cargo_multipliers),
+        'insuranceRate': tariff.insurance_rate,
+        'packagingPrice': tariff.packaging_price
+    }
+
+@traced('pricing')
+def calculate_price(tariff, distance, weight, volume, cargo_type, insurance, packaging):
+    """Цена заказа по версии тарифа (тот же расчет выполняет calculateOrderPrice в JS)"""
+    total = tariff.base_price + distance * tariff.per_km + weight * tariff.per_kg + volume * tariff.per_m3
+    total *= tariff.cargo_multipliers.get(cargo_type, 1.0)
+    if insurance:
+        total += total * tariff.insurance_rate
+    if packaging:
+        total += tariff.packaging_price
+    # Округление половин вверх, как Math.round: цена на клиенте совпадает до рубля
+    return int(total + 0.5)
+
+# Текущая версия и время последней проверки; заменяются одним присваиванием
+_tariff_state = {'tariff': None, 'checked': 0.0}
+_tariff_lock = threading.Lock()
+
+def load_tariff(version=None):
+    """Прочитать версию тарифа из БД (по умолчанию последнюю)"""
+    conn = get_read_db()
+    cursor = conn.cursor()
+    if version is None:
+        cursor.execute('SELECT version, data, created_at FROM tariffs ORDER BY version DESC LIMIT 1')
+    else:
+        cursor.execute('SELECT version, data, created_at FROM tariffs WHERE version = ?', (version,))
+    row = cursor.fetchone()
+    conn.close()
+    return make_tariff(row['version'], json.loads(row['data']), row['created_at']) if row else None
+
+def current_tariff():
+    """Действующий тариф. Новая версия, опубликованная другим процессом,
+    подхватывается не позже чем через TARIFF_REFRESH_INTERVAL секунд."""
+    state = _tariff_state
+    now = time.monotonic()
+    if state['tariff'] is not None and now - state['checked'] < app.config['TARIFF_REFRESH_INTERVAL']:
+        return state['tariff']
+    with _tariff_lock:
+        if _tariff_state['tariff'] is None or now - _tariff_state['checked'] >= app.config['TARIFF_REFRESH_INTERVAL']:
+            conn = get_read_db()
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(version) FROM tariffs')
+            latest = cursor.fetchone()[0]
+            conn.close()
+            tariff = _tariff_state['tariff']
+            if tariff is None or tariff.version != latest:
+                tariff = load_tariff(latest)
+            _tariff_state.update(tariff=tariff, checked=now)
+        return _tariff_state['tariff']
+
+def publish_tariff(changes, admin_id):
+    """Опубликовать новую версию на основе текущей и сразу переключиться на нее"""
+    current = tariff_to_dict(current_tariff())
+    data = {**current, **changes}
+    # Коэффициенты типов груза дополняют действующие, а не заменяют их целиком
+    data['cargoMultipliers'] = {**current['cargoMultipliers'], **changes.get('cargoMultipliers', {})}
+    data = {key: data[key] for key in DEFAULT_TARIFF}
+    make_tariff(0, data)  # проверка формата до записи
+    def write(cursor):
+        cursor.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM tariffs')
+        version = cursor.fetchone()[0]
+        cursor.execute('INSERT INTO tariffs (version, data, created_by) VALUES (?, ?, ?)',
+                       (version, json.dumps(data), admin_id))
+        return version
+    version = run_write(write)
+    tariff = load_tariff(version)
+    with _tariff_lock:
+        _tariff_state.update(tariff=tariff, checked=time.monotonic())
+    return tariff
+
+def validate_tariff_changes(data):
+    """Проверить поля новой версии тарифа; вернуть словарь изменений или бросить ValueError"""
+    changes = {}
+    for key in TARIFF_NUMBERS:
+        if key in data:
+            value = data[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f'{key} должен быть неотрицательным числом')
+            changes[key] = value
+    if 'cargoMultipliers' in data:
+        multipliers = data['cargoMultipliers']
+        if not isinstance(multipliers, dict) or not all(
+                isinstance(v, (int, float)) and not isinstance(v, bool) and v > 0 for v in multipliers.values()):
+            raise ValueError('cargoMultipliers: словарь тип груза -> положительный коэффициент')
+        changes['cargoMultipliers'] = multipliers
+    if not changes:
+        raise ValueError('Нет изменений тарифа')
+    return changes
+
+# === МАРШРУТЫ ДЛЯ СТАТИКИ ===
+@app.route('/')
+def index():
+    """Главная страница - отдаем main.html"""
+    return send_from_directory('', 'main.html')
+
+@app.route('/css/<path:filename>')
+def styles(filename):
+    """Раздача CSS файлов"""
+    return send_from_directory('css', filename)
+
+@app.route('/js/<path:filename>')
+def scripts(filename):
+    """Раздача JS файлов"""
+    return send_from_directory('js', filename)
+
+# === API ENDPOINTS ===
+# === АВТОРИЗАЦИЯ ===
+@app.route('/api/register', methods=['POST'])
+@rate_limited('register', login_fields=('email',))
+@swag_from({
+    'tags': ['Авторизация'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'email': {'type': 'string', 'example': 'user@example.com'},
+                    'phone': {'type': 'string', 'example': '+79123456789'},
+                    'password': {'type': 'string', 'example': 'secure123'},
+                    'firstName': {'type': 'string', 'example': 'Иван'},
+                    'lastName': {'type': 'string', 'example': 'Иванов'}
+                },
+                'required': ['email', 'phone', 'password', 'firstName', 'lastName']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Успешная регистрация',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Регистрация успешна'},
+                    'user': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'email': {'type': 'string', 'example': 'user@example.com'},
+                            'phone': {'type': 'string', 'example': '+79123456789'},
+                            'firstName': {'type': 'string', 'example': 'Иван'},
+                            'lastName': {'type': 'string', 'example': 'Иванов'},
+                            'verified': {'type': 'boolean', 'example': True},
+                            'isAdmin': {'type': 'boolean', 'example': False},
+                            'isDriver': {'type': 'boolean', 'example': False}
+                        }
+                    }
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'},
+        403: {'description': 'Телефон не подтвержден кодом (POST /api/verification/verify)'},
+        429: {'description': 'Слишком много попыток'}
+    }
+})
+def register():
+    """Регистрация пользователя"""
+    try:
+        data = request.get_json()
+        email = data.get('email', '').strip()
+        phone = data.get('phone', '').strip()
+        password = data.get('password', '')
+        first_name = data.get('firstName', '').strip()
+        last_name = data.get('lastName', '').strip()
+        if not all([email, phone, password, first_name, last_name]):
+            return jsonify({'success': False, 'message': 'Заполните все поля'}), 400
+        if len(password) < 6:
+            return jsonify({'success': False, 'message': 'Пароль должен быть не менее 6 символов'}), 400
+        if not is_contact_verified('register', phone):
+            return jsonify({'success': False, 'message': 'Телефон не подтвержден кодом'}), 403
+        conn = get_read_db()
+        # Проверка существования email или телефона
+        exists = UserRepo.contact_taken(conn, email, phone)
+        conn.close()
+        if exists:
+            return jsonify({'success': False, 'message': 'Пользователь с таким email или телефоном уже существует'}), 400
+        # Хэширование - вне потока записи
+        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        user_id = run_write(lambda cursor: UserRepo.create(cursor, email, phone, hashed_password,
+                                                           first_name, last_name))
+        clear_verified_contact('register')
+        # Автоматический вход после регистрации
+        session['user_id'] = user_id
+        return jsonify({
+            'success': True,
+            'message': 'Регистрация успешна',
+            'user': {
+                'id': user_id,
+                'email': email,
+                'phone': phone,
+                'firstName': first_name,
+                'lastName': last_name,
+                'verified': True,
+                'isAdmin': False,
+                'isDriver': False
+            }
+        })
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'message': 'Пользователь с таким email или телефоном уже существует'}), 400
+    except Exception as e:
+        print(f"[ERROR] Ошибка при регистрации: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/login', methods=['POST'])
+@rate_limited('login', login_fields=('login',))
+@swag_from({
+    'tags': ['Авторизация'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'login': {'type': 'string', 'description': 'Email или телефон', 'example': "+79123456789"},
+                    'password': {'type': 'string', 'example': "secure123"}
+                },
+                'required': ['login', 'password']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Успешный вход',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Вход выполнен успешно'},
+                    'user': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'email': {'type': 'string', 'example': 'user@example.com'},
+                            'phone': {'type': 'string', 'example': '+79123456789'},
+                            'firstName': {'type': 'string', 'example': 'Иван'},
+                            'lastName': {'type': 'string', 'example': 'Иванов'},
+                            'verified': {'type': 'boolean', 'example': True},
+                            'isAdmin': {'type': 'boolean', 'example': False},
+                            'isDriver': {'type': 'boolean', 'example': False}
+                        }
+                    }
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'},
+        401: {'description': 'Неверные учетные данные'},
+        429: {'description': 'Слишком много попыток'}
+    }
+})
+def login():
+    """Вход пользователя"""
+    try:
+        data = request.get_json()
+        login_field = data.get('login', '').strip()  # email или phone
+        password = data.get('password', '')
+        if not login_field or not password:
+            return jsonify({'success': False, 'message': 'Заполните все поля'}), 400
+        conn = get_read_db()
+        user = UserRepo.find_by_contact(conn, login_field)
+        conn.close()
+        if user and check_password_hash(user['password'], password):
+            if not user['verified']:
+                return jsonify({'success': False, 'message': 'Аккаунт не подтвержден'}), 400
+            session['user_id'] = user['id']
+            return jsonify({
+                'success': True,
+                'message': 'Вход выполнен успешно',
+                'user': {
+                    'id': user['id'],
+                    'email': user['email'],
+                    'phone': user['phone'],
+                    'firstName': user['first_name'],
+                    'lastName': user['last_name'],
+                    'verified': bool(user['verified']),
+                    'isAdmin': bool(user['is_admin']),
+                    'isDriver': bool(user['is_driver'])
+                }
+            })
+        else:
+            return jsonify({'success': False, 'message': 'Неверный телефон/email или пароль'}), 401
+    except Exception as e:
+        print(f"[ERROR] Ошибка при входе: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/logout', methods=['POST'])
+@swag_from({
+    'tags': ['Авторизация'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {
+            'description': 'Успешный выход',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Выход выполнен успешно'}
+                }
+            }
+        }
+    }
+})
+def logout():
+    """Выход из системы"""
+    session.clear()
+    return jsonify({'success': True, 'message': 'Выход выполнен успешно'})
+
+@app.route('/api/current-user', methods=['GET'])
+@swag_from({
+    'tags': ['Авторизация'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {
+            'description': 'Текущий пользователь',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'user': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'email': {'type': 'string', 'example': 'user@example.com'},
+                            'phone': {'type': 'string', 'example': '+79123456789'},
+                            'firstName': {'type': 'string', 'example': 'Иван'},
+                            'lastName': {'type': 'string', 'example': 'Иванов'},
+                            'verified': {'type': 'boolean', 'example': True},
+                            'isAdmin': {'type': 'boolean', 'example': False},
+                            'isDriver': {'type': 'boolean', 'example': False}
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def current_user():
+    """Получить текущего пользователя"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'user': None})
+    conn = get_read_db()
+    user = UserRepo.get(conn, session['user_id'])
+    conn.close()
+    if user:
+        return jsonify({
+            'success': True,
+            'user': {
+                'id': user['id'],
+                'email': user['email'],
+                'phone': user['phone'],
+                'firstName': user['first_name'],
+                'lastName': user['last_name'],
+                'verified': bool(user['verified']),
+                'isAdmin': bool(user['is_admin']),
+                'isDriver': bool(user['is_driver'])
+            }
+        })
+    else:
+        session.clear()
+        return jsonify({'success': False, 'user': None})
+
+# === ПРОФИЛЬ ===
+@app.route('/api/profile', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Профиль'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {
+            'description': 'Профиль пользователя',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'user': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'email': {'type': 'string', 'example': 'user@example.com'},
+                            'phone': {'type': 'string', 'example': '+79123456789'},
+                            'firstName': {'type': 'string', 'example': 'Иван'},
+                            'lastName': {'type': 'string', 'example': 'Иванов'},
+                            'verified': {'type': 'boolean', 'example': True},
+                            'isAdmin': {'type': 'boolean', 'example': False},
+                            'isDriver': {'type': 'boolean', 'example': False}
+                        }
+                    }
+                }
+            }
+        },
+        404: {'description': 'Пользователь не найден'}
+    }
+})
+def get_profile():
+    """Получить профиль пользователя"""
+    conn = get_read_db()
+    user = UserRepo.get(conn, session['user_id'])
+    conn.close()
+    if user:
+        return jsonify({
+            'success': True,
+            'user': {
+                'id': user['id'],
+                'email': user['email'],
+                'phone': user['phone'],
+                'firstName': user['first_name'],
+                'lastName': user['last_name'],
+                'verified': bool(user['verified']),
+                'isAdmin': bool(user['is_admin']),
+                'isDriver': bool(user['is_driver'])
+            }
+        })
+    return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
+
+@app.route('/api/profile', methods=['POST'])
+@login_required
+@swag_from({
+    'tags': ['Профиль'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'firstName': {'type': 'string', 'example': 'Иван'},
+                    'lastName': {'type': 'string', 'example': 'Иванов'},
+                    'email': {'type': 'string', 'example': 'new_email@example.com'},
+                    'phone': {'type': 'string', 'example': '+79123456789'}
+                },
+                'required': ['firstName', 'lastName', 'email', 'phone']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Профиль успешно обновлен',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Профиль обновлен'}
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'}
+    }
+})
+def update_profile():
+    """Обновить профиль пользователя"""
+    try:
+        data = request.get_json()
+        first_name = data.get('firstName', '').strip()
+        last_name = data.get('lastName', '').strip()
+        email = data.get('email', '').strip()
+        phone = data.get('phone', '').strip()
+        user_id = session['user_id']
+        def write(cursor):
+            # Проверка уникальности email и phone
+            if UserRepo.contact_taken(cursor, email, phone, user_id):
+                raise WriteRejected('Email или телефон уже используются')
+            UserRepo.update_profile(cursor, user_id, first_name, last_name, email, phone)
+        run_write(write)
+        return jsonify({'success': True, 'message': 'Профиль обновлен'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
+    except Exception as e:
+        print(f"[ERROR] Ошибка при обновлении профиля: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/profile/password', methods=['POST'])
+@login_required
+@swag_from({
+    'tags': ['Профиль'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'currentPassword': {'type': 'string', 'example': 'old_secure123'},
+                    'newPassword': {'type': 'string', 'example': 'new_secure123'},
+                    'isRecovery': {'type': 'boolean', 'example': False}
+                },
+                'required': ['newPassword']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Пароль успешно изменен',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Пароль успешно изменен'}
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'}
+    }
+})
+def change_password():
+    """Смена пароля (с поддержкой восстановления)"""
+    try:
+        data = request.get_json()
+        current_password = data.get('currentPassword', '')
+        new_password = data.get('newPassword', '')
+        is_recovery = data.get('isRecovery', False)  # Новый флаг
+        if not new_password:
+            return jsonify({'success': False, 'message': 'Новый пароль обязателен'}), 400
+        if len(new_password) < 6:
+            return jsonify({'success': False, 'message': 'Пароль должен быть не менее 6 символов'}), 400
+        # Если это НЕ восстановление — проверяем текущий пароль
+        if not is_recovery:
+            if not current_password:
+                return jsonify({'success': False, 'message': 'Текущий пароль обязателен'}), 400
+            conn = get_read_db()
+            password_hash = UserRepo.password_hash(conn, session['user_id'])
+            conn.close()
+            if not password_hash or not check_password_hash(password_hash, current_password):
+                return jsonify({'success': False, 'message': 'Текущий пароль указан неверно'}), 400
+        # Обновляем пароль
+        hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256')
+        user_id = session['user_id']
+        run_write(lambda cursor: UserRepo.set_password(cursor, user_id, hashed_password))
+        # При восстановлении — разлогиниваем для безопасности
+        if is_recovery:
+            session.clear()
+        return jsonify({'success': True, 'message': 'Пароль успешно изменен'})
+    except Exception as e:
+        print(f"[ERROR] Ошибка при смене пароля: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/verification/issue', methods=['POST'])
+@rate_limited('verification_issue', login_fields=('contact',))
+@swag_from({
+    'tags': ['Авторизация'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'contact': {'type': 'string', 'description': 'Email или телефон', 'example': "+79123456789"},
+                    'purpose': {'type': 'string', 'enum': list(VERIFICATION_PURPOSES), 'example': 'reset_password'}
+                },
+                'required': ['contact', 'purpose']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Код отправлен',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'expiresIn': {'type': 'integer', 'example': 300},
+                    'resendAfter': {'type': 'integer', 'example': 60},
+                    'code': {'type': 'string', 'description': 'Только в демо-режиме (VERIFICATION_EXPOSE_CODE) и только для register', 'example': '4821'}
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'},
+        404: {'description': 'Пользователь не найден'},
+        429: {'description': 'Код уже отправлен, повторить позже'}
+    }
+})
+def issue_verification():
+    """Выпуск кода подтверждения для регистрации или восстановления пароля"""
+    try:
+        data = request.get_json() or {}
+        contact = data.get('contact', '').strip()
+        purpose = data.get('purpose', '')
+        if not contact or purpose not in VERIFICATION_PURPOSES:
+            return jsonify({'success': False, 'message': 'Укажите контакт и цель подтверждения'}), 400
+        if purpose == 'reset_password':
+            conn = get_read_db()
+            exists = UserRepo.find_by_contact(conn, contact)
+            conn.close()
+            if not exists:
+                return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
+        code, retry_after = issue_verification_code(contact, purpose)
+        if code is None:
+            response = jsonify({'success': False, 'message': 'Код уже отправлен, повторите позже',
+                                'retryAfter': retry_after})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+        result = {
+            'success': True,
+            'expiresIn': app.config['VERIFICATION_CODE_TTL'],
+            'resendAfter': app.config['VERIFICATION_RESEND_AFTER']
+        }
+        if app.config['VERIFICATION_EXPOSE_CODE'] and purpose in VERIFICATION_EXPOSABLE_PURPOSES:
+            result['code'] = code
+        elif app.debug:
+            # Демо без шлюза: код виден только в журнале сервера
+            print(f"[INFO] Код подтверждения ({purpose}) для {contact}: {code}")
+        return jsonify(result)
+    except Exception as e:
+        print(f"[ERROR] issue_verification: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/verification/verify', methods=['POST'])
+@rate_limited('verification_verify', login_fields=('contact',))
+@swag_from({
+    'tags': ['Авторизация'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'contact': {'type': 'string', 'example': "+79123456789"},
+                    'purpose': {'type': 'string', 'enum': list(VERIFICATION_PURPOSES), 'example': 'reset_password'},
+                    'code': {'type': 'string', 'example': '4821'}
+                },
+                'required': ['contact', 'purpose', 'code']
+            }
+        }
+    ],
+    'responses': {
+        200: {'description': 'Код подтвержден, контакт отмечен в сессии'},
+        400: {'description': 'Неверный или истекший код'},
+        429: {'description': 'Слишком много попыток'}
+    }
+})
+def verify_verification():
+    """Проверка кода; при успехе контакт считается подтвержденным в текущей сессии"""
+    try:
+        data = request.get_json() or {}
+        contact = data.get('contact', '').strip()
+        purpose = data.get('purpose', '')
+        code = str(data.get('code', '')).strip()
+        if not contact or not code or purpose not in VERIFICATION_PURPOSES:
+            return jsonify({'success': False, 'message': 'Укажите контакт, цель и код'}), 400
+        ok, message = check_verification_code(contact, purpose, code)
+        if not ok:
+            return jsonify({'success': False, 'message': message}), 400
+        mark_contact_verified(purpose, contact)
+        return jsonify({'success': True, 'message': 'Код подтвержден'})
+    except Exception as e:
+        print(f"[ERROR] verify_verification: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/reset-password', methods=['POST'])
+@rate_limited('reset_password', login_fields=('contact',))
+@swag_from({
+    'tags': ['Авторизация'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'contact': {'type': 'string', 'description': 'Email или телефон', 'example': "+79123456789"},
+                    'newPassword': {'type': 'string', 'example': "new_secure123"}
+                },
+                'required': ['contact', 'newPassword']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Пароль успешно изменен',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Пароль успешно изменён'}
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'},
+        403: {'description': 'Контакт не подтвержден кодом'},
+        404: {'description': 'Пользователь не найден'},
+        429: {'description': 'Слишком много попыток'}
+    }
+})
+def reset_password_no_auth():
+    """Смена пароля без авторизации (после подтверждения через код)"""
+    try:
+        data = request.get_json()
+        contact = data.get('contact', '').strip()  # email или phone
+        new_password = data.get('newPassword', '')
+        if not contact or not new_password:
+            return jsonify({'success': False, 'message': 'Укажите email/телефон и новый пароль'}), 400
+        if len(new_password) < 6:
+            return jsonify({'success': False, 'message': 'Пароль должен быть не менее 6 символов'}), 400
+        if not is_contact_verified('reset_password', contact):
+            return jsonify({'success': False, 'message': 'Контакт не подтвержден кодом'}), 403
+        conn = get_read_db()
+        user = UserRepo.find_by_contact(conn, contact)
+        conn.close()
+        if not user:
+            return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
+        hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256')
+        run_write(lambda cursor: UserRepo.set_password(cursor, user['id'], hashed_password))
+        clear_verified_contact('reset_password')
+        return jsonify({'success': True, 'message': 'Пароль успешно изменён'})
+    except Exception as e:
+        print(f"[ERROR] reset_password_no_auth: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# === ГОРОДА ===
+@app.route('/api/cities/resolve', methods=['GET'])
+@swag_from({
+    'tags': ['Заказы'],
+    'parameters': [
+        {
+            'name': 'address',
+            'in': 'query',
+            'type': 'string',
+            'required': True,
+            'description': 'Адрес или название города'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Город адреса по каталогу; cityId null, если не найден',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'cityId': {'type': 'integer', 'example': 7},
+                    'city': {'type': 'string', 'example': 'Нижний Новгород'},
+                    'match': {'type': 'string', 'enum': ['exact', 'fuzzy'], 'example': 'exact'}
+                }
+            }
+        }
+    }
+})
+def resolve_city():
+    """Определить город адреса тем же способом, что при создании заказа"""
+    city_id, match = resolve_address(request.args.get('address', ''))
+    return jsonify({'success': True, 'cityId': city_id, 'city': CITY_CATALOG[city_id][0] if city_id else None,
+                    'match': match})
+
+# === ТАРИФЫ ===
+def tariff_response(tariff, max_age, immutable=False):
+    """Ответ с тарифом и заголовками кэширования (ETag по номеру версии)"""
+    etag = f'"tariff-{tariff.version}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({'success': True, 'tariff': tariff_to_dict(tariff)})
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = f'public, max-age={max_age}' + (', immutable' if immutable else '')
+    return response
+
+@app.route('/api/tariffs', methods=['GET'])
+@swag_from({
+    'tags': ['Заказы'],
+    'responses': {
+        200: {
+            'description': 'Действующая версия тарифа (для расчета цены на клиенте)',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'tariff': {
+                        'type': 'object',
+                        'properties': {
+                            'version': {'type': 'integer', 'example': 1},
+                            'basePrice': {'type': 'number', 'example': 1000},
+                            'perKm': {'type': 'number', 'example': 20},
+                            'perKg': {'type': 'number', 'example': 80},
+                            'perM3': {'type': 'number', 'example': 400},
+                            'cargoMultipliers': {'type': 'object'},
+                            'insuranceRate': {'type': 'number', 'example': 0.01},
+                            'packagingPrice': {'type': 'number', 'example': 2000}
+                        }
+                    }
+                }
+            }
+        },
+        304: {'description': 'Версия не изменилась (If-None-Match)'}
+    }
+})
+def get_current_tariff():
+    """Действующий тариф"""
+    try:
+        return tariff_response(current_tariff(), app.config['TARIFF_CACHE_MAX_AGE'])
+    except Exception as e:
+        print(f"[ERROR] get_current_tariff: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/tariffs/<int:version>', methods=['GET'])
+@swag_from({
+    'tags': ['Заказы'],
+    'parameters': [
+        {'name': 'version', 'in': 'path', 'type': 'integer', 'required': True}
+    ],
+    'responses': {
+        200: {'description': 'Версия тарифа; версии не меняются, поэтому кэшируются бессрочно'},
+        404: {'description': 'Версия не найдена'}
+    }
+})
+def get_tariff_version(version):
+    """Конкретная версия тарифа (например, та, по которой посчитан заказ)"""
+    try:
+        tariff = load_tariff(version)
+        if tariff is None:
+            return jsonify({'success': False, 'message': 'Версия тарифа не найдена'}), 404
+        return tariff_response(tariff, 31536000, immutable=True)
+    except Exception as e:
+        print(f"[ERROR] get_tariff_version: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/admin/tariffs', methods=['GET'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {'description': 'История версий тарифа, новые первыми'}
+    }
+})
+def admin_list_tariffs():
+    """Все версии тарифа"""
+    try:
+        conn = get_read_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT version, data, created_at, created_by FROM tariffs ORDER BY version DESC')
+        rows = cursor.fetchall()
+        conn.close()
+        return jsonify({
+            'success': True,
+            'current': current_tariff().version,
+            'tariffs': [{**tariff_to_dict(make_tariff(row['version'], json.loads(row['data']), row['created_at'])),
+                         'createdBy': row['created_by']} for row in rows]
+        })
+    except Exception as e:
+        print(f"[ERROR] admin_list_tariffs: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/admin/tariffs', methods=['POST'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'description': 'Изменяемые поля; остальные берутся из действующей версии',
+                'properties': {
+                    'basePrice': {'type': 'number', 'example': 1000},
+                    'perKm': {'type': 'number', 'example': 25},
+                    'perKg': {'type': 'number', 'example': 80},
+                    'perM3': {'type': 'number', 'example': 400},
+                    'cargoMultipliers': {'type': 'object', 'example': {'general': 1.0, 'fragile': 1.3}},
+                    'insuranceRate': {'type': 'number', 'example': 0.01},
+                    'packagingPrice': {'type': 'number', 'example': 2000}
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {'description': 'Опубликована новая версия; действует сразу, без перезапуска'},
+        400: {'description': 'Ошибка валидации'}
+    }
+})
+def admin_publish_tariff():
+    """Публикация новой версии тарифа"""
+    try:
+        changes = validate_tariff_changes(request.get_json() or {})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        tariff = publish_tariff(changes, session['user_id'])
+        return jsonify({'success': True, 'message': 'Тариф опубликован', 'tariff': tariff_to_dict(tariff)})
+    except Exception as e:
+        print(f"[ERROR] admin_publish_tariff: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# === ЗАКАЗЫ ===
+@app.route('/api/orders', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Список полей через запятую (имеет приоритет над view)',
+            'example': 'id,status,price'
+        },
+        {
+            'name': 'view',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['compact', 'summary', 'full'],
+            'required': False,
+            'description': 'Именованный набор полей (по умолчанию full)'
+        },
+        {
+            'name': 'include_archived',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Включить заказы из архива'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Список заказов',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'orders': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'id': {'type': 'integer', 'example': 1},
+                                'senderName': {'type': 'string', 'example': 'Иван Иванов'},
+                                'cargoDescription': {'type': 'string', 'example': 'Электроника'},
+                                'status': {'type': 'string', 'example': 'new'},
+                                'price': {'type': 'number', 'example': 1500}
+                            }
+                        }
+                    },
+                    'cursor': {
+                        'type': 'string',
+                        'example': '42',
+                        'description': 'Курсор для GET /api/orders/changes'
+                    }
+                }
+            }
+        },
+        400: {'description': 'Недопустимое поле или представление'}
+    }
+})
+def get_orders():
+    """Получить заказы пользователя"""
+    try:
+        fields = resolve_fields(ORDER_FIELDS, ORDER_VIEWS)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    # created_at нужен для слияния результатов шардов
+    query_fields = fields if 'created_at' in fields else fields + ['created_at']
+    columns = select_list(ORDER_FIELDS, query_fields)
+    conn = get_read_db()
+    # Проверяем роль пользователя
+    user = UserRepo.role(conn, session['user_id'])
+    conn.close()
+    databases = None
+    if user['is_admin']:
+        # Администратор видит все заказы
+        condition, params = '', ()
+    elif user['is_driver']:
+        # Водитель видит свои заказы
+        condition, params = 'WHERE driver_id = ?', (session['user_id'],)
+    else:
+        # Обычный пользователь видит свои заказы - они целиком в одном шарде
+        condition, params = 'WHERE user_id = ?', (session['user_id'],)
+        databases = [order_database_for_user(session['user_id'])]
+    # Курсор читается до списка: изменения между ними придут повторно, но не потеряются
+    cursor = order_change_cursor()
+    row_lists = scatter_orders(f'SELECT {columns} FROM {{source}} {condition} ORDER BY created_at DESC',
+                               params, databases, parse_bool_arg('include_archived'))
+    orders = [{name: row[name] for name in fields}
+              for row in merge_shard_rows(row_lists, newest_first, reverse=True)]
+    return jsonify({'success': True, 'orders': orders, 'cursor': cursor})
+
+@app.route('/api/orders', methods=['POST'])
+@login_required
+@idempotent('create_order')
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'senderName': {'type': 'string', 'example': 'Иван Иванов'},
+                    'senderPhone': {'type': 'string', 'example': '+79123456789'},
+                    'senderEmail': {'type': 'string', 'example': 'ivan@example.com'},
+                    'cargoDescription': {'type': 'string', 'example': 'Электроника'},
+                    'productCategory': {'type': 'string', 'example': 'electronics'},
+                    'cargoWeight': {'type': 'number', 'example': 10},
+                    'cargoVolume': {'type': 'number', 'example': 1},
+                    'cargoType': {'type': 'string', 'example': 'general'},
+                    'shippingDate': {'type': 'string', 'format': 'date', 'example': '2023-12-25'},
+                    'pickupAddress': {'type': 'string', 'example': 'Москва, ул. Ленина, 1'},
+                    'deliveryAddress': {'type': 'string', 'example': 'Санкт-Петербург, ул. Пушкина, 10'},
+                    'distance': {'type': 'number', 'example': 700},
+                    'insurance': {'type': 'boolean', 'example': True},
+                    'packaging': {'type': 'boolean', 'example': False},
+                    'comments': {'type': 'string', 'example': 'Осторожно, хрупкий груз'}
+                },
+                'required': [
+                    'senderName', 'senderPhone', 'cargoDescription', 'productCategory',
+                    'cargoWeight', 'cargoVolume', 'cargoType', 'shippingDate',
+                    'pickupAddress', 'deliveryAddress', 'distance'
+                ]
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Заказ успешно создан',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Заказ успешно создан'},
+                    'order': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'price': {'type': 'number', 'example': 15000},
+                            'distance': {'type': 'number', 'example': 700}
+                        }
+                    }
+                }
+            }
+        },
+        400: {'description': 'Ошибка валидации'},
+        403: {'description': 'Доступ запрещен для администраторов и водителей'}
+    }
+})
+def create_order():
+    """Создать новый заказ"""
+    try:
+        data = request.get_json()
+        # Проверка, что пользователь не администратор и не водитель
+        conn = get_read_db()
+        user = UserRepo.role(conn, session['user_id'])
+        conn.close()
+        if user['is_admin'] or user['is_driver']:
+            return jsonify({'success': False, 'message': 'Заказ доступен только для обычных пользователей'}), 403
+        # Расчет расстояния (упрощенный)
+        pickup_address = data.get('pickupAddress', '')
+        delivery_address = data.get('deliveryAddress', '')
+        distance = data.get('distance', 100)  # По умолчанию 100 км
+        # Цена по действующей версии тарифа, версия сохраняется в заказе
+        cargo_weight = float(data.get('cargoWeight', 0))
+        cargo_volume = float(data.get('cargoVolume', 0))
+        tariff = current_tariff()
+        total_price = calculate_price(tariff, distance, cargo_weight, cargo_volume,
+                                      data.get('cargoType', 'general'),
+                                      data.get('insurance'), data.get('packaging'))
+        values = (
+            # При шардировании id выдает общая последовательность, иначе AUTOINCREMENT
+            allocate_order_id() if app.config['ORDER_SHARDS'] else None,
+            session['user_id'],
+            data.get('senderName', ''),
+            data.get('senderPhone', ''),
+            data.get('senderEmail', ''),
+            data.get('cargoDescription', ''),
+            data.get('productCategory', ''),
+            cargo_weight,
+            cargo_volume,
+            data.get('cargoType', 'general'),
+            data.get('shippingDate', ''),
+            pickup_address,
+            delivery_address,
+            distance,
+            total_price,
+            1 if data.get('insurance') else 0,
+            1 if data.get('packaging') else 0,
+            data.get('comments', ''),
+            'new',
+            'processing',
+            tariff.version,
+            address_city_id(pickup_address),
+            address_city_id(delivery_address)
+        )
+        order_id = run_write(lambda cursor: OrderRepo.create(cursor, values),
+                             order_database_for_user(session['user_id']))
+        return jsonify({
+            'success': True,
+            'message': 'Заказ успешно создан',
+            'order': {
+                'id': order_id,
+                'price': total_price,
+                'distance': distance,
+                'tariffVersion': tariff.version
+            }
+        })
+    except Exception as e:
+        print(f"[ERROR] Ошибка при создании заказа: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/orders/<int:order_id>', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'order_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заказа'
+        },
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Список полей через запятую (имеет приоритет над view)'
+        },
+        {
+            'name': 'view',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['compact', 'summary', 'full'],
+            'required': False,
+            'description': 'Именованный набор полей (по умолчанию full)'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Детали заказа',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'order': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'senderName': {'type': 'string', 'example': 'Иван Иванов'},
+                            'cargoDescription': {'type': 'string', 'example': 'Электроника'},
+                            'status': {'type': 'string', 'example': 'new'},
+                            'price': {'type': 'number', 'example': 1500}
+                        }
+                    }
+                }
+            }
+        },
+        400: {'description': 'Недопустимое поле или представление'},
+        403: {'description': 'Доступ запрещен'},
+        404: {'description': 'Заказ не найден'}
+    }
+})
+def get_order(order_id):
+    """Получить детали заказа"""
+    try:
+        fields = resolve_fields(ORDER_FIELDS, ORDER_VIEWS)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    # user_id нужен для проверки прав, даже если клиент его не запросил
+    query_fields = fields if 'user_id' in fields else fields + ['user_id']
+    # Заказ ищется и в основной БД (шардах), и в архиве
+    order = fetch_order_row(select_list(ORDER_FIELDS, query_fields), order_id)
+    if not order:
+        return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+    conn = get_read_db()
+    # Проверка прав доступа
+    user = UserRepo.role(conn, session['user_id'])
+    conn.close()
+    if not user['is_admin'] and not user['is_driver'] and order['user_id'] != session['user_id']:
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+    return jsonify({'success': True, 'order': {name: order[name] for name in fields}})
+
+@app.route('/api/orders/search', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'q',
+            'in': 'query',
+            'type': 'string',
+            'required': True,
+            'description': 'Строка поиска (префиксный поиск по словам)',
+            'example': 'Моск элект'
+        },
+        {
+            'name': 'limit',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': 'Максимум результатов (по умолчанию 50, не более 200)'
+        },
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Список полей через запятую (имеет приоритет над view)'
+        },
+        {
+            'name': 'view',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['compact', 'summary', 'full'],
+            'required': False,
+            'description': 'Именованный набор полей (по умолчанию summary)'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Найденные заказы, отсортированные по релевантности',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'orders': {'type': 'array', 'items': {'type': 'object'}}
+                }
+            }
+        },
+        400: {'description': 'Пустой запрос или недопустимые параметры'}
+    }
+})
+def search_orders():
+    """Полнотекстовый поиск по заказам с учетом роли пользователя"""
+    try:
+        fields = resolve_fields(ORDER_FIELDS, ORDER_VIEWS, default_view='summary')
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', ORDER_SEARCH_LIMIT)), 1), ORDER_SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit должен быть числом'}), 400
+    match = build_fts_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'success': False, 'message': 'Пустой поисковый запрос'}), 400
+    columns = ', '.join(f'o.{name}' for name in fields)
+    conn = get_read_db()
+    user = UserRepo.role(conn, session['user_id'])
+    conn.close()
+    params = [match]
+    databases = None
+    if user['is_admin']:
+        # Администратор ищет по всем заказам
+        visibility = ''
+    elif user['is_driver']:
+        # Водитель - только по назначенным ему
+        visibility = 'AND o.driver_id = ?'
+        params.append(session['user_id'])
+    else:
+        # Клиент - только по своим, они в одном шарде
+        visibility = 'AND o.user_id = ?'
+        params.append(session['user_id'])
+        databases = [order_database_for_user(session['user_id'])]
+    params.append(limit)
+    # Каждый шард отдает свои limit лучших, затем слияние по релевантности
+    row_lists = scatter_orders(f"""
+        SELECT {columns}, bm25(orders_fts, {ORDER_SEARCH_WEIGHTS}) AS search_rank
+        FROM orders_fts
+        JOIN orders o ON o.id = orders_fts.rowid
+        WHERE orders_fts MATCH ? {visibility}
+        ORDER BY search_rank
+        LIMIT ?
+    """, params, databases)
+    orders = [{name: row[name] for name in fields}
+              for row in merge_shard_rows(row_lists, lambda row: row['search_rank'], limit=limit)]
+    return jsonify({'success': True, 'orders': orders})
+
+@app.route('/api/orders/changes', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'since',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Курсор из прошлого ответа GET /api/orders или /api/orders/changes',
+            'example': '42'
+        },
+        {
+            'name': 'limit',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': 'Максимум заказов с каждого файла БД (по умолчанию 500, не более 2000)'
+        },
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Список полей через запятую (имеет приоритет над view)'
+        },
+        {
+            'name': 'view',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['compact', 'summary', 'full'],
+            'required': False,
+            'description': 'Именованный набор полей (по умолчанию summary)'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Заказы, измененные после курсора, и новый курсор',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'orders': {'type': 'array', 'items': {'type': 'object'}},
+                    'cursor': {'type': 'string', 'example': '57'},
+                    'removed': {
+                        'type': 'array',
+                        'items': {'type': 'integer'},
+                        'example': [17],
+                        'description': 'ID заказов, которые больше не видны пользователю (архив, другой водитель)'
+                    },
+                    'hasMore': {'type': 'boolean', 'example': False},
+                    'reset': {
+                        'type': 'boolean',
+                        'example': False,
+                        'description': 'Курсор не подходит (другое число шардов): заказы отданы с начала'
+                    }
+                }
+            }
+        },
+        400: {'description': 'Недопустимое поле, представление или limit'}
+    }
+})
+def get_order_changes():
+    """Заказы, измененные после курсора, в пределах видимости пользователя.
+
+    Заказы, перенесенные в архив или переназначенные другому водителю,
+    приходят в removed (из order_removals): клиент удаляет их из своего списка.
+    Если файл вернул меньше limit строк, его часть курсора сдвигается до
+    счетчика, прочитанного перед запросом, - иначе у клиента и водителя
+    курсор стоял бы на их последнем изменении и каждый опрос повторял бы
+    один и тот же диапазон.
+    """
+    try:
+        fields = resolve_fields(ORDER_FIELDS, ORDER_VIEWS, default_view='summary')
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', ORDER_CHANGES_LIMIT)), 1), ORDER_CHANGES_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit должен быть числом'}), 400
+    # id нужен клиенту для слияния, change_seq - для нового курсора
+    query_fields = fields + [name for name in ('id', 'change_seq') if name not in fields]
+    columns = select_list(ORDER_FIELDS, query_fields)
+    databases = order_databases()
+    since = parse_change_cursor(request.args.get('since', ''), len(databases))
+    reset = since is None
+    if reset:
+        since = [0] * len(databases)
+    conn = get_read_db()
+    user = UserRepo.role(conn, session['user_id'])
+    conn.close()
+    if user['is_admin']:
+        condition, params, scanned = '', (), list(range(len(databases)))
+        # Администратор видит и переназначенные заказы: пропадают только архивные
+        removal_condition = "AND kind = 'archived'"
+    elif user['is_driver']:
+        condition, params, scanned = 'AND driver_id = ?', (session['user_id'],), list(range(len(databases)))
+        removal_condition = 'AND driver_id = ?'
+    else:
+        # Заказы клиента целиком в одном шарде, остальные части курсора не меняются
+        condition, params = 'AND user_id = ?', (session['user_id'],)
+        scanned = [databases.index(order_database_for_user(session['user_id']))]
+        removal_condition = "AND kind = 'archived' AND user_id = ?"
+    scanned_databases = [databases[index] for index in scanned]
+    # Счетчики читаются до выборки: изменения после них придут повторно, но не потеряются
+    latest = order_change_seqs(scanned_databases)
+    row_lists = scatter_orders(
+        f'SELECT {columns} FROM orders WHERE change_seq > ? {condition} ORDER BY change_seq LIMIT ?',
+        lambda index: (since[scanned[index]], *params, limit),
+        scanned_databases)
+    cursor = list(since)
+    for position, (index, rows) in enumerate(zip(scanned, row_lists)):
+        if len(rows) == limit:
+            cursor[index] = rows[-1]['change_seq']
+        else:
+            cursor[index] = max(cursor[index], latest[position], rows[-1]['change_seq'] if rows else 0)
+    # Выборка removed идет после заказов и видит все номера до нового курсора.
+    # После сброса клиент загружает список заново, удалять ему нечего
+    removal_lists = [] if reset else scatter_orders(
+        f'SELECT change_seq, order_id FROM order_removals '
+        f'WHERE change_seq > ? AND change_seq <= ? {removal_condition}',
+        lambda index: (since[scanned[index]], cursor[scanned[index]], *params),
+        scanned_databases)
+    removed = []
+    for rows, removals in zip(row_lists, removal_lists):
+        # Заказ, снова ставший видимым после удаления, придет в orders с большим change_seq
+        returned = {row['id']: row['change_seq'] for row in rows}
+        removed.extend(removal['order_id'] for removal in removals
+                       if returned.get(removal['order_id'], 0) <= removal['change_seq'])
+    return jsonify({
+        'success': True,
+        'orders': [{name: row[name] for name in fields} for rows in row_lists for row in rows],
+        'removed': sorted(set(removed)),
+        'cursor': format_change_cursor(cursor),
+        'hasMore': any(len(rows) == limit for rows in row_lists),
+        'reset': reset
+    })
+
+@app.route('/api/orders/facets', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {
+            'description': 'Количество заказов по значениям полей с учетом роли пользователя',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Регистрация успешна'},
-                    'user': {
+                    'total': {'type': 'integer', 'example': 12},
+                    'facets': {
                         'type': 'object',
                         'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'email': {'type': 'string', 'example': 'user@example.com'},
-                            'phone': {'type': 'string', 'example': '+79123456789'},
-                            'firstName': {'type': 'string', 'example': 'Иван'},
-                            'lastName': {'type': 'string', 'example': 'Иванов'},
-                            'verified': {'type': 'boolean', 'example': True},
-                            'isAdmin': {'type': 'boolean', 'example': False},
-                            'isDriver': {'type': 'boolean', 'example': False}
+                            'status': {'type': 'object', 'example': {'new': 3, 'delivered': 9}},
+                            'clientStatus': {'type': 'object', 'example': {'processing': 3, 'delivered': 9}},
+                            'productCategory': {'type': 'object', 'example': {'electronics': 12}},
+                            'cargoType': {'type': 'object', 'example': {'general': 12}},
+                            'shippingDate': {
+                                'type': 'object',
+                                'description': 'Корзины: past, today, week (7 дней), later, none',
+                                'example': {'past': 9, 'week': 3}
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def get_order_facets():
+    """Счетчики для вкладок и фильтров списка заказов без загрузки самих заказов"""
+    user_id = session['user_id']
+    conn = get_read_db()
+    user = UserRepo.role(conn, user_id)
+    conn.close()
+    if user['is_admin']:
+        scope, condition, params, tag = 'admin', '', (), 'orders'
+        databases = order_databases()
+    elif user['is_driver']:
+        scope, condition, params, tag = 'driver', 'WHERE driver_id = ?', (user_id,), f'orders:driver:{user_id}'
+        databases = order_databases()
+    else:
+        scope, condition, params, tag = 'user', 'WHERE user_id = ?', (user_id,), f'orders:user:{user_id}'
+        databases = [order_database_for_user(user_id)]
+    today = datetime.now().date()
+
+    def build():
+        # Группировка в порядке покрывающего индекса idx_orders*_facets: строки таблицы не читаются
+        row_lists = scatter_orders(f'''
+            SELECT {', '.join(ORDER_FACET_COLUMNS)}, COUNT(*) AS orders
+            FROM {{source}} {condition}
+            GROUP BY {', '.join(ORDER_FACET_COLUMNS)}
+        ''', params, databases)
+        return jsonify({'success': True, **fold_order_facets(itertools.chain.from_iterable(row_lists), today)})
+
+    # Корзины дат зависят от текущего дня, поэтому он входит в ключ
+    return cached_json(('order_facets', user_id, scope, today.isoformat()), (tag,), build, databases)
+
+@app.route('/api/orders/<int:order_id>/timeline', methods=['GET'])
+@login_required
+@swag_from({
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'order_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заказа'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'События заказа по порядку с временем от предыдущего события',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'events': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'seq': {'type': 'integer', 'example': 2},
+                                'type': {'type': 'string', 'example': 'confirmed'},
+                                'at': {'type': 'string', 'example': '2026-10-19 10:15:00'},
+                                'actorId': {'type': 'integer', 'example': 1},
+                                'driverId': {'type': 'integer', 'example': None},
+                                'sincePrevious': {'type': 'number', 'example': 540.0}
+                            }
                         }
                     }
                 }
             }
         },
-        400: {'description': 'Ошибка валидации'}
+        403: {'description': 'Доступ запрещен'},
+        404: {'description': 'Заказ не найден'}
     }
 })
-def register():
-    """Регистрация пользователя"""
+def get_order_timeline(order_id):
+    """История переходов заказа из order_events"""
+    order = fetch_order_row('user_id', order_id)
+    if not order:
+        return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+    conn = get_read_db()
+    user = UserRepo.role(conn, session['user_id'])
+    conn.close()
+    if not user['is_admin'] and not user['is_driver'] and order['user_id'] != session['user_id']:
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+    # События лежат в шарде клиента и остаются там после архивации заказа
+    conn = get_read_db(order_database_for_user(order['user_id']))
+    rows = OrderRepo.events(conn, order_id)
+    conn.close()
+    events = []
+    previous = None
+    for row in rows:
+        events.append({
+            'seq': row['seq'],
+            'type': row['type'],
+            'at': order_event_time(row['at']),
+            'actorId': row['actor_id'],
+            'driverId': row['driver_id'],
+            'sincePrevious': round(row['at'] - previous, 1) if previous is not None else None
+        })
+        previous = row['at']
+    return jsonify({'success': True, 'events': events})
+
+@app.route('/api/admin/orders/stage-durations', methods=['GET'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'days',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': 'Этапы, завершенные за последние N дней (по умолчанию 30, не более 365)'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Перцентили длительности этапов в секундах',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'days': {'type': 'integer', 'example': 30},
+                    'stages': {
+                        'type': 'object',
+                        'example': {
+                            'confirmToAssign': {'count': 120, 'avg': 1800.0, 'max': 7200.0,
+                                                'p50': 1500.0, 'p90': 4100.0, 'p99': 6900.0}
+                        }
+                    }
+                }
+            }
+        },
+        400: {'description': 'Некорректный параметр days'}
+    }
+})
+def admin_order_stage_durations():
+    """Длительности этапов подтверждение -> назначение -> принятие -> доставка по всему парку"""
+    try:
+        days = min(max(int(request.args.get('days', 30)), 1), ORDER_STAGE_MAX_DAYS)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'days должен быть числом'}), 400
+    since = time.time() - days * 86400
+    return jsonify({'success': True, 'days': days, 'stages': order_stage_durations(since)})
+
+@app.route('/api/admin/analytics/query', methods=['POST'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'groupBy': {
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'example': ['productCategory', 'createdWeek'],
+                        'description': 'Измерения: cargoType, productCategory, status, clientStatus, '
+                                       'insurance, packaging, created/shipping + Day/Week/Month'
+                    },
+                    'metrics': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'op': {'type': 'string', 'enum': ['count', 'sum', 'avg', 'min', 'max']},
+                                'field': {'type': 'string', 'enum': ['price', 'distance', 'weight', 'volume',
+                                                                     'insurance', 'packaging', 'pricePerKm']},
+                                'as': {'type': 'string', 'description': 'Имя показателя в ответе'}
+                            }
+                        },
+                        'example': [{'op': 'sum', 'field': 'price'}, {'op': 'count'}]
+                    },
+                    'filters': {
+                        'type': 'object',
+                        'example': {'status': ['delivered'], 'createdFrom': '2025-01-01'},
+                        'description': 'Категории и флаги - список допустимых значений; '
+                                       'createdFrom/createdTo/shippingFrom/shippingTo - даты включительно'
+                    },
+                    'orderBy': {'type': 'string', 'example': 'sumPrice'},
+                    'order': {'type': 'string', 'enum': ['asc', 'desc']},
+                    'limit': {'type': 'integer', 'example': 1000},
+                    'fresh': {'type': 'boolean', 'description': 'Дочитать изменения заказов перед запросом'}
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Группы с показателями',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'rows': {'type': 'integer', 'example': 120000},
+                    'refreshedAt': {'type': 'string', 'example': '2025-03-01 12:00:00'},
+                    'totalGroups': {'type': 'integer', 'example': 52},
+                    'groups': {
+                        'type': 'array',
+                        'items': {'type': 'object'},
+                        'example': [{'productCategory': 'electronics', 'createdWeek': '2025-02-24',
+                                     'sumPrice': 154000.0, 'count': 12.0}]
+                    }
+                }
+            }
+        },
+        400: {'description': 'Некорректный запрос'},
+        503: {'description': 'На сервере не установлен NumPy'}
+    }
+})
+def admin_analytics_query():
+    """Группировки и агрегаты по заказам из колоночного куба в памяти"""
+    if np is None:
+        return jsonify({'success': False, 'message': 'Аналитика недоступна: не установлен NumPy'}), 503
+    data = request.get_json(silent=True)
+    try:
+        spec = parse_analytics_query(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        result = run_analytics_query(spec, fresh=bool(data.get('fresh')))
+    except Exception as e:
+        print(f"[ERROR] admin_analytics_query: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+    return jsonify({'success': True, **result})
+
+# === АДМИН: обработка заказов ===
+@app.route('/api/admin/orders/<int:order_id>/decision', methods=['POST'])
+@admin_required
+@idempotent('admin_order_decision')
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'order_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заказа'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'decision': {'type': 'string', 'enum': ['confirm', 'reject'], 'example': 'confirm'},
+                    'comment': {'type': 'string', 'example': 'Заказ подтвержден'}
+                },
+                'required': ['decision']
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Решение по заказу применено',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Решение применено'},
+                    'status': {'type': 'string', 'example': 'confirmed'}
+                }
+            }
+        },
+        400: {'description': 'Некорректное решение'},
+        404: {'description': 'Заказ не найден'}
+    }
+})
+def admin_order_decision(order_id):
+    """Подтвердить / отклонить заказ"""
     try:
         data = request.get_json()
-        email = data.get('email', '').strip()
-        phone = data.get('phone', '').strip()
-        password = data.get('password', '')
-        first_name = data.get('firstName', '').strip()
-        last_name = data.get('lastName', '').strip()
-        if not all([email, phone, password, first_name, last_name]):
-            return jsonify({'success': False, 'message': 'Заполните все поля'}), 400
-        if len(password) < 6:
-            return jsonify({'success': False, 'message': 'Пароль должен быть не менее 6 символов'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        # Проверка существования email или телефона
-        cursor.execute('SELECT id FROM users WHERE email = ? OR phone = ?', (email, phone))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({'success': False, 'message': 'Пользователь с таким email или телефоном уже существует'}), 400
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
-        cursor.execute('''
-            INSERT INTO users (email, phone, password, first_name, last_name, verified)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (email, phone, hashed_password, first_name, last_name, 1))
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        # Автоматический вход после регистрации
-        session['user_id'] = user_id
-        return jsonify({
-            'success': True,
-            'message': 'Регистрация успешна',
-            'user': {
-                'id': user_id,
-                'email': email,
-                'phone': phone,
-                'firstName': first_name,
-                'lastName': last_name,
-                'verified': True,
-                'isAdmin': False,
-                'isDriver': False
+        decision = data.get('decision')
+        comment = data.get('comment', '')
+        if decision not in ['confirm', 'reject']:
+            return jsonify({'success': False, 'message': 'Некорректное решение'}), 400
+        new_status = 'confirmed' if decision == 'confirm' else 'rejected'
+        admin_id = session['user_id']
+        database = locate_order(order_id)
+        if database is None:
+            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+        def write(cursor):
+            if not OrderRepo.parties(cursor, order_id):
+                raise WriteRejected('Заказ не найден', 404)
+            OrderRepo.set_decision(cursor, [order_id], new_status, comment, datetime.now(), admin_id)
+        run_write(write, database)
+        return jsonify({'success': True, 'message': 'Решение применено', 'status': new_status})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
+    except Exception as e:
+        print(f"[ERROR] admin_order_decision: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/admin/orders/<int:order_id>/assign', methods=['POST'])
+@admin_required
+@idempotent('admin_assign_driver')
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'order_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заказа'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'driverId': {'type': 'integer', 'example': 5}
+                },
+                'required': ['driverId']
             }
-        })
-    except sqlite3.IntegrityError:
-        return jsonify({'success': False, 'message': 'Пользователь с таким email или телефоном уже существует'}), 400
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Водитель успешно назначен',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Водитель назначен'},
+                    'driverId': {'type': 'integer', 'example': 5}
+                }
+            }
+        },
+        400: {'description': 'Некорректные данные'},
+        404: {'description': 'Заказ или водитель не найден'}
+    }
+})
+def admin_assign_driver(order_id):
+    """Назначить водителя на заказ"""
+    try:
+        data = request.get_json()
+        driver_id = data.get('driverId')
+        if not driver_id:
+            return jsonify({'success': False, 'message': 'driverId обязателен'}), 400
+        database = locate_order(order_id)
+        if database is None:
+            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+        # Проверяем, что driver_id существует как пользователь с is_driver=1
+        conn = get_read_db()
+        is_driver = UserRepo.is_driver(conn, driver_id)
+        conn.close()
+        if not is_driver:
+            return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
+        admin_id = session['user_id']
+        # Таблица users в основной БД: если заказ там же, роль перепроверяется
+        # в транзакции записи (водителя могли уволить после чтения выше)
+        same_database = database == app.config['DATABASE']
+        def write(cursor):
+            # Проверяем заказ
+            if not OrderRepo.parties(cursor, order_id):
+                raise WriteRejected('Заказ не найден', 404)
+            if same_database and not UserRepo.is_driver(cursor, driver_id):
+                raise WriteRejected('Водитель не найден', 404)
+            OrderRepo.assign(cursor, [order_id], driver_id, datetime.now(), admin_id)
+        run_write(write, database)
+        _positions.forget_order(order_id)
+        return jsonify({'success': True, 'message': 'Водитель назначен', 'driverId': driver_id})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
     except Exception as e:
-        print(f"[ERROR] Ошибка при регистрации: {e}", file=sys.stderr)
+        print(f"[ERROR] admin_assign_driver: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/login', methods=['POST'])
+@app.route('/api/orders/<int:order_id>/status', methods=['POST'])
+@login_required
+@idempotent('update_order_status')
 @swag_from({
-    'tags': ['Авторизация'],
+    'tags': ['Заказы'],
+    'security': [{'SessionAuth': []}],
     'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'order_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заказа'
+        },
         {
             'name': 'body',
             'in': 'body',
@@ -359,358 +6107,547 @@ def register():
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'login': {'type': 'string', 'description': 'Email или телефон', 'example': "+79123456789"},
-                    'password': {'type': 'string', 'example': "secure123"}
+                    'status': {'type': 'string', 'example': 'in_transit'},
+                    'clientStatus': {'type': 'string', 'example': 'in_transit'}
                 },
-                'required': ['login', 'password']
+                'required': ['status']
             }
         }
     ],
     'responses': {
         200: {
-            'description': 'Успешный вход',
+            'description': 'Статус успешно обновлен',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Вход выполнен успешно'},
-                    'user': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'email': {'type': 'string', 'example': 'user@example.com'},
-                            'phone': {'type': 'string', 'example': '+79123456789'},
-                            'firstName': {'type': 'string', 'example': 'Иван'},
-                            'lastName': {'type': 'string', 'example': 'Иванов'},
-                            'verified': {'type': 'boolean', 'example': True},
-                            'isAdmin': {'type': 'boolean', 'example': False},
-                            'isDriver': {'type': 'boolean', 'example': False}
-                        }
-                    }
+                    'message': {'type': 'string', 'example': 'Статус обновлен'}
                 }
             }
         },
-        400: {'description': 'Ошибка валидации'},
-        401: {'description': 'Неверные учетные данные'}
+        403: {'description': 'Доступ запрещен'},
+        404: {'description': 'Заказ не найден'}
     }
 })
-def login():
-    """Вход пользователя"""
+def update_order_status(order_id):
+    """Обновление статуса заказа (водитель/админ/клиент)"""
     try:
         data = request.get_json()
-        login_field = data.get('login', '').strip()  # email или phone
-        password = data.get('password', '')
-        if not login_field or not password:
-            return jsonify({'success': False, 'message': 'Заполните все поля'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, email, phone, password, first_name, last_name, verified, is_admin, is_driver
-            FROM users WHERE email = ? OR phone = ?
-        ''', (login_field, login_field))
-        user = cursor.fetchone()
+        new_status = data.get('status')
+        client_status = data.get('clientStatus')
+        user_id = session['user_id']
+        database = locate_order(order_id)
+        if database is None:
+            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+        conn = get_read_db()
+        role = UserRepo.role(conn, user_id)
         conn.close()
-        if user and check_password_hash(user['password'], password):
-            if not user['verified']:
-                return jsonify({'success': False, 'message': 'Аккаунт не подтвержден'}), 400
-            session['user_id'] = user['id']
-            return jsonify({
-                'success': True,
-                'message': 'Вход выполнен успешно',
-                'user': {
-                    'id': user['id'],
-                    'email': user['email'],
-                    'phone': user['phone'],
-                    'firstName': user['first_name'],
-                    'lastName': user['last_name'],
-                    'verified': bool(user['verified']),
-                    'isAdmin': bool(user['is_admin']),
-                    'isDriver': bool(user['is_driver'])
-                }
-            })
-        else:
-            return jsonify({'success': False, 'message': 'Неверный телефон/email или пароль'}), 401
+        # Таблицы users и drivers в основной БД: если заказ там же, роль
+        # перепроверяется в транзакции записи, а счетчик водителя обновляется
+        # в ней же; при шардах - роль из чтения выше и отдельная запись счетчика
+        same_database = database == app.config['DATABASE']
+        def write(cursor):
+            order = OrderRepo.parties(cursor, order_id)
+            if not order:
+                raise WriteRejected('Заказ не найден', 404)
+            current = UserRepo.role(cursor, user_id) if same_database else role
+            if current is None:
+                raise WriteRejected('Доступ запрещен', 403)
+            # Проверка прав: админ — любые, водитель — только свои, клиент — только свой
+            is_admin = bool(current['is_admin'])
+            is_driver = bool(current['is_driver'])
+            is_owner = (order['user_id'] == user_id)
+            if is_driver and order['driver_id'] != user_id and not is_admin:
+                raise WriteRejected('Доступ запрещен', 403)
+            if not (is_admin or is_driver or is_owner):
+                raise WriteRejected('Доступ запрещен', 403)
+            # Обновляем статус и соответствующее поле времени
+            OrderRepo.set_status(cursor, order_id, new_status, client_status, actor_id=user_id)
+            credited = None
+            if new_status == 'delivered' and is_driver and order['driver_id']:
+                # Обновляем статистику водителя
+                credited = order['driver_id']
+                if same_database:
+                    DriverRepo.credit_delivery(cursor, credited)
+            return credited
+        credited = run_write(write, database)
+        if credited and not same_database:
+            run_write(lambda cursor: DriverRepo.credit_delivery(cursor, credited))
+        if new_status not in GPS_TRACKED_STATUSES:
+            _positions.forget_order(order_id)
+        return jsonify({'success': True, 'message': 'Статус обновлен'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
     except Exception as e:
-        print(f"[ERROR] Ошибка при входе: {e}", file=sys.stderr)
+        print(f"[ERROR] update_order_status: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/logout', methods=['POST'])
+@app.route('/api/driver/orders/<int:order_id>/accept', methods=['POST'])
+@login_required
+@idempotent('driver_accept_order')
 @swag_from({
-    'tags': ['Авторизация'],
+    'tags': ['Водители'],
     'security': [{'SessionAuth': []}],
+    'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'order_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заказа'
+        }
+    ],
     'responses': {
         200: {
-            'description': 'Успешный выход',
+            'description': 'Заказ успешно принят',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Выход выполнен успешно'}
+                    'message': {'type': 'string', 'example': 'Заказ принят'}
                 }
             }
-        }
+        },
+        403: {'description': 'Доступ запрещен (нет прав водителя или заказ не назначен)'},
+        404: {'description': 'Заказ не найден'}
     }
 })
-def logout():
-    """Выход из системы"""
-    session.clear()
-    return jsonify({'success': True, 'message': 'Выход выполнен успешно'})
+def driver_accept_order(order_id):
+    """Водитель принимает заказ (меняет статус на in_transit)"""
+    try:
+        user_id = session['user_id']
+        # Проверяем что пользователь - водитель
+        conn = get_read_db()
+        is_driver = UserRepo.is_driver(conn, user_id)
+        conn.close()
+        if not is_driver:
+            return jsonify({'success': False, 'message': 'Только водители могут принимать заказы'}), 403
+        database = locate_order(order_id)
+        if database is None:
+            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+        # Если заказ в основной БД, роль перепроверяется в транзакции записи
+        same_database = database == app.config['DATABASE']
+        def write(cursor):
+            # Проверяем заказ
+            order = OrderRepo.parties(cursor, order_id)
+            if not order:
+                raise WriteRejected('Заказ не найден', 404)
+            if same_database and not UserRepo.is_driver(cursor, user_id):
+                raise WriteRejected('Только водители могут принимать заказы', 403)
+            # Проверяем что заказ назначен этому водителю
+            if order['driver_id'] != user_id:
+                raise WriteRejected('Заказ не назначен вам', 403)
+            # Обновляем статус
+            OrderRepo.accept(cursor, order_id, datetime.now(), user_id)
+        run_write(write, database)
+        return jsonify({'success': True, 'message': 'Заказ принят'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
+    except Exception as e:
+        print(f"[ERROR] driver_accept_order: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/current-user', methods=['GET'])
+# === АДМИН: массовые операции ===
+@app.route('/api/admin/orders/bulk', methods=['POST'])
+@admin_required
+@idempotent('admin_bulk_orders')
 @swag_from({
-    'tags': ['Авторизация'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
+    'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'action': {'type': 'string', 'enum': ['confirm', 'reject', 'assign'], 'example': 'confirm'},
+                    'orderIds': {'type': 'array', 'items': {'type': 'integer'}, 'example': [12, 13, 14]},
+                    'driverId': {'type': 'integer', 'description': 'Для action=assign', 'example': 5},
+                    'comment': {'type': 'string', 'example': 'Подтверждено пакетом'}
+                },
+                'required': ['action', 'orderIds']
+            }
+        }
+    ],
     'responses': {
         200: {
-            'description': 'Текущий пользователь',
+            'description': 'Результат по каждому заказу; успешные изменения фиксируются одной транзакцией',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'user': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'email': {'type': 'string', 'example': 'user@example.com'},
-                            'phone': {'type': 'string', 'example': '+79123456789'},
-                            'firstName': {'type': 'string', 'example': 'Иван'},
-                            'lastName': {'type': 'string', 'example': 'Иванов'},
-                            'verified': {'type': 'boolean', 'example': True},
-                            'isAdmin': {'type': 'boolean', 'example': False},
-                            'isDriver': {'type': 'boolean', 'example': False}
-                        }
-                    }
+                    'processed': {'type': 'integer', 'example': 3},
+                    'succeeded': {'type': 'integer', 'example': 2},
+                    'failed': {'type': 'integer', 'example': 1},
+                    'results': {'type': 'array', 'items': {'type': 'object'}}
                 }
             }
-        }
+        },
+        400: {'description': 'Ошибка валидации'},
+        404: {'description': 'Водитель не найден'}
     }
 })
-def current_user():
-    """Получить текущего пользователя"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'user': None})
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, email, phone, first_name, last_name, verified, is_admin, is_driver
-        FROM users WHERE id = ?
-    ''', (session['user_id'],))
-    user = cursor.fetchone()
-    conn.close()
-    if user:
-        return jsonify({
-            'success': True,
-            'user': {
-                'id': user['id'],
-                'email': user['email'],
-                'phone': user['phone'],
-                'firstName': user['first_name'],
-                'lastName': user['last_name'],
-                'verified': bool(user['verified']),
-                'isAdmin': bool(user['is_admin']),
-                'isDriver': bool(user['is_driver'])
-            }
-        })
-    else:
-        session.clear()
-        return jsonify({'success': False, 'user': None})
+def admin_bulk_orders():
+    """Подтвердить, отклонить или назначить водителя сразу для списка заказов"""
+    try:
+        data = request.get_json() or {}
+        action = data.get('action')
+        if action not in ('confirm', 'reject', 'assign'):
+            return jsonify({'success': False, 'message': 'Некорректное действие'}), 400
+        order_ids = parse_bulk_ids(data, 'orderIds')
+        driver_id = data.get('driverId')
+        if action == 'assign' and not driver_id:
+            return jsonify({'success': False, 'message': 'driverId обязателен'}), 400
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        comment = data.get('comment', '')
+        admin_id = session['user_id']
+        if action == 'assign':
+            conn = get_read_db()
+            is_driver = UserRepo.is_driver(conn, driver_id)
+            conn.close()
+            if not is_driver:
+                return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
+        def write(ids, database):
+            def apply(cursor):
+                # Водителя перепроверяем в транзакции, если users в том же файле
+                if action == 'assign' and database == app.config['DATABASE'] \
+                        and not UserRepo.is_driver(cursor, driver_id):
+                    raise WriteRejected('Водитель не найден', 404)
+                # Одна проверка на весь список вместо запроса на каждый заказ
+                found = OrderRepo.present(cursor, ids)
+                valid = [order_id for order_id in ids if order_id in found]
+                if action == 'assign':
+                    OrderRepo.assign(cursor, valid, driver_id, datetime.now(), admin_id)
+                else:
+                    status = 'confirmed' if action == 'confirm' else 'rejected'
+                    OrderRepo.set_decision(cursor, valid, status, comment, datetime.now(), admin_id)
+                return valid
+            return apply
+        # Каждый шард обновляет найденные у себя заказы одной транзакцией;
+        # оставшиеся id передаются следующему шарду
+        valid = []
+        remaining = order_ids
+        for database in order_databases():
+            if not remaining:
+                break
+            applied = set(run_write(write(remaining, database), database))
+            valid.extend(order_id for order_id in remaining if order_id in applied)
+            remaining = [order_id for order_id in remaining if order_id not in applied]
+        missing = set(remaining)
+        results = [{'id': order_id, 'success': order_id not in missing,
+                    'message': 'Заказ не найден' if order_id in missing else None} for order_id in order_ids]
+        if action == 'assign':
+            for order_id in valid:
+                _positions.forget_order(order_id)
+        return bulk_response(results)
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
+    except Exception as e:
+        print(f"[ERROR] admin_bulk_orders: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-# === ПРОФИЛЬ ===
-@app.route('/api/profile', methods=['GET'])
-@login_required
+@app.route('/api/admin/driver_applications/bulk', methods=['POST'])
+@admin_required
+@idempotent('admin_bulk_driver_applications')
 @swag_from({
-    'tags': ['Профиль'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
-    'responses': {
-        200: {
-            'description': 'Профиль пользователя',
+    'parameters': [
+        IDEMPOTENCY_KEY_PARAM,
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'success': {'type': 'boolean', 'example': True},
-                    'user': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'email': {'type': 'string', 'example': 'user@example.com'},
-                            'phone': {'type': 'string', 'example': '+79123456789'},
-                            'firstName': {'type': 'string', 'example': 'Иван'},
-                            'lastName': {'type': 'string', 'example': 'Иванов'},
-                            'verified': {'type': 'boolean', 'example': True},
-                            'isAdmin': {'type': 'boolean', 'example': False},
-                            'isDriver': {'type': 'boolean', 'example': False}
-                        }
-                    }
-                }
+                    'action': {'type': 'string', 'enum': ['approve', 'reject'], 'example': 'approve'},
+                    'applicationIds': {'type': 'array', 'items': {'type': 'integer'}, 'example': [3, 4]}
+                },
+                'required': ['action', 'applicationIds']
             }
-        },
-        404: {'description': 'Пользователь не найден'}
+        }
+    ],
+    'responses': {
+        200: {'description': 'Результат по каждой заявке; успешные изменения фиксируются одной транзакцией'},
+        400: {'description': 'Ошибка валидации'}
     }
 })
-def get_profile():
-    """Получить профиль пользователя"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, email, phone, first_name, last_name, verified, is_admin, is_driver
-        FROM users WHERE id = ?
-    ''', (session['user_id'],))
-    user = cursor.fetchone()
-    conn.close()
-    if user:
+def admin_bulk_driver_applications():
+    """Одобрить или отклонить сразу список заявок водителей"""
+    try:
+        data = request.get_json() or {}
+        action = data.get('action')
+        if action not in ('approve', 'reject'):
+            return jsonify({'success': False, 'message': 'Некорректное действие'}), 400
+        app_ids = parse_bulk_ids(data, 'applicationIds')
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        admin_id = session['user_id']
+        def write(cursor):
+            now = datetime.now()
+            apps = ApplicationRepo.get_many(cursor, app_ids)
+            results = []
+            valid = []
+            if action == 'reject':
+                for app_id in app_ids:
+                    ok = app_id in apps
+                    results.append({'id': app_id, 'success': ok, 'message': None if ok else 'Заявка не найдена'})
+                    if ok:
+                        valid.append(app_id)
+                ApplicationRepo.set_status(cursor, valid, 'rejected', admin_id, now)
+                return results
+            user_ids = list({app['user_id'] for app in apps.values()})
+            taken = DriverRepo.present(cursor, user_ids)
+            approved = []
+            for app_id in app_ids:
+                app = apps.get(app_id)
+                if app is None:
+                    message = 'Заявка не найдена'
+                elif app['status'] != 'pending':
+                    message = 'Заявка уже обработана'
+                elif app['user_id'] in taken:
+                    message = 'Пользователь уже водитель'
+                else:
+                    message = None
+                    taken.add(app['user_id'])
+                    approved.append(app)
+                results.append({'id': app_id, 'success': message is None, 'message': message})
+            DriverRepo.create_from_applications(cursor, approved, now.date().isoformat())
+            UserRepo.set_driver(cursor, [app['user_id'] for app in approved], True)
+            ApplicationRepo.set_status(cursor, [app['id'] for app in approved], 'approved', admin_id, now)
+            return results
+        return bulk_response(run_write(write))
+    except Exception as e:
+        print(f"[ERROR] admin_bulk_driver_applications: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# === АДМИН: архив заказов ===
+@app.route('/api/admin/archive', methods=['GET'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {
+            'description': 'Состояние архива заказов',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'hotOrders': {'type': 'integer', 'example': 1200},
+                    'archivedOrders': {'type': 'integer', 'example': 54000},
+                    'pendingOrders': {'type': 'integer', 'example': 300},
+                    'freePages': {'type': 'integer', 'example': 0}
+                }
+            }
+        }
+    }
+})
+def admin_archive_status():
+    """Статистика горячих и архивных заказов"""
+    try:
+        cutoff = datetime.now() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+        status_marks = ', '.join('?' for _ in ARCHIVABLE_STATUSES)
+        counts_query = f'''
+            SELECT COUNT(*),
+                   COALESCE(SUM(status IN ({status_marks})
+                                AND COALESCE(delivered_at, cancelled_at, processed_at) < ?), 0),
+                   (SELECT freelist_count FROM pragma_freelist_count())
+            FROM main.orders
+        '''
+        params = (*ARCHIVABLE_STATUSES, cutoff)
+        # Счетчики основной БД считаются в одном снимке, чтобы не разойтись при параллельной архивации
+        with read_snapshot(with_archive=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM archive.orders')
+            archived = cursor.fetchone()[0]
+            cursor.execute(counts_query, params)
+            totals = [tuple(cursor.fetchone())]
+        if app.config['ORDER_SHARDS']:
+            totals.extend(tuple(rows[0]) for rows in scatter_orders(counts_query, params))
+        hot, pending, free_pages = (sum(column) for column in zip(*totals))
         return jsonify({
             'success': True,
-            'user': {
-                'id': user['id'],
-                'email': user['email'],
-                'phone': user['phone'],
-                'firstName': user['first_name'],
-                'lastName': user['last_name'],
-                'verified': bool(user['verified']),
-                'isAdmin': bool(user['is_admin']),
-                'isDriver': bool(user['is_driver'])
-            }
+            'hotOrders': hot,
+            'archivedOrders': archived,
+            'pendingOrders': pending,
+            'freePages': free_pages,
+            'archiveAfterDays': app.config['ARCHIVE_AFTER_DAYS']
         })
-    return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
+    except Exception as e:
+        print(f"[ERROR] admin_archive_status: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/profile', methods=['POST'])
-@login_required
+@app.route('/api/admin/archive', methods=['POST'])
+@admin_required
 @swag_from({
-    'tags': ['Профиль'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
             'name': 'body',
             'in': 'body',
-            'required': True,
+            'required': False,
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'firstName': {'type': 'string', 'example': 'Иван'},
-                    'lastName': {'type': 'string', 'example': 'Иванов'},
-                    'email': {'type': 'string', 'example': 'new_email@example.com'},
-                    'phone': {'type': 'string', 'example': '+79123456789'}
-                },
-                'required': ['firstName', 'lastName', 'email', 'phone']
+                    'days': {'type': 'integer', 'example': 90},
+                    'batchSize': {'type': 'integer', 'example': 500},
+                    'maxBatches': {'type': 'integer', 'example': 20}
+                }
             }
         }
     ],
     'responses': {
         200: {
-            'description': 'Профиль успешно обновлен',
+            'description': 'Архивация выполнена',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Профиль обновлен'}
+                    'moved': {'type': 'integer', 'example': 1000},
+                    'batches': {'type': 'integer', 'example': 2},
+                    'reclaimedPages': {'type': 'integer', 'example': 150}
                 }
             }
         },
-        400: {'description': 'Ошибка валидации'}
+        400: {'description': 'Некорректные параметры'}
     }
 })
-def update_profile():
-    """Обновить профиль пользователя"""
+def admin_run_archive():
+    """Перенести завершенные заказы в архив"""
     try:
-        data = request.get_json()
-        first_name = data.get('firstName', '').strip()
-        last_name = data.get('lastName', '').strip()
-        email = data.get('email', '').strip()
-        phone = data.get('phone', '').strip()
-        conn = get_db()
-        cursor = conn.cursor()
-        # Проверка уникальности email и phone
-        cursor.execute('SELECT id FROM users WHERE (email = ? OR phone = ?) AND id != ?',
-                      (email, phone, session['user_id']))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({'success': False, 'message': 'Email или телефон уже используются'}), 400
-        cursor.execute('''
-            UPDATE users SET first_name = ?, last_name = ?, email = ?, phone = ?
-            WHERE id = ?
-        ''', (first_name, last_name, email, phone, session['user_id']))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Профиль обновлен'})
+        data = request.get_json(silent=True) or {}
+        try:
+            days = int(data.get('days', app.config['ARCHIVE_AFTER_DAYS']))
+            batch_size = int(data.get('batchSize', app.config['ARCHIVE_BATCH_SIZE']))
+            max_batches = int(data['maxBatches']) if data.get('maxBatches') else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Некорректные параметры'}), 400
+        if days < 0 or batch_size <= 0:
+            return jsonify({'success': False, 'message': 'Некорректные параметры'}), 400
+        result = archive_finished_orders(days, batch_size, max_batches)
+        return jsonify({'success': True, **result})
     except Exception as e:
-        print(f"[ERROR] Ошибка при обновлении профиля: {e}", file=sys.stderr)
+        print(f"[ERROR] admin_run_archive: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/profile/password', methods=['POST'])
-@login_required
+# === АДМИН: консолидация грузов ===
+@app.route('/api/admin/consolidation', methods=['GET'])
+@admin_required
 @swag_from({
-    'tags': ['Профиль'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
-        {
-            'name': 'body',
-            'in': 'body',
-            'required': True,
-            'schema': {
-                'type': 'object',
-                'properties': {
-                    'currentPassword': {'type': 'string', 'example': 'old_secure123'},
-                    'newPassword': {'type': 'string', 'example': 'new_secure123'},
-                    'isRecovery': {'type': 'boolean', 'example': False}
-                },
-                'required': ['newPassword']
-            }
-        }
+        {'name': 'dateFrom', 'in': 'query', 'type': 'string', 'required': False, 'example': '2026-11-01'},
+        {'name': 'dateTo', 'in': 'query', 'type': 'string', 'required': False, 'example': '2026-11-07'}
     ],
     'responses': {
         200: {
-            'description': 'Пароль успешно изменен',
+            'description': 'План загрузки подтвержденных заказов по направлениям и датам отправки',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Пароль успешно изменен'}
+                    'plans': {'type': 'array', 'items': {'type': 'object'}},
+                    'summary': {'type': 'object'}
                 }
             }
-        },
-        400: {'description': 'Ошибка валидации'}
+        }
     }
 })
-def change_password():
-    """Смена пароля (с поддержкой восстановления)"""
+def admin_consolidation():
+    """План консолидации: подтвержденные заказы без водителя раскладываются по машинам активного парка"""
     try:
-        data = request.get_json()
-        current_password = data.get('currentPassword', '')
-        new_password = data.get('newPassword', '')
-        is_recovery = data.get('isRecovery', False)  # Новый флаг
-        if not new_password:
-            return jsonify({'success': False, 'message': 'Новый пароль обязателен'}), 400
-        if len(new_password) < 6:
-            return jsonify({'success': False, 'message': 'Пароль должен быть не менее 6 символов'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        # Если это НЕ восстановление — проверяем текущий пароль
-        if not is_recovery:
-            if not current_password:
-                conn.close()
-                return jsonify({'success': False, 'message': 'Текущий пароль обязателен'}), 400
-            cursor.execute('SELECT password FROM users WHERE id = ?', (session['user_id'],))
-            user = cursor.fetchone()
-            if not user or not check_password_hash(user['password'], current_password):
-                conn.close()
-                return jsonify({'success': False, 'message': 'Текущий пароль указан неверно'}), 400
-        # Обновляем пароль
-        hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256')
-        cursor.execute('UPDATE users SET password = ? WHERE id = ?',
-                       (hashed_password, session['user_id']))
-        conn.commit()
+        conditions = ["status = 'confirmed'", 'driver_id IS NULL']
+        params = []
+        if request.args.get('dateFrom'):
+            conditions.append('shipping_date >= ?')
+            params.append(request.args['dateFrom'])
+        if request.args.get('dateTo'):
+            conditions.append('shipping_date <= ?')
+            params.append(request.args['dateTo'])
+        started = time.perf_counter()
+        # Заказы собираются со всех шардов, парк - из основной БД
+        orders = [row for rows in scatter_orders(f'''
+            SELECT id, cargo_weight, cargo_volume, cargo_type, shipping_date,
+                   pickup_address, delivery_address
+            FROM orders WHERE {' AND '.join(conditions)}
+        ''', params) for row in rows]
+        conn = get_read_db()
+        fleet = DriverRepo.active_fleet(conn)
         conn.close()
-        # При восстановлении — разлогиниваем для безопасности
-        if is_recovery:
-            session.clear()
-        return jsonify({'success': True, 'message': 'Пароль успешно изменен'})
+        plans = plan_consolidation(orders, fleet)
+        trucks = [truck for plan in plans for truck in plan['trucks']]
+        placed = sum(len(truck['orderIds']) for truck in trucks)
+        return jsonify({
+            'success': True,
+            'plans': plans,
+            'summary': {
+                'orders': len(orders),
+                'placed': placed,
+                'unplaced': len(orders) - placed,
+                'lanes': len(plans),
+                'trucks': len(trucks),
+                'fleet': len(fleet),
+                'avgWeightFill': round(sum(t['weightFill'] for t in trucks) / len(trucks), 3) if trucks else 0,
+                'avgVolumeFill': round(sum(t['volumeFill'] for t in trucks) / len(trucks), 3) if trucks else 0,
+                'elapsedMs': round((time.perf_counter() - started) * 1000, 1)
+            }
+        })
     except Exception as e:
-        print(f"[ERROR] Ошибка при смене пароля: {e}", file=sys.stderr)
+        print(f"[ERROR] admin_consolidation: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/reset-password', methods=['POST'])
+# === ЗАЯВКИ ВОДИТЕЛЕЙ ===
+@app.route('/api/driver/application', methods=['GET'])
+@login_required
 @swag_from({
-    'tags': ['Авторизация'],
+    'tags': ['Водители'],
+    'security': [{'SessionAuth': []}],
+    'responses': {
+        200: {
+            'description': 'Заявка водителя',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'application': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'licenseNumber': {'type': 'string', 'example': '1234567890'},
+                            'carModel': {'type': 'string', 'example': 'Volvo FH16'},
+                            'status': {'type': 'string', 'example': 'pending'}
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def get_driver_application():
+    """Получить заявку водителя текущего пользователя"""
+    conn = get_read_db()
+    app = ApplicationRepo.latest_for_user(conn, session['user_id'])
+    conn.close()
+    if app:
+        return jsonify({'success': True, 'application': dict(app)})
+    return jsonify({'success': True, 'application': None})
+
+@app.route('/api/driver/application', methods=['POST'])
+@login_required
+@swag_from({
+    'tags': ['Водители'],
+    'security': [{'SessionAuth': []}],
     'parameters': [
         {
             'name': 'body',
@@ -719,77 +6656,82 @@ def change_password():
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'contact': {'type': 'string', 'description': 'Email или телефон', 'example': "+79123456789"},
-                    'newPassword': {'type': 'string', 'example': "new_secure123"}
+                    'licenseNumber': {'type': 'string', 'example': '1234567890'},
+                    'experience': {'type': 'integer', 'example': 5},
+                    'carModel': {'type': 'string', 'example': 'Volvo FH16'},
+                    'carNumber': {'type': 'string', 'example': 'А123ВС45'},
+                    'maxWeight': {'type': 'number', 'example': 20000},
+                    'carType': {'type': 'string', 'example': 'tent'}
                 },
-                'required': ['contact', 'newPassword']
+                'required': ['licenseNumber', 'experience', 'carModel', 'carNumber', 'maxWeight', 'carType']
             }
         }
     ],
     'responses': {
         200: {
-            'description': 'Пароль успешно изменен',
+            'description': 'Заявка успешно отправлена',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Пароль успешно изменён'}
+                    'message': {'type': 'string', 'example': 'Заявка успешно отправлена'},
+                    'applicationId': {'type': 'integer', 'example': 1}
                 }
             }
         },
-        400: {'description': 'Ошибка валидации'},
-        404: {'description': 'Пользователь не найден'}
+        400: {'description': 'Уже есть активная заявка'}
     }
 })
-def reset_password_no_auth():
-    """Смена пароля без авторизации (после подтверждения через код)"""
+def submit_driver_application():
+    """Подать заявку на роль водителя"""
     try:
         data = request.get_json()
-        contact = data.get('contact', '').strip()  # email или phone
-        new_password = data.get('newPassword', '')
-        if not contact or not new_password:
-            return jsonify({'success': False, 'message': 'Укажите email/телефон и новый пароль'}), 400
-        if len(new_password) < 6:
-            return jsonify({'success': False, 'message': 'Пароль должен быть не менее 6 символов'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, email, phone FROM users WHERE email = ? OR phone = ?', (contact, contact))
-        user = cursor.fetchone()
-        if not user:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
-        hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256')
-        cursor.execute('UPDATE users SET password = ? WHERE id = ?', (hashed_password, user['id']))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Пароль успешно изменён'})
+        values = (
+            session['user_id'],
+            data.get('licenseNumber', ''),
+            int(data.get('experience', 0)),
+            data.get('carModel', ''),
+            data.get('carNumber', ''),
+            float(data.get('maxWeight', 0)),
+            data.get('carType', 'tent')
+        )
+        def write(cursor):
+            # Проверка существующей заявки
+            if ApplicationRepo.has_pending(cursor, values[0]):
+                raise WriteRejected('У вас уже есть активная заявка')
+            return ApplicationRepo.create(cursor, *values)
+        app_id = run_write(write)
+        return jsonify({'success': True, 'message': 'Заявка успешно отправлена', 'applicationId': app_id})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
     except Exception as e:
-        print(f"[ERROR] reset_password_no_auth: {e}", file=sys.stderr)
+        print(f"[ERROR] Ошибка при подаче заявки: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-# === ЗАКАЗЫ ===
-@app.route('/api/orders', methods=['GET'])
-@login_required
+# === АДМИНСКИЕ ФУНКЦИИ ===
+@app.route('/api/admin/driver_applications', methods=['GET'])
+@admin_required
+@cached_response('admin_driver_applications', ('driver_applications', 'users'))
 @swag_from({
-    'tags': ['Заказы'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'responses': {
         200: {
-            'description': 'Список заказов',
+            'description': 'Список заявок водителей',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'orders': {
+                    'applications': {
                         'type': 'array',
                         'items': {
                             'type': 'object',
                             'properties': {
                                 'id': {'type': 'integer', 'example': 1},
-                                'senderName': {'type': 'string', 'example': 'Иван Иванов'},
-                                'cargoDescription': {'type': 'string', 'example': 'Электроника'},
-                                'status': {'type': 'string', 'example': 'new'},
-                                'price': {'type': 'number', 'example': 1500}
+                                'firstName': {'type': 'string', 'example': 'Иван'},
+                                'lastName': {'type': 'string', 'example': 'Иванов'},
+                                'licenseNumber': {'type': 'string', 'example': '1234567890'},
+                                'status': {'type': 'string', 'example': 'pending'}
                             }
                         }
                     }
@@ -798,585 +6740,741 @@ def reset_password_no_auth():
         }
     }
 })
-def get_orders():
-    """Получить заказы пользователя"""
-    conn = get_db()
-    cursor = conn.cursor()
-    # Проверяем роль пользователя
-    cursor.execute('SELECT is_admin, is_driver FROM users WHERE id = ?', (session['user_id'],))
-    user = cursor.fetchone()
-    if user['is_admin']:
-        # Администратор видит все заказы
-        cursor.execute('''
-            SELECT * FROM orders ORDER BY created_at DESC
-        ''')
-    elif user['is_driver']:
-        # Водитель видит свои заказы
-        cursor.execute('''
-            SELECT * FROM orders WHERE driver_id = ? ORDER BY created_at DESC
-        ''', (session['user_id'],))
-    else:
-        # Обычный пользователь видит свои заказы
-        cursor.execute('''
-            SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC
-        ''', (session['user_id'],))
-    orders = []
-    for row in cursor.fetchall():
-        orders.append(dict(row))
+def get_driver_applications():
+    """Получить все заявки водителей (для админа)"""
+    conn = get_read_db()
+    applications = [dict(row) for row in ApplicationRepo.list_with_users(conn)]
     conn.close()
-    return jsonify({'success': True, 'orders': orders})
+    return jsonify({'success': True, 'applications': applications})
+
+@app.route('/api/admin/driver_application/<int:app_id>/approve', methods=['POST'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'app_id',
+            'in': 'path',
+            'type': 'integer',
+            'required': True,
+            'description': 'ID заявки'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Заявка успешно одобрена',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Заявка одобрена'}
+                }
+            }
+        },
+        400: {'description': 'Заявка уже обработана или не найдена'},
+        404: {'description': 'Заявка не найдена'}
+    }
+})
+def approve_driver_application(app_id):
+    """Одобрить заявку водителя"""
+    try:
+        admin_id = session['user_id']
+        def write(cursor):
+            # Получаем заявку
+            app = ApplicationRepo.get(cursor, app_id)
+            if not app:
+                raise WriteRejected('Заявка не найдена', 404)
+            if app['status'] != 'pending':
+                raise WriteRejected('Заявка уже обработана')
+            now = datetime.now()
+            # Создаем запись водителя
+            DriverRepo.create_from_applications(cursor, [app], now.date().isoformat())
+            # Обновляем роль пользователя
+            UserRepo.set_driver(cursor, [app['user_id']], True)
+            # Обновляем статус заявки
+            ApplicationRepo.set_status(cursor, [app_id], 'approved', admin_id, now)
+        run_write(write)
+        return jsonify({'success': True, 'message': 'Заявка одобрена'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
+    except Exception as e:
+        print(f"[ERROR] Ошибка при одобрении заявки: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/orders', methods=['POST'])
-@login_required
+@app.route('/api/admin/driver_application/<int:app_id>/reject', methods=['POST'])
+@admin_required
 @swag_from({
-    'tags': ['Заказы'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'body',
-            'in': 'body',
+            'name': 'app_id',
+            'in': 'path',
+            'type': 'integer',
             'required': True,
+            'description': 'ID заявки'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Заявка успешно отклонена',
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'senderName': {'type': 'string', 'example': 'Иван Иванов'},
-                    'senderPhone': {'type': 'string', 'example': '+79123456789'},
-                    'senderEmail': {'type': 'string', 'example': 'ivan@example.com'},
-                    'cargoDescription': {'type': 'string', 'example': 'Электроника'},
-                    'productCategory': {'type': 'string', 'example': 'electronics'},
-                    'cargoWeight': {'type': 'number', 'example': 10},
-                    'cargoVolume': {'type': 'number', 'example': 1},
-                    'cargoType': {'type': 'string', 'example': 'general'},
-                    'shippingDate': {'type': 'string', 'format': 'date', 'example': '2023-12-25'},
-                    'pickupAddress': {'type': 'string', 'example': 'Москва, ул. Ленина, 1'},
-                    'deliveryAddress': {'type': 'string', 'example': 'Санкт-Петербург, ул. Пушкина, 10'},
-                    'distance': {'type': 'number', 'example': 700},
-                    'insurance': {'type': 'boolean', 'example': True},
-                    'packaging': {'type': 'boolean', 'example': False},
-                    'comments': {'type': 'string', 'example': 'Осторожно, хрупкий груз'}
-                },
-                'required': [
-                    'senderName', 'senderPhone', 'cargoDescription', 'productCategory',
-                    'cargoWeight', 'cargoVolume', 'cargoType', 'shippingDate',
-                    'pickupAddress', 'deliveryAddress', 'distance'
-                ]
+                    'success': {'type': 'boolean', 'example': True},
+                    'message': {'type': 'string', 'example': 'Заявка отклонена'}
+                }
             }
+        },
+        404: {'description': 'Заявка не найдена'}
+    }
+})
+def reject_driver_application(app_id):
+    """Отклонить заявку водителя"""
+    try:
+        admin_id = session['user_id']
+        def write(cursor):
+            if not ApplicationRepo.get(cursor, app_id):
+                raise WriteRejected('Заявка не найдена', 404)
+            ApplicationRepo.set_status(cursor, [app_id], 'rejected', admin_id, datetime.now())
+        run_write(write)
+        return jsonify({'success': True, 'message': 'Заявка отклонена'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
+    except Exception as e:
+        print(f"[ERROR] Ошибка при отклонении заявки: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# === АДМИН: список водителей ===
+@app.route('/api/admin/drivers', methods=['GET'])
+@admin_required
+@cached_response('admin_drivers', ('drivers', 'users'))
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Список полей через запятую (имеет приоритет над view)'
+        },
+        {
+            'name': 'view',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['summary', 'full'],
+            'required': False,
+            'description': 'Именованный набор полей (по умолчанию full)'
         }
     ],
     'responses': {
         200: {
-            'description': 'Заказ успешно создан',
+            'description': 'Список водителей',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Заказ успешно создан'},
-                    'order': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'price': {'type': 'number', 'example': 15000},
-                            'distance': {'type': 'number', 'example': 700}
+                    'drivers': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'id': {'type': 'integer', 'example': 1},
+                                'firstName': {'type': 'string', 'example': 'Иван'},
+                                'lastName': {'type': 'string', 'example': 'Иванов'},
+                                'carModel': {'type': 'string', 'example': 'Volvo FH16'},
+                                'status': {'type': 'string', 'example': 'active'}
+                            }
                         }
                     }
                 }
             }
         },
-        400: {'description': 'Ошибка валидации'},
-        403: {'description': 'Доступ запрещен для администраторов и водителей'}
+        400: {'description': 'Недопустимое поле или представление'}
     }
 })
-def create_order():
-    """Создать новый заказ"""
+def admin_drivers():
+    """Получить список водителей с данными пользователя"""
     try:
-        data = request.get_json()
-        # Проверка, что пользователь не администратор и не водитель
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT is_admin, is_driver FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
-        if user['is_admin'] or user['is_driver']:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заказ доступен только для обычных пользователей'}), 403
-        # Расчет расстояния (упрощенный)
-        pickup_address = data.get('pickupAddress', '')
-        delivery_address = data.get('deliveryAddress', '')
-        distance = data.get('distance', 100)  # По умолчанию 100 км
-        # Расчет цены (упрощенный)
-        cargo_weight = float(data.get('cargoWeight', 0))
-        cargo_volume = float(data.get('cargoVolume', 0))
-        base_price = 1000
-        price_per_km = 20
-        price_per_kg = 80
-        price_per_m3 = 400
-        distance_cost = distance * price_per_km
-        weight_cost = cargo_weight * price_per_kg
-        volume_cost = cargo_volume * price_per_m3
-        total_price = base_price + distance_cost + weight_cost + volume_cost
-        # Коэффициенты для типов груза
-        cargo_type_multiplier = {
-            'general': 1.0,
-            'fragile': 1.3,
-            'dangerous': 1.5,
-            'perishable': 1.4
-        }
-        multiplier = cargo_type_multiplier.get(data.get('cargoType', 'general'), 1.0)
-        total_price *= multiplier
-        # Страховка 1%
-        if data.get('insurance'):
-            total_price += total_price * 0.01
-        # Упаковка
-        if data.get('packaging'):
-            total_price += 2000
-        total_price = round(total_price)
-        cursor.execute('''
-            INSERT INTO orders (
-                user_id, sender_name, sender_phone, sender_email, cargo_description,
-                product_category, cargo_weight, cargo_volume, cargo_type, shipping_date,
-                pickup_address, delivery_address, distance, price, insurance, packaging,
-                comments, status, client_status
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            session['user_id'],
-            data.get('senderName', ''),
-            data.get('senderPhone', ''),
-            data.get('senderEmail', ''),
-            data.get('cargoDescription', ''),
-            data.get('productCategory', ''),
-            cargo_weight,
-            cargo_volume,
-            data.get('cargoType', 'general'),
-            data.get('shippingDate', ''),
-            pickup_address,
-            delivery_address,
-            distance,
-            total_price,
-            1 if data.get('insurance') else 0,
-            1 if data.get('packaging') else 0,
-            data.get('comments', ''),
-            'new',
-            'processing'
-        ))
-        order_id = cursor.lastrowid
-        conn.commit()
+        fields = resolve_fields(DRIVER_FIELDS, DRIVER_VIEWS)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        conn = get_read_db()
+        drivers = [dict(row) for row in DriverRepo.select(conn, select_list(DRIVER_FIELDS, fields))]
         conn.close()
-        return jsonify({
-            'success': True,
-            'message': 'Заказ успешно создан',
-            'order': {
-                'id': order_id,
-                'price': total_price,
-                'distance': distance
-            }
-        })
+        return jsonify({'success': True, 'drivers': drivers})
     except Exception as e:
-        print(f"[ERROR] Ошибка при создании заказа: {e}", file=sys.stderr)
+        print(f"[ERROR] admin_drivers: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/orders/<int:order_id>', methods=['GET'])
-@login_required
+@app.route('/api/admin/drivers/leaderboard', methods=['GET'])
+@admin_required
 @swag_from({
-    'tags': ['Заказы'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'order_id',
-            'in': 'path',
+            'name': 'period',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['week', 'month', 'all'],
+            'required': False,
+            'description': 'Период итогов (по умолчанию week)'
+        },
+        {
+            'name': 'sort',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['deliveries', 'onTimeRate', 'avgTransit', 'weeklyVolume', 'revenue', 'distance'],
+            'required': False,
+            'description': 'Показатель сортировки (по умолчанию deliveries)'
+        },
+        {
+            'name': 'order',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['desc', 'asc'],
+            'required': False,
+            'description': 'Направление сортировки (по умолчанию desc); пустые значения всегда в конце'
+        },
+        {
+            'name': 'limit',
+            'in': 'query',
             'type': 'integer',
-            'required': True,
-            'description': 'ID заказа'
+            'required': False,
+            'description': 'Сколько водителей вернуть (по умолчанию 50, не более 1000)'
         }
     ],
     'responses': {
         200: {
-            'description': 'Детали заказа',
+            'description': 'Водители, упорядоченные по показателю',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'order': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'senderName': {'type': 'string', 'example': 'Иван Иванов'},
-                            'cargoDescription': {'type': 'string', 'example': 'Электроника'},
-                            'status': {'type': 'string', 'example': 'new'},
-                            'price': {'type': 'number', 'example': 1500}
+                    'period': {'type': 'string', 'example': 'week'},
+                    'updatedAt': {'type': 'string', 'example': '2025-03-01 12:00:00'},
+                    'drivers': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'rank': {'type': 'integer', 'example': 1},
+                                'driverId': {'type': 'integer', 'example': 7},
+                                'firstName': {'type': 'string', 'example': 'Иван'},
+                                'lastName': {'type': 'string', 'example': 'Иванов'},
+                                'deliveries': {'type': 'integer', 'example': 12},
+                                'onTimeRate': {'type': 'number', 'example': 0.92},
+                                'avgTransit': {'type': 'number', 'example': 86400.0,
+                                               'description': 'Среднее время в пути, сек'},
+                                'weeklyVolume': {'type': 'number', 'example': 12.0},
+                                'revenue': {'type': 'number', 'example': 154000.0},
+                                'distance': {'type': 'number', 'example': 5400.0}
+                            }
                         }
                     }
                 }
             }
         },
-        403: {'description': 'Доступ запрещен'},
-        404: {'description': 'Заказ не найден'}
+        400: {'description': 'Недопустимый период, показатель или limit'}
     }
 })
-def get_order(order_id):
-    """Получить детали заказа"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-    order = cursor.fetchone()
-    if not order:
-        conn.close()
-        return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
-    # Проверка прав доступа
-    cursor.execute('SELECT is_admin, is_driver FROM users WHERE id = ?', (session['user_id'],))
-    user = cursor.fetchone()
-    if not user['is_admin'] and not user['is_driver'] and order['user_id'] != session['user_id']:
-        conn.close()
-        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+def admin_driver_leaderboard():
+    """Таблица лидеров водителей по готовым итогам driver_rollups (заказы не читаются)"""
+    period = request.args.get('period', 'week')
+    sort = request.args.get('sort', 'deliveries')
+    order = request.args.get('order', 'desc').lower()
+    if period not in DRIVER_ROLLUP_PERIODS:
+        return jsonify({'success': False, 'message': 'Недопустимый период'}), 400
+    if sort not in DRIVER_LEADERBOARD_SORTS or order not in ('asc', 'desc'):
+        return jsonify({'success': False, 'message': 'Недопустимая сортировка'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', DRIVER_LEADERBOARD_LIMIT)), 1), DRIVER_LEADERBOARD_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit должен быть числом'}), 400
+    column = DRIVER_LEADERBOARD_SORTS[sort]
+    conn = get_read_db()
+    rows = conn.execute(f'''
+        SELECT r.driver_id, u.first_name, u.last_name, r.deliveries, r.on_time_rate,
+               r.avg_transit, r.weekly_volume, r.revenue, r.distance
+        FROM driver_rollups r
+        LEFT JOIN users u ON u.id = r.driver_id
+        WHERE r.period = ?
+        ORDER BY r.{column} IS NULL, r.{column} {order.upper()}, r.driver_id
+        LIMIT ?
+    ''', (period, limit)).fetchall()
+    updated = conn.execute('SELECT MIN(updated_at) FROM driver_rollup_watermarks').fetchone()[0]
     conn.close()
-    return jsonify({'success': True, 'order': dict(order)})
+    drivers = [{
+        'rank': rank,
+        'driverId': row['driver_id'],
+        'firstName': row['first_name'],
+        'lastName': row['last_name'],
+        'deliveries': row['deliveries'],
+        'onTimeRate': None if row['on_time_rate'] is None else round(row['on_time_rate'], 4),
+        'avgTransit': None if row['avg_transit'] is None else round(row['avg_transit'], 1),
+        'weeklyVolume': round(row['weekly_volume'], 2),
+        'revenue': row['revenue'],
+        'distance': row['distance'],
+    } for rank, row in enumerate(rows, 1)]
+    return jsonify({'success': True, 'period': period,
+                    'updatedAt': order_event_time(updated) if updated else None,
+                    'drivers': drivers})
 
-# === АДМИН: обработка заказов ===
-@app.route('/api/admin/orders/<int:order_id>/decision', methods=['POST'])
+@app.route('/api/admin/drivers/<int:driver_user_id>/dismiss', methods=['POST'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'order_id',
+            'name': 'driver_user_id',
             'in': 'path',
             'type': 'integer',
             'required': True,
-            'description': 'ID заказа'
+            'description': 'ID пользователя-водителя'
         },
         {
             'name': 'body',
             'in': 'body',
-            'required': True,
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'decision': {'type': 'string', 'enum': ['confirm', 'reject'], 'example': 'confirm'},
-                    'comment': {'type': 'string', 'example': 'Заказ подтвержден'}
-                },
-                'required': ['decision']
+                    'reason': {'type': 'string', 'example': 'Нарушение правил'},
+                    'action': {'type': 'string', 'enum': ['reassign', 'cancel', 'keep'], 'example': 'reassign'}
+                }
             }
         }
     ],
     'responses': {
         200: {
-            'description': 'Решение по заказу применено',
+            'description': 'Водитель успешно удален',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Решение применено'},
-                    'status': {'type': 'string', 'example': 'confirmed'}
+                    'message': {'type': 'string', 'example': 'Водитель успешно удален из системы'}
                 }
             }
         },
-        400: {'description': 'Некорректное решение'},
-        404: {'description': 'Заказ не найден'}
+        404: {'description': 'Водитель не найден'}
     }
 })
-def admin_order_decision(order_id):
-    """Подтвердить / отклонить заказ"""
+def dismiss_driver(driver_user_id):
+    """Удалить водителя из системы"""
     try:
-        data = request.get_json()
-        decision = data.get('decision')
-        comment = data.get('comment', '')
-        if decision not in ['confirm', 'reject']:
-            return jsonify({'success': False, 'message': 'Некорректное решение'}), 400
-        new_status = 'confirmed' if decision == 'confirm' else 'rejected'
-        client_status = 'confirmed' if decision == 'confirm' else 'rejected'
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM orders WHERE id = ?', (order_id,))
-        if not cursor.fetchone():
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
-        cursor.execute('''
-            UPDATE orders
-            SET status = ?, client_status = ?, admin_comment = ?, processed_at = ?
-            WHERE id = ?
-        ''', (new_status, client_status, comment, datetime.now(), order_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Решение применено', 'status': new_status})
+        data = request.get_json() or {}
+        reason = data.get('reason', '')
+        def write(cursor):
+            # Проверяем водителя
+            if not DriverRepo.exists(cursor, driver_user_id):
+                raise WriteRejected('Водитель не найден', 404)
+            # Удаляем запись водителя из таблицы drivers
+            DriverRepo.delete(cursor, driver_user_id)
+            # Снимаем роль водителя с пользователя
+            UserRepo.set_driver(cursor, [driver_user_id], False)
+        run_write(write)
+        # Прием координат больше не должен пропускать его по памяти
+        _positions.forget_driver(driver_user_id)
+        return jsonify({'success': True, 'message': 'Водитель успешно удален из системы'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
     except Exception as e:
-        print(f"[ERROR] admin_order_decision: {e}", file=sys.stderr)
+        print(f"[ERROR] dismiss_driver: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/admin/orders/<int:order_id>/assign', methods=['POST'])
+@app.route('/api/admin/drivers/<int:driver_user_id>/restore', methods=['POST'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'order_id',
+            'name': 'driver_user_id',
             'in': 'path',
             'type': 'integer',
             'required': True,
-            'description': 'ID заказа'
-        },
-        {
-            'name': 'body',
-            'in': 'body',
-            'required': True,
-            'schema': {
-                'type': 'object',
-                'properties': {
-                    'driverId': {'type': 'integer', 'example': 5}
-                },
-                'required': ['driverId']
-            }
+            'description': 'ID пользователя-водителя'
         }
     ],
     'responses': {
         200: {
-            'description': 'Водитель успешно назначен',
+            'description': 'Водитель успешно восстановлен',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Водитель назначен'},
-                    'driverId': {'type': 'integer', 'example': 5}
+                    'message': {'type': 'string', 'example': 'Водитель восстановлен'}
                 }
             }
         },
-        400: {'description': 'Некорректные данные'},
-        404: {'description': 'Заказ или водитель не найден'}
+        404: {'description': 'Водитель не найден'}
     }
 })
-def admin_assign_driver(order_id):
-    """Назначить водителя на заказ"""
+def restore_driver(driver_user_id):
+    """Восстановить водителя"""
     try:
-        data = request.get_json()
-        driver_id = data.get('driverId')
-        if not driver_id:
-            return jsonify({'success': False, 'message': 'driverId обязателен'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        # Проверяем заказ
-        cursor.execute('SELECT id FROM orders WHERE id = ?', (order_id,))
-        if not cursor.fetchone():
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
-        # Проверяем, что driver_id существует как пользователь с is_driver=1
-        cursor.execute('SELECT id FROM users WHERE id = ? AND is_driver = 1', (driver_id,))
-        if not cursor.fetchone():
-            conn.close()
-            return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
-        cursor.execute('''
-            UPDATE orders
-            SET driver_id = ?, assigned_at = ?
-            WHERE id = ?
-        ''', (driver_id, datetime.now(), order_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Водитель назначен', 'driverId': driver_id})
+        def write(cursor):
+            if not DriverRepo.exists(cursor, driver_user_id):
+                raise WriteRejected('Водитель не найден', 404)
+            DriverRepo.restore(cursor, driver_user_id)
+            UserRepo.set_driver(cursor, [driver_user_id], True)
+        run_write(write)
+        return jsonify({'success': True, 'message': 'Водитель восстановлен'})
+    except WriteRejected as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
     except Exception as e:
-        print(f"[ERROR] admin_assign_driver: {e}", file=sys.stderr)
+        print(f"[ERROR] restore_driver: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/orders/<int:order_id>/status', methods=['POST'])
+# === ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ВОДИТЕЛЕЙ ===
+@app.route('/api/driver/info', methods=['GET'])
 @login_required
 @swag_from({
-    'tags': ['Заказы'],
+    'tags': ['Водители'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'order_id',
-            'in': 'path',
-            'type': 'integer',
-            'required': True,
-            'description': 'ID заказа'
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Список полей через запятую (имеет приоритет над view)'
         },
         {
-            'name': 'body',
-            'in': 'body',
-            'required': True,
-            'schema': {
-                'type': 'object',
-                'properties': {
-                    'status': {'type': 'string', 'example': 'in_transit'},
-                    'clientStatus': {'type': 'string', 'example': 'in_transit'}
-                },
-                'required': ['status']
-            }
+            'name': 'view',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['summary', 'full'],
+            'required': False,
+            'description': 'Именованный набор полей (по умолчанию full)'
         }
     ],
     'responses': {
         200: {
-            'description': 'Статус успешно обновлен',
+            'description': 'Информация о водителе',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Статус обновлен'}
+                    'driver': {
+                        'type': 'object',
+                        'properties': {
+                            'id': {'type': 'integer', 'example': 1},
+                            'licenseNumber': {'type': 'string', 'example': '1234567890'},
+                            'carModel': {'type': 'string', 'example': 'Volvo FH16'},
+                            'completedDeliveries': {'type': 'integer', 'example': 15}
+                        }
+                    }
                 }
             }
         },
-        403: {'description': 'Доступ запрещен'},
-        404: {'description': 'Заказ не найден'}
+        400: {'description': 'Недопустимое поле или представление'},
+        404: {'description': 'Водитель не найден'}
     }
 })
-def update_order_status(order_id):
-    """Обновление статуса заказа (водитель/админ/клиент)"""
+def get_driver_info():
+    """Получить информацию о водителе (для текущего пользователя)"""
     try:
-        data = request.get_json()
-        new_status = data.get('status')
-        client_status = data.get('clientStatus')
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-        order = cursor.fetchone()
-        if not order:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
-        # Проверка прав: админ — любые, водитель — только свои, клиент — только свой
-        cursor.execute('SELECT is_admin, is_driver FROM users WHERE id = ?', (session['user_id'],))
-        role = cursor.fetchone()
-        is_admin = bool(role['is_admin'])
-        is_driver = bool(role['is_driver'])
-        is_owner = (order['user_id'] == session['user_id'])
-        if is_driver and order['driver_id'] != session['user_id'] and not is_admin:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
-        if not (is_admin or is_driver or is_owner):
-            conn.close()
-            return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
-        # Обновляем статус и соответствующее поле времени
-        update_fields = ['status = ?']
-        update_values = [new_status]
-        if client_status:
-            update_fields.append('client_status = ?')
-            update_values.append(client_status)
-        if new_status == 'in_transit':
-            update_fields.append('in_transit_at = ?')
-            update_values.append(datetime.now())
-        elif new_status == 'delivered':
-            update_fields.append('delivered_at = ?')
-            update_values.append(datetime.now())
-            # Обновляем статистику водителя
-            if is_driver and order['driver_id']:
-                cursor.execute('''
-                    UPDATE drivers 
-                    SET completed_deliveries = completed_deliveries + 1 
-                    WHERE user_id = ?
-                ''', (order['driver_id'],))
-        update_values.append(order_id)
-        cursor.execute(f'''
-            UPDATE orders
-            SET {', '.join(update_fields)}
-            WHERE id = ?
-        ''', update_values)
-        conn.commit()
+        fields = resolve_fields(DRIVER_FIELDS, DRIVER_VIEWS)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        conn = get_read_db()
+        rows = DriverRepo.select(conn, select_list(DRIVER_FIELDS, fields), session['user_id'])
         conn.close()
-        return jsonify({'success': True, 'message': 'Статус обновлен'})
+        driver = rows[0] if rows else None
+        if driver:
+            return jsonify({'success': True, 'driver': dict(driver)})
+        return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
     except Exception as e:
-        print(f"[ERROR] update_order_status: {e}", file=sys.stderr)
+        print(f"[ERROR] get_driver_info: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/driver/orders/<int:order_id>/accept', methods=['POST'])
+@app.route('/api/driver/work-status', methods=['POST'])
 @login_required
 @swag_from({
     'tags': ['Водители'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'order_id',
-            'in': 'path',
-            'type': 'integer',
+            'name': 'body',
+            'in': 'body',
             'required': True,
-            'description': 'ID заказа'
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'workStatus': {'type': 'string', 'enum': ['active', 'inactive'], 'example': 'active'}
+                },
+                'required': ['workStatus']
+            }
         }
     ],
     'responses': {
         200: {
-            'description': 'Заказ успешно принят',
+            'description': 'Статус работы успешно обновлен',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Заказ принят'}
+                    'message': {'type': 'string', 'example': 'Статус работы обновлен'}
                 }
             }
         },
-        403: {'description': 'Доступ запрещен (нет прав водителя или заказ не назначен)'},
-        404: {'description': 'Заказ не найден'}
+        400: {'description': 'Некорректный статус'},
+        403: {'description': 'Только водители могут изменять статус работы'}
     }
 })
-def driver_accept_order(order_id):
-    """Водитель принимает заказ (меняет статус на in_transit)"""
+def update_driver_work_status():
+    """Обновить статус работы водителя (active/inactive)"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        data = request.get_json()
+        work_status = data.get('workStatus')
+        if work_status not in ['active', 'inactive']:
+            return jsonify({'success': False, 'message': 'Некорректный статус'}), 400
+        conn = get_read_db()
         # Проверяем что пользователь - водитель
-        cursor.execute('SELECT is_driver FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
-        if not user or not user['is_driver']:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Только водители могут принимать заказы'}), 403
-        # Проверяем заказ
-        cursor.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-        order = cursor.fetchone()
-        if not order:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
-        # Проверяем что заказ назначен этому водителю
-        if order['driver_id'] != session['user_id']:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заказ не назначен вам'}), 403
-        # Обновляем статус
-        cursor.execute('''
-            UPDATE orders 
-            SET status = ?, client_status = ?, in_transit_at = ?, accepted_at = ?
-            WHERE id = ?
-        ''', ('in_transit', 'in_transit', datetime.now(), datetime.now(), order_id))
-        conn.commit()
+        is_driver = UserRepo.is_driver(conn, session['user_id'])
         conn.close()
-        return jsonify({'success': True, 'message': 'Заказ принят'})
+        if not is_driver:
+            return jsonify({'success': False, 'message': 'Только водители могут изменять статус работы'}), 403
+        user_id = session['user_id']
+        run_write(lambda cursor: DriverRepo.set_work_status(cursor, user_id, work_status))
+        return jsonify({'success': True, 'message': 'Статус работы обновлен'})
     except Exception as e:
-        print(f"[ERROR] driver_accept_order: {e}", file=sys.stderr)
+        print(f"[ERROR] update_driver_work_status: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-# === ЗАЯВКИ ВОДИТЕЛЕЙ ===
-@app.route('/api/driver/application', methods=['GET'])
+@app.route('/api/driver/route', methods=['GET'])
 @login_required
 @swag_from({
     'tags': ['Водители'],
     'security': [{'SessionAuth': []}],
+    'parameters': [
+        {'name': 'start', 'in': 'query', 'type': 'string', 'required': False,
+         'description': 'Город, откуда водитель начинает маршрут', 'example': 'Москва'}
+    ],
     'responses': {
         200: {
-            'description': 'Заявка водителя',
+            'description': 'Порядок погрузок и доставок по открытым заказам водителя',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'application': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'licenseNumber': {'type': 'string', 'example': '1234567890'},
-                            'carModel': {'type': 'string', 'example': 'Volvo FH16'},
-                            'status': {'type': 'string', 'example': 'pending'}
-                        }
-                    }
+                    'route': {'type': 'array', 'items': {'type': 'object'}},
+                    'totalKm': {'type': 'number', 'example': 1120},
+                    'cached': {'type': 'boolean', 'example': False}
                 }
             }
-        }
+        },
+        403: {'description': 'Только для водителей'}
     }
 })
-def get_driver_application():
-    """Получить заявку водителя текущего пользователя"""
-    conn = get_db()
+def get_driver_route():
+    """Маршрут водителя по открытым заказам (кэшируется до изменения набора заказов)"""
+    try:
+        user_id = session['user_id']
+        start_city = normalize_city(request.args.get('start', ''))
+        conn = get_read_db()
+        is_driver = UserRepo.is_driver(conn, user_id)
+        conn.close()
+        if not is_driver:
+            return jsonify({'success': False, 'message': 'Только для водителей'}), 403
+        status_marks = ', '.join('?' for _ in ROUTE_OPEN_STATUSES)
+        orders = merge_shard_rows(scatter_orders(f'''
+            SELECT id, status, pickup_address, delivery_address FROM orders
+            WHERE driver_id = ? AND status IN ({status_marks})
+            ORDER BY id
+        ''', (user_id, *ROUTE_OPEN_STATUSES)), lambda row: row['id'])
+        signature = (start_city, tuple(tuple(order) for order in orders))
+        with _route_cache_lock:
+            cached = _route_cache.get(user_id)
+            if cached is not None and cached[0] == signature:
+                _route_cache.move_to_end(user_id)
+                return jsonify({'success': True, 'cached': True, **cached[1]})
+        stops = []
+        for order in orders:
+            # Заказ в пути уже погружен - остается только доставка
+            if order['status'] != 'in_transit':
+                stops.append({'orderId': order['id'], 'type': 'pickup', 'address': order['pickup_address'],
+                              'city': extract_city(order['pickup_address'])})
+            stops.append({'orderId': order['id'], 'type': 'delivery', 'address': order['delivery_address'],
+                          'city': extract_city(order['delivery_address'])})
+        started = time.perf_counter()
+        plan = plan_route(stops, start_city or None) if stops else \
+            {'stops': [], 'totalKm': 0, 'constructedKm': 0, 'improvements': 0}
+        result = {
+            'route': plan['stops'],
+            'totalKm': plan['totalKm'],
+            'orders': len(orders),
+            'optimization': {
+                'constructedKm': plan['constructedKm'],
+                'improvements': plan['improvements'],
+                'elapsedMs': round((time.perf_counter() - started) * 1000, 2)
+            }
+        }
+        with _route_cache_lock:
+            _route_cache[user_id] = (signature, result)
+            _route_cache.move_to_end(user_id)
+            while len(_route_cache) > app.config['ROUTE_CACHE_SIZE']:
+                _route_cache.popitem(last=False)
+        return jsonify({'success': True, 'cached': False, **result})
+    except Exception as e:
+        print(f"[ERROR] get_driver_route: {e}", file=sys.stderr)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# === GPS-ТРЕКИНГ ===
+# Заказы, по которым водитель передает координаты
+GPS_TRACKED_STATUSES = ('confirmed', 'in_transit')
+
+class PositionStore:
+    """Последние координаты в памяти: по водителю и по заказу.
+
+    Для заказа хранятся также его клиент и водитель, поэтому
+    GET /api/orders/<id>/location проверяет доступ и отвечает без
+    обращения к БД. Данные относятся к текущему процессу.
+    """
+    def __init__(self):
+        self.drivers = {}  # driver_id -> (ts, lat, lon, order_id)
+        self.orders = {}  # order_id -> {'driverId', 'userId', 'position'}
+        self.lock = threading.Lock()
+
+    def knows(self, driver_id, order_id):
+        """Проверены ли уже водитель и его заказ"""
+        with self.lock:
+            if order_id is None:
+                return driver_id in self.drivers
+            entry = self.orders.get(order_id)
+            return entry is not None and entry['driverId'] == driver_id
+
+    def register(self, driver_id, order_id=None, user_id=None):
+        with self.lock:
+            self.drivers.setdefault(driver_id, None)
+            if order_id is not None:
+                self.orders[order_id] = {'driverId': driver_id, 'userId': user_id, 'position': None}
+
+    def update(self, driver_id, order_id, point):
+        """Запомнить точку (ts, lat, lon), если она новее известной"""
+        with self.lock:
+            current = self.drivers.get(driver_id)
+            if current is None or point[0] >= current[0]:
+                self.drivers[driver_id] = (*point, order_id)
+            entry = self.orders.get(order_id)
+            if entry is not None and (entry['position'] is None or point[0] >= entry['position'][0]):
+                entry['position'] = point
+
+    def order_entry(self, order_id):
+        with self.lock:
+            entry = self.orders.get(order_id)
+            return dict(entry) if entry is not None else None
+
+    def forget_order(self, order_id):
+        """Сбросить заказ после смены водителя или завершения"""
+        with self.lock:
+            self.orders.pop(order_id, None)
+
+    def forget_driver(self, driver_id):
+        """Сбросить водителя и его заказы: следующая точка снова проверится по БД"""
+        with self.lock:
+            self.drivers.pop(driver_id, None)
+            for order_id in [order_id for order_id, entry in self.orders.items()
+                             if entry['driverId'] == driver_id]:
+                del self.orders[order_id]
+
+_positions = PositionStore()
+# Дни, таблицы которых уже созданы в этом процессе
+_gps_partitions = set()
+
+def gps_partition(ts):
+    """Имя таблицы точек за день, к которому относится ts"""
+    return 'gps_points_' + datetime.fromtimestamp(ts).strftime('%Y%m%d')
+
+def parse_gps_points(raw):
+    """Разобрать [[ts, lat, lon], ...]; вернуть (точки, число отброшенных)"""
+    now = time.time()
+    oldest = now - app.config['GPS_RETENTION_DAYS'] * 86400
+    newest = now + app.config['GPS_MAX_FUTURE_SKEW']
+    points = []
+    for item in raw:
+        try:
+            ts, lat, lon = (float(value) for value in item)
+        except (TypeError, ValueError):
+            continue
+        if oldest <= ts <= newest and -90 <= lat <= 90 and -180 <= lon <= 180:
+            points.append((int(ts), lat, lon))
+    return points, len(raw) - len(points)
+
+def store_gps_points(driver_id, order_id, points):
+    """Записать точки в таблицы по дням одной операцией записи"""
+    by_day = {}
+    for ts, lat, lon in points:
+        # Микроградусы в INTEGER: ~0.1 м точности и вдвое компактнее REAL
+        by_day.setdefault(gps_partition(ts), []).append(
+            (driver_id, ts, order_id, round(lat * 1_000_000), round(lon * 1_000_000)))
+    def write(cursor):
+        stored = 0
+        for table, rows in by_day.items():
+            if table not in _gps_partitions:
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        driver_id INTEGER NOT NULL,
+                        ts INTEGER NOT NULL,
+                        order_id INTEGER,
+                        lat INTEGER NOT NULL,
+                        lon INTEGER NOT NULL,
+                        PRIMARY KEY (driver_id, ts)
+                    ) WITHOUT ROWID
+                ''')
+            # Повторно отправленная пачка не создает дублей
+            cursor.executemany(f'INSERT OR IGNORE INTO {table} VALUES (?, ?, ?, ?, ?)', rows)
+            stored += cursor.rowcount
+        return stored
+    stored = run_write(write)
+    _gps_partitions.update(by_day)
+    return stored
+
+def latest_gps_point(driver_id, order_id):
+    """Последняя сохраненная точка водителя по заказу (ts, lat, lon) или None.
+
+    Таблицы по дням просматриваются от новой к старой; в каждой поиск идет
+    по первичному ключу (driver_id, ts) с конца.
+    """
+    conn = get_read_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'gps_points_[0-9]*' "
+                       "ORDER BY name DESC")
+        for table in [row['name'] for row in cursor.fetchall()]:
+            cursor.execute(f'SELECT ts, lat, lon FROM {table} WHERE driver_id = ? AND order_id = ? '
+                           f'ORDER BY ts DESC LIMIT 1', (driver_id, order_id))
+            row = cursor.fetchone()
+            if row is not None:
+                return row['ts'], row['lat'] / 1_000_000, row['lon'] / 1_000_000
+    finally:
+        conn.close()
+    return None
+
+def drop_expired_gps_partitions():
+    """Удалить таблицы точек старше GPS_RETENTION_DAYS целиком (DROP вместо DELETE)"""
+    cutoff = 'gps_points_' + (datetime.now() - timedelta(days=app.config['GPS_RETENTION_DAYS'])).strftime('%Y%m%d')
+    conn = get_read_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM driver_applications WHERE user_id = ? ORDER BY applied_at DESC LIMIT 1
-    ''', (session['user_id'],))
-    app = cursor.fetchone()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'gps_points_[0-9]*'")
+    expired = [row['name'] for row in cursor.fetchall() if row['name'] < cutoff]
     conn.close()
-    if app:
-        return jsonify({'success': True, 'application': dict(app)})
-    return jsonify({'success': True, 'application': None})
+    def write(cursor):
+        for table in expired:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+    if expired:
+        run_write(write)
+        _gps_partitions.difference_update(expired)
+    return {'dropped': expired}
 
-@app.route('/api/driver/application', methods=['POST'])
+@app.route('/api/driver/location', methods=['POST'])
 @login_required
 @swag_from({
     'tags': ['Водители'],
@@ -1389,459 +7487,519 @@ def get_driver_application():
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'licenseNumber': {'type': 'string', 'example': '1234567890'},
-                    'experience': {'type': 'integer', 'example': 5},
-                    'carModel': {'type': 'string', 'example': 'Volvo FH16'},
-                    'carNumber': {'type': 'string', 'example': 'А123ВС45'},
-                    'maxWeight': {'type': 'number', 'example': 20000},
-                    'carType': {'type': 'string', 'example': 'tent'}
+                    'orderId': {'type': 'integer', 'description': 'Заказ, который везет водитель', 'example': 15},
+                    'points': {
+                        'type': 'array',
+                        'description': 'Точки [unix-время в секундах, широта, долгота]',
+                        'items': {'type': 'array', 'items': {'type': 'number'}},
+                        'example': [[1760000000, 55.7558, 37.6173], [1760000005, 55.7561, 37.6180]]
+                    }
                 },
-                'required': ['licenseNumber', 'experience', 'carModel', 'carNumber', 'maxWeight', 'carType']
+                'required': ['points']
             }
         }
     ],
     'responses': {
         200: {
-            'description': 'Заявка успешно отправлена',
+            'description': 'Точки приняты',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Заявка успешно отправлена'},
-                    'applicationId': {'type': 'integer', 'example': 1}
+                    'accepted': {'type': 'integer', 'example': 2},
+                    'stored': {'type': 'integer', 'example': 2},
+                    'rejected': {'type': 'integer', 'example': 0}
                 }
             }
         },
-        400: {'description': 'Уже есть активная заявка'}
+        400: {'description': 'Ошибка валидации'},
+        403: {'description': 'Не водитель или заказ не назначен ему'}
     }
 })
-def submit_driver_application():
-    """Подать заявку на роль водителя"""
+def ingest_driver_location():
+    """Прием пачки GPS-точек от водителя"""
     try:
-        data = request.get_json()
-        # Проверка существующей заявки
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM driver_applications WHERE user_id = ? AND status = ?',
-                      (session['user_id'], 'pending'))
-        if cursor.fetchone():
+        data = request.get_json() or {}
+        driver_id = session['user_id']
+        order_id = data.get('orderId')
+        raw = data.get('points')
+        if not isinstance(raw, list) or not raw:
+            return jsonify({'success': False, 'message': 'points должен быть непустым массивом'}), 400
+        if len(raw) > app.config['GPS_MAX_BATCH']:
+            return jsonify({'success': False,
+                            'message': f"Не более {app.config['GPS_MAX_BATCH']} точек за запрос"}), 400
+        if order_id is not None and not isinstance(order_id, int):
+            return jsonify({'success': False, 'message': 'orderId должен быть числом'}), 400
+        # Права проверяются по БД один раз, дальше - по памяти
+        if not _positions.knows(driver_id, order_id):
+            conn = get_read_db()
+            is_driver = UserRepo.is_driver(conn, driver_id)
             conn.close()
-            return jsonify({'success': False, 'message': 'У вас уже есть активная заявка'}), 400
-        cursor.execute('''
-            INSERT INTO driver_applications (
-                user_id, license_number, experience, car_model, car_number,
-                max_weight, car_type
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            session['user_id'],
-            data.get('licenseNumber', ''),
-            int(data.get('experience', 0)),
-            data.get('carModel', ''),
-            data.get('carNumber', ''),
-            float(data.get('maxWeight', 0)),
-            data.get('carType', 'tent')
-        ))
-        app_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Заявка успешно отправлена', 'applicationId': app_id})
+            order = fetch_order_row('user_id, driver_id, status', order_id) if order_id is not None else None
+            if not is_driver:
+                return jsonify({'success': False, 'message': 'Только водители передают координаты'}), 403
+            if order_id is not None and (not order or order['driver_id'] != driver_id
+                                         or order['status'] not in GPS_TRACKED_STATUSES):
+                return jsonify({'success': False, 'message': 'Заказ не назначен вам или уже завершен'}), 403
+            _positions.register(driver_id, order_id, order['user_id'] if order else None)
+        points, rejected = parse_gps_points(raw)
+        stored = store_gps_points(driver_id, order_id, points) if points else 0
+        if points:
+            _positions.update(driver_id, order_id, max(points))
+        return jsonify({'success': True, 'accepted': len(points), 'stored': stored, 'rejected': rejected})
     except Exception as e:
-        print(f"[ERROR] Ошибка при подаче заявки: {e}", file=sys.stderr)
+        print(f"[ERROR] ingest_driver_location: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-# === АДМИНСКИЕ ФУНКЦИИ ===
-@app.route('/api/admin/driver_applications', methods=['GET'])
-@admin_required
+@app.route('/api/orders/<int:order_id>/location', methods=['GET'])
+@login_required
 @swag_from({
-    'tags': ['Администрирование'],
+    'tags': ['Заказы'],
     'security': [{'SessionAuth': []}],
+    'parameters': [
+        {'name': 'order_id', 'in': 'path', 'type': 'integer', 'required': True}
+    ],
     'responses': {
         200: {
-            'description': 'Список заявок водителей',
+            'description': 'Последнее известное местоположение груза',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'applications': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'object',
-                            'properties': {
-                                'id': {'type': 'integer', 'example': 1},
-                                'firstName': {'type': 'string', 'example': 'Иван'},
-                                'lastName': {'type': 'string', 'example': 'Иванов'},
-                                'licenseNumber': {'type': 'string', 'example': '1234567890'},
-                                'status': {'type': 'string', 'example': 'pending'}
-                            }
+                    'location': {
+                        'type': 'object',
+                        'properties': {
+                            'lat': {'type': 'number', 'example': 55.7561},
+                            'lon': {'type': 'number', 'example': 37.618},
+                            'timestamp': {'type': 'string', 'example': '2026-10-19 10:15:05'},
+                            'ageSeconds': {'type': 'integer', 'example': 12}
                         }
                     }
                 }
             }
+        },
+        403: {'description': 'Доступ запрещен'},
+        404: {'description': 'Заказ не найден или нет данных о местоположении'}
+    }
+})
+def get_order_location(order_id):
+    """Последнее местоположение по заказу.
+
+    Обычно отвечает из памяти без запросов к БД. Если процесс не видел
+    точек заказа (перезапуск, другой процесс), участники берутся из заказа,
+    а точка - из таблиц gps_points_*. Доступ проверяется до ответа о
+    наличии данных, чтобы чужие заказы не выдавали, отслеживаются ли они.
+    """
+    entry = _positions.order_entry(order_id)
+    if entry is None:
+        order = fetch_order_row('user_id, driver_id', order_id)
+        if order is None:
+            return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
+        entry = {'userId': order['user_id'], 'driverId': order['driver_id'], 'position': None}
+    user_id = session['user_id']
+    if user_id not in (entry['userId'], entry['driverId']):
+        # Администратор - единственный случай, когда нужна БД
+        conn = get_read_db()
+        is_admin = UserRepo.is_admin(conn, user_id)
+        conn.close()
+        if not is_admin:
+            return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+    if entry['position'] is None and entry['driverId'] is not None:
+        entry['position'] = latest_gps_point(entry['driverId'], order_id)
+    if entry['position'] is None:
+        return jsonify({'success': False, 'message': 'Нет данных о местоположении'}), 404
+    ts, lat, lon = entry['position']
+    return jsonify({
+        'success': True,
+        'location': {
+            'lat': lat,
+            'lon': lon,
+            'timestamp': datetime.fromtimestamp(ts).isoformat(sep=' '),
+            'ageSeconds': max(int(time.time() - ts), 0),
+            'driverId': entry['driverId']
+        }
+    })
+
+# === СОСТОЯНИЕ СЕРВИСА ===
+def wal_status(database):
+    """Кадры WAL без чекпойнта: (всего в WAL, уже перенесено в БД, размер файла WAL).
+
+    Счетчики mxFrame и nBackfill читаются из заголовка wal-index (файл -shm,
+    порядок байтов машины); без -shm число кадров оценивается по размеру WAL.
+    """
+    wal_path = database + '-wal'
+    wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    try:
+        with open(database + '-shm', 'rb') as shm:
+            header = shm.read(WAL_INDEX_HEADER_SIZE)
+        if len(header) == WAL_INDEX_HEADER_SIZE:
+            frames = struct.unpack_from('=I', header, WAL_INDEX_MAX_FRAME)[0]
+            backfilled = struct.unpack_from('=I', header, WAL_INDEX_BACKFILL)[0]
+            return frames, min(backfilled, frames), wal_size
+    except OSError:
+        pass
+    conn = get_read_db(database)
+    try:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    finally:
+        conn.close()
+    return max(wal_size - 32, 0) // (page_size + 24), 0, wal_size
+
+# Смещения в заголовке wal-index (формат файла -shm SQLite)
+WAL_INDEX_MAX_FRAME = 16  # WalIndexHdr.mxFrame
+WAL_INDEX_BACKFILL = 96  # WalCkptInfo.nBackfill
+WAL_INDEX_HEADER_SIZE = 136
+
+@app.route('/api/health', methods=['GET'])
+@swag_from({
+    'tags': ['Администрирование'],
+    'responses': {
+        200: {
+            'description': 'Сервис отвечает (подробности - GET /api/admin/health)',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean', 'example': True},
+                    'status': {'type': 'string', 'example': 'ok'}
+                }
+            }
         }
     }
 })
-def get_driver_applications():
-    """Получить все заявки водителей (для админа)"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT da.*, u.first_name, u.last_name, u.phone, u.email
-        FROM driver_applications da
-        JOIN users u ON da.user_id = u.id
-        ORDER BY da.applied_at DESC
-    ''')
-    applications = []
-    for row in cursor.fetchall():
-        app_dict = dict(row)
-        applications.append(app_dict)
-    conn.close()
-    return jsonify({'success': True, 'applications': applications})
+def health():
+    """Проверка живости для балансировщика: без состояния БД и без записи"""
+    return jsonify({'success': True, 'status': 'ok'})
 
-@app.route('/api/admin/driver_application/<int:app_id>/approve', methods=['POST'])
+@app.route('/api/admin/health', methods=['GET'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
-    'parameters': [
-        {
-            'name': 'app_id',
-            'in': 'path',
-            'type': 'integer',
-            'required': True,
-            'description': 'ID заявки'
-        }
-    ],
     'responses': {
         200: {
-            'description': 'Заявка успешно одобрена',
+            'description': 'Состояние БД: размер WAL, отставание чекпойнта, пул чтения',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Заявка одобрена'}
+                    'status': {'type': 'string', 'enum': ['ok', 'warning'], 'example': 'ok'},
+                    'walSizeBytes': {'type': 'integer', 'example': 4194304},
+                    'checkpointLagFrames': {'type': 'integer', 'example': 0}
                 }
             }
-        },
-        400: {'description': 'Заявка уже обработана или не найдена'},
-        404: {'description': 'Заявка не найдена'}
+        }
     }
 })
-def approve_driver_application(app_id):
-    """Одобрить заявку водителя"""
+def admin_health():
+    """Состояние WAL, пула чтения и очереди записи; чекпойнт не запускается"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        # Получаем заявку
-        cursor.execute('SELECT * FROM driver_applications WHERE id = ?', (app_id,))
-        app = cursor.fetchone()
-        if not app:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заявка не найдена'}), 404
-        if app['status'] != 'pending':
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заявка уже обработана'}), 400
-        # Создаем запись водителя
-        cursor.execute('''
-            INSERT INTO drivers (
-                user_id, license_number, experience, car_model, car_number,
-                max_weight, car_type, status, work_status, hire_date
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            app['user_id'],
-            app['license_number'],
-            app['experience'],
-            app['car_model'],
-            app['car_number'],
-            app['max_weight'],
-            app['car_type'],
-            'active',
-            'active',
-            datetime.now().date().isoformat()
-        ))
-        # Обновляем роль пользователя
-        cursor.execute('UPDATE users SET is_driver = 1 WHERE id = ?', (app['user_id'],))
-        # Обновляем статус заявки
-        cursor.execute('''
-            UPDATE driver_applications SET status = ?, processed_at = ?, processed_by = ?
-            WHERE id = ?
-        ''', ('approved', datetime.now(), session['user_id'], app_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Заявка одобрена'})
+        if app.config['STORAGE_BACKEND'] == 'memory':
+            wal_frames, checkpointed, wal_size = 0, 0, 0
+        else:
+            wal_frames, checkpointed, wal_size = wal_status(app.config['DATABASE'])
+        lag = wal_frames - checkpointed
+        pool = get_read_pool().stats()
+        warnings = []
+        if lag > app.config['HEALTH_WAL_LAG_WARN']:
+            warnings.append('Чекпойнт отстает: долгие читатели удерживают WAL')
+        if pool['oldestSnapshotAge'] > app.config['HEALTH_SNAPSHOT_AGE_WARN']:
+            warnings.append('Снимок чтения удерживается слишком долго')
+        if app.config['STORAGE_BACKEND'] == 'memory':
+            warnings.append('Хранилище в памяти: чтение видит незафиксированные записи')
+        return jsonify({
+            'success': True,
+            'status': 'warning' if warnings else 'ok',
+            'warnings': warnings,
+            'walSizeBytes': wal_size,
+            'walFrames': wal_frames,
+            'checkpointedFrames': checkpointed,
+            'checkpointLagFrames': lag,
+            'readPool': pool,
+            'writerQueue': get_writer().queue.qsize() if app.config['WRITER_MODE'] == 'queue' else 0
+        })
     except Exception as e:
-        print(f"[ERROR] Ошибка при одобрении заявки: {e}", file=sys.stderr)
+        print(f"[ERROR] admin_health: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/admin/driver_application/<int:app_id>/reject', methods=['POST'])
+@app.route('/api/admin/rate-limits', methods=['GET'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
-    'parameters': [
-        {
-            'name': 'app_id',
-            'in': 'path',
-            'type': 'integer',
-            'required': True,
-            'description': 'ID заявки'
-        }
-    ],
     'responses': {
         200: {
-            'description': 'Заявка успешно отклонена',
+            'description': 'Счетчики ограничителя частоты по маршрутам',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Заявка отклонена'}
+                    'routes': {'type': 'object'},
+                    'trackedKeys': {'type': 'integer', 'example': 120}
                 }
             }
-        },
-        404: {'description': 'Заявка не найдена'}
+        }
     }
 })
-def reject_driver_application(app_id):
-    """Отклонить заявку водителя"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM driver_applications WHERE id = ?', (app_id,))
-        app = cursor.fetchone()
-        if not app:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Заявка не найдена'}), 404
-        cursor.execute('''
-            UPDATE driver_applications SET status = ?, processed_at = ?, processed_by = ?
-            WHERE id = ?
-        ''', ('rejected', datetime.now(), session['user_id'], app_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Заявка отклонена'})
-    except Exception as e:
-        print(f"[ERROR] Ошибка при отклонении заявки: {e}", file=sys.stderr)
-        return jsonify({'success': False, 'message': str(e)}), 500
+def admin_rate_limits():
+    """Статистика ограничителя частоты запросов"""
+    return jsonify({
+        'success': True,
+        'routes': {
+            route: {'limits': limits, **rate_limit_counters.get(route, {'allowed': 0, 'rejectedIp': 0, 'rejectedLogin': 0})}
+            for route, limits in app.config['RATE_LIMITS'].items()
+        },
+        'trackedKeys': len(_rate_limiter.buckets),
+        'maxKeys': _rate_limiter.max_keys
+    })
 
-# === АДМИН: список водителей ===
-@app.route('/api/admin/drivers', methods=['GET'])
+@app.route('/api/admin/repositories', methods=['GET'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
+    'parameters': [
+        {
+            'name': 'reset',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Обнулить счетчики после чтения'
+        }
+    ],
     'responses': {
         200: {
-            'description': 'Список водителей',
+            'description': 'Время методов репозиториев в этом процессе',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'drivers': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'object',
-                            'properties': {
-                                'id': {'type': 'integer', 'example': 1},
-                                'firstName': {'type': 'string', 'example': 'Иван'},
-                                'lastName': {'type': 'string', 'example': 'Иванов'},
-                                'carModel': {'type': 'string', 'example': 'Volvo FH16'},
-                                'status': {'type': 'string', 'example': 'active'}
-                            }
-                        }
-                    }
+                    'storage': {'type': 'string', 'example': 'sqlite'},
+                    'timing': {'type': 'boolean', 'example': True},
+                    'methods': {'type': 'object'}
                 }
             }
         }
     }
 })
-def admin_drivers():
-    """Получить список водителей с данными пользователя"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT d.*, u.first_name, u.last_name, u.phone, u.email
-            FROM drivers d
-            JOIN users u ON d.user_id = u.id
-            ORDER BY d.id DESC
-        ''')
-        drivers = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({'success': True, 'drivers': drivers})
-    except Exception as e:
-        print(f"[ERROR] admin_drivers: {e}", file=sys.stderr)
-        return jsonify({'success': False, 'message': str(e)}), 500
+def admin_repositories():
+    """Число вызовов и время методов UserRepo/OrderRepo/DriverRepo/ApplicationRepo"""
+    return jsonify({
+        'success': True,
+        'storage': app.config['STORAGE_BACKEND'],
+        'timing': app.config['REPO_TIMING'],
+        'statementCacheSize': app.config['STATEMENT_CACHE_SIZE'],
+        'methods': _repo_timings.snapshot(reset=parse_bool_arg('reset'))
+    })
 
-@app.route('/api/admin/drivers/<int:driver_user_id>/dismiss', methods=['POST'])
+@app.route('/api/admin/traces', methods=['GET'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'driver_user_id',
-            'in': 'path',
-            'type': 'integer',
-            'required': True,
-            'description': 'ID пользователя-водителя'
+            'name': 'minMs',
+            'in': 'query',
+            'type': 'number',
+            'required': False,
+            'description': 'Только запросы не короче N мс'
         },
         {
-            'name': 'body',
-            'in': 'body',
-            'schema': {
-                'type': 'object',
-                'properties': {
-                    'reason': {'type': 'string', 'example': 'Нарушение правил'},
-                    'action': {'type': 'string', 'enum': ['reassign', 'cancel', 'keep'], 'example': 'reassign'}
-                }
-            }
+            'name': 'path',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'Часть имени трассы (метод и шаблон маршрута), например /api/orders'
+        },
+        {
+            'name': 'limit',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': 'Сколько трасс вернуть (по умолчанию 50)'
         }
     ],
     'responses': {
         200: {
-            'description': 'Водитель успешно удален',
+            'description': 'Сохраненные трассы этого процесса, от новых к старым',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Водитель успешно удален из системы'}
+                    'sampleRate': {'type': 'number', 'example': 0.01},
+                    'traces': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'traceId': {'type': 'string', 'example': '9f2c4e1a7b3d5f60'},
+                                'requestId': {'type': 'string', 'example': 'checkout-42'},
+                                'name': {'type': 'string', 'example': 'POST /api/orders'},
+                                'status': {'type': 'integer', 'example': 200},
+                                'startedAt': {'type': 'string', 'example': '2025-03-01 12:00:00.123'},
+                                'durationMs': {'type': 'number', 'example': 2043.5},
+                                'spans': {'type': 'integer', 'example': 42},
+                                'dropped': {'type': 'integer', 'example': 0}
+                            }
+                        }
+                    }
                 }
             }
         },
-        404: {'description': 'Водитель не найден'}
+        400: {'description': 'Некорректный параметр'}
     }
 })
-def dismiss_driver(driver_user_id):
-    """Удалить водителя из системы"""
+def admin_traces():
+    """Список сохраненных трасс запросов"""
     try:
-        data = request.get_json() or {}
-        reason = data.get('reason', '')
-        conn = get_db()
-        cursor = conn.cursor()
-        # Проверяем водителя
-        cursor.execute('SELECT * FROM drivers WHERE user_id = ?', (driver_user_id,))
-        driver = cursor.fetchone()
-        if not driver:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
-        # Удаляем запись водителя из таблицы drivers
-        cursor.execute('DELETE FROM drivers WHERE user_id = ?', (driver_user_id,))
-        # Снимаем роль водителя с пользователя
-        cursor.execute('UPDATE users SET is_driver = 0 WHERE id = ?', (driver_user_id,))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Водитель успешно удален из системы'})
-    except Exception as e:
-        print(f"[ERROR] dismiss_driver: {e}", file=sys.stderr)
-        return jsonify({'success': False, 'message': str(e)}), 500
+        min_ms = float(request.args.get('minMs', 0))
+        limit = max(int(request.args.get('limit', 50)), 1)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'minMs и limit должны быть числами'}), 400
+    traces = _traces.select(min_ms=min_ms, path=request.args.get('path'), limit=limit)
+    return jsonify({'success': True, 'sampleRate': app.config['TRACE_SAMPLE_RATE'],
+                    'traces': [trace.summary() for trace in traces]})
 
-@app.route('/api/admin/drivers/<int:driver_user_id>/restore', methods=['POST'])
+@app.route('/api/admin/traces/export', methods=['GET'])
 @admin_required
 @swag_from({
     'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
         {
-            'name': 'driver_user_id',
-            'in': 'path',
-            'type': 'integer',
-            'required': True,
-            'description': 'ID пользователя-водителя'
-        }
+            'name': 'ids',
+            'in': 'query',
+            'type': 'string',
+            'required': False,
+            'description': 'traceId через запятую (заголовок X-Trace-Id ответа); '
+                           'без ids выбор по minMs/path/limit, как в /api/admin/traces'
+        },
+        {'name': 'minMs', 'in': 'query', 'type': 'number', 'required': False},
+        {'name': 'path', 'in': 'query', 'type': 'string', 'required': False},
+        {'name': 'limit', 'in': 'query', 'type': 'integer', 'required': False}
     ],
     'responses': {
         200: {
-            'description': 'Водитель успешно восстановлен',
+            'description': 'Файл Chrome trace (chrome://tracing, ui.perfetto.dev); каждая трасса - отдельный процесс',
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Водитель восстановлен'}
+                    'traceEvents': {'type': 'array', 'items': {'type': 'object'}},
+                    'displayTimeUnit': {'type': 'string', 'example': 'ms'}
                 }
             }
         },
-        404: {'description': 'Водитель не найден'}
+        400: {'description': 'Некорректный параметр'},
+        404: {'description': 'Трассы не найдены'}
     }
 })
-def restore_driver(driver_user_id):
-    """Восстановить водителя"""
+def admin_traces_export():
+    """Выгрузить трассы в формате Chrome trace event для просмотра флеймграфа"""
+    trace_ids = {value.strip() for value in request.args.get('ids', '').split(',') if value.strip()}
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM drivers WHERE user_id = ?', (driver_user_id,))
-        driver = cursor.fetchone()
-        if not driver:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
-        cursor.execute('''
-            UPDATE drivers 
-            SET status = 'active',
-                inactive_since = NULL,
-                inactive_reason = NULL,
-                dismissal_reason = NULL,
-                dismissed_by = NULL
-            WHERE user_id = ?
-        ''', (driver_user_id,))
-        cursor.execute('UPDATE users SET is_driver = 1 WHERE id = ?', (driver_user_id,))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Водитель восстановлен'})
-    except Exception as e:
-        print(f"[ERROR] restore_driver: {e}", file=sys.stderr)
-        return jsonify({'success': False, 'message': str(e)}), 500
+        min_ms = float(request.args.get('minMs', 0))
+        limit = max(int(request.args.get('limit', 20)), 1)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'minMs и limit должны быть числами'}), 400
+    traces = _traces.select(trace_ids, min_ms, request.args.get('path'), limit)
+    if not traces:
+        return jsonify({'success': False, 'message': 'Трассы не найдены'}), 404
+    events = [event for pid, trace in enumerate(traces, 1) for event in trace.chrome_events(pid)]
+    response = jsonify({'traceEvents': events, 'displayTimeUnit': 'ms'})
+    response.headers['Content-Disposition'] = 'attachment; filename="traces.json"'
+    return response
 
-# === ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ВОДИТЕЛЕЙ ===
-@app.route('/api/driver/info', methods=['GET'])
-@login_required
+@app.route('/api/admin/cache', methods=['GET'])
+@admin_required
 @swag_from({
-    'tags': ['Водители'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'responses': {
         200: {
-            'description': 'Информация о водителе',
+            'description': 'Счетчики кэша ответов в этом процессе и текущие версии тегов',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'driver': {
+                    'responses': {
                         'type': 'object',
                         'properties': {
-                            'id': {'type': 'integer', 'example': 1},
-                            'licenseNumber': {'type': 'string', 'example': '1234567890'},
-                            'carModel': {'type': 'string', 'example': 'Volvo FH16'},
-                            'completedDeliveries': {'type': 'integer', 'example': 15}
+                            'hits': {'type': 'integer'},
+                            'misses': {'type': 'integer'},
+                            'stale': {'type': 'integer'},
+                            'evictions': {'type': 'integer'},
+                            'hitRate': {'type': 'number'},
+                            'entries': {'type': 'integer'},
+                            'bytes': {'type': 'integer'}
                         }
-                    }
+                    },
+                    'tags': {'type': 'object', 'example': {'drivers': 12, 'users': 4}}
                 }
             }
+        }
+    }
+})
+def admin_cache():
+    """Попадания, промахи и вытеснения кэша ответов списков администратора"""
+    conn = get_read_db()
+    tags = dict(conn.execute('SELECT tag, version FROM cache_tags').fetchall())
+    conn.close()
+    return jsonify({'success': True, 'responses': _response_cache.snapshot(), 'tags': tags})
+
+@app.route('/api/admin/changes/<consumer>', methods=['GET'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
+    'produces': ['application/x-ndjson'],
+    'parameters': [
+        {
+            'name': 'consumer',
+            'in': 'path',
+            'type': 'string',
+            'required': True,
+            'description': 'Имя потребителя (billing, analytics, ...)'
         },
-        404: {'description': 'Водитель не найден'}
+        {
+            'name': 'limit',
+            'in': 'query',
+            'type': 'integer',
+            'required': False,
+            'description': 'Максимум событий (по умолчанию 10000, не более 100000)'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'NDJSON: по строке на событие {source, seq, table, rowId, operation, columns, changedAt}, '
+                           'последняя строка - {cursor, count, hasMore, gaps}. Курсор подтверждается '
+                           'POST /api/admin/changes/<consumer>/ack'
+        },
+        400: {'description': 'Некорректное имя потребителя или limit'}
     }
 })
-def get_driver_info():
-    """Получить информацию о водителе (для текущего пользователя)"""
+def read_change_log(consumer):
+    """Потоковое чтение журнала изменений после подтвержденного курсора потребителя"""
+    if not CHANGE_CONSUMER_NAME.fullmatch(consumer):
+        return jsonify({'success': False, 'message': 'Некорректное имя потребителя'}), 400
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT d.*, u.first_name, u.last_name, u.phone, u.email
-            FROM drivers d
-            JOIN users u ON d.user_id = u.id
-            WHERE d.user_id = ?
-        ''', (session['user_id'],))
-        driver = cursor.fetchone()
-        conn.close()
-        if driver:
-            return jsonify({'success': True, 'driver': dict(driver)})
-        return jsonify({'success': False, 'message': 'Водитель не найден'}), 404
-    except Exception as e:
-        print(f"[ERROR] get_driver_info: {e}", file=sys.stderr)
-        return jsonify({'success': False, 'message': str(e)}), 500
+        limit = min(max(int(request.args.get('limit', CHANGE_LOG_LIMIT)), 1), CHANGE_LOG_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit должен быть числом'}), 400
+    return app.response_class(stream_change_log(change_log_sources(), change_consumer_cursor(consumer), limit),
+                              mimetype='application/x-ndjson')
 
-@app.route('/api/driver/work-status', methods=['POST'])
-@login_required
+@app.route('/api/admin/changes/<consumer>/ack', methods=['POST'])
+@admin_required
 @swag_from({
-    'tags': ['Водители'],
+    'tags': ['Администрирование'],
     'security': [{'SessionAuth': []}],
     'parameters': [
+        {
+            'name': 'consumer',
+            'in': 'path',
+            'type': 'string',
+            'required': True
+        },
         {
             'name': 'body',
             'in': 'body',
@@ -1849,50 +8007,96 @@ def get_driver_info():
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'workStatus': {'type': 'string', 'enum': ['active', 'inactive'], 'example': 'active'}
+                    'cursor': {'type': 'object', 'example': {'transport_company.db': 1200}}
                 },
-                'required': ['workStatus']
+                'required': ['cursor']
             }
         }
     ],
+    'responses': {
+        200: {'description': 'Курсор сохранен'},
+        400: {'description': 'Некорректный курсор или источник'}
+    }
+})
+def ack_change_log(consumer):
+    """Подтвердить обработку событий до курсора включительно"""
+    if not CHANGE_CONSUMER_NAME.fullmatch(consumer):
+        return jsonify({'success': False, 'message': 'Некорректное имя потребителя'}), 400
+    data = request.get_json(silent=True) or {}
+    cursor = data.get('cursor')
+    sources = change_log_sources()
+    if (not isinstance(cursor, dict) or not cursor
+            or any(source not in sources or type(seq) is not int or seq < 0 for source, seq in cursor.items())):
+        return jsonify({'success': False, 'message': 'cursor - объект {источник: seq} из ответа журнала'}), 400
+    ack_change_consumer(consumer, cursor)
+    return jsonify({'success': True, 'cursor': change_consumer_cursor(consumer)})
+
+@app.route('/api/admin/maintenance', methods=['GET'])
+@admin_required
+@swag_from({
+    'tags': ['Администрирование'],
+    'security': [{'SessionAuth': []}],
     'responses': {
         200: {
-            'description': 'Статус работы успешно обновлен',
+            'description': 'Состояние планировщика обслуживания БД',
             'schema': {
                 'type': 'object',
                 'properties': {
                     'success': {'type': 'boolean', 'example': True},
-                    'message': {'type': 'string', 'example': 'Статус работы обновлен'}
+                    'lease': {'type': 'object'},
+                    'process': {'type': 'object'},
+                    'tasks': {'type': 'array', 'items': {'type': 'object'}}
                 }
             }
-        },
-        400: {'description': 'Некорректный статус'},
-        403: {'description': 'Только водители могут изменять статус работы'}
+        }
     }
 })
-def update_driver_work_status():
-    """Обновить статус работы водителя (active/inactive)"""
+def admin_maintenance():
+    """Аренда исполнителя, расписание и результаты последних запусков задач"""
     try:
-        data = request.get_json()
-        work_status = data.get('workStatus')
-        if work_status not in ['active', 'inactive']:
-            return jsonify({'success': False, 'message': 'Некорректный статус'}), 400
-        conn = get_db()
+        conn = get_read_db()
         cursor = conn.cursor()
-        # Проверяем что пользователь - водитель
-        cursor.execute('SELECT is_driver FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
-        if not user or not user['is_driver']:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Только водители могут изменять статус работы'}), 403
-        cursor.execute('''
-            UPDATE drivers SET work_status = ? WHERE user_id = ?
-        ''', (work_status, session['user_id']))
-        conn.commit()
+        cursor.execute('SELECT owner, expires_at FROM maintenance_lease WHERE id = 1')
+        lease = cursor.fetchone()
+        cursor.execute('SELECT name, last_run, duration, runs, result, error FROM maintenance_tasks')
+        history = {row['name']: row for row in cursor.fetchall()}
         conn.close()
-        return jsonify({'success': True, 'message': 'Статус работы обновлен'})
+        now = time.time()
+        scheduler = _maintenance if _maintenance is not None and _maintenance.pid == os.getpid() else None
+        tasks = []
+        for name, interval in app.config['MAINTENANCE_INTERVALS'].items():
+            row = history.get(name)
+            last_run = row['last_run'] if row else None
+            base = last_run if last_run is not None else (scheduler.started if scheduler else now)
+            tasks.append({
+                'name': name,
+                'interval': interval,
+                'lastRun': datetime.fromtimestamp(last_run).isoformat(sep=' ') if row else None,
+                'nextRun': datetime.fromtimestamp(base + interval).isoformat(sep=' '),
+                'durationMs': round(row['duration'] * 1000, 1) if row else None,
+                'runs': row['runs'] if row else 0,
+                'result': json.loads(row['result']) if row and row['result'] else None,
+                'error': row['error'] if row else None
+            })
+        return jsonify({
+            'success': True,
+            'enabled': app.config['MAINTENANCE_ENABLED'],
+            'lease': {
+                'owner': lease['owner'],
+                'expiresAt': datetime.fromtimestamp(lease['expires_at']).isoformat(sep=' '),
+                'active': lease['expires_at'] > now
+            } if lease else None,
+            'process': {
+                'owner': scheduler.owner if scheduler else None,
+                'leader': scheduler.leader if scheduler else False,
+                'busy': scheduler.busy if scheduler else None,
+                'deferred': scheduler.deferred if scheduler else 0,
+                'latencyAvgMs': round(_latency.current(app.config['MAINTENANCE_TICK']) * 1000, 1)
+            },
+            'tasks': tasks
+        })
     except Exception as e:
-        print(f"[ERROR] update_driver_work_status: {e}", file=sys.stderr)
+        print(f"[ERROR] admin_maintenance: {e}", file=sys.stderr)
         return jsonify({'success': False, 'message': str(e)}), 500
 
 # === ГЛАВНАЯ ФУНКЦИЯ ===
@@ -1900,6 +8104,8 @@ if __name__ == '__main__':
     if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
         print("[INFO] Запуск Flask-сервера...")
     init_db()
+    # Демо-стенд без SMS-шлюза: код регистрации показывается в интерфейсе
+    app.config['VERIFICATION_EXPOSE_CODE'] = True
     app.run(
         host='127.0.0.1',
         port=5000,